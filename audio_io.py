@@ -3,11 +3,19 @@ import data
 import time
 import queue
 import threading
-import random
+import functools
 import shutil
 import subprocess
 import logging
+import os
 import data
+import shuffle
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 db = data.WebStereoDB  # there is no need for a database object, but this is used to simplify references to its static constants.
@@ -22,22 +30,297 @@ class NoAudioIOAvailableError(Exception):
     pass
 
 
-# On Darwin, check whether we have access to FFMPEG. If we don't, fallback to afplay, but that doesn't support seeking.
-USE_FFPLAY = False
-if shutil.which('ffplay'):
-    USE_FFPLAY = True
-elif shutil.which('ffmpeg') and sys.platform not in ['win32', 'darwin']:
-    # Linux-specific ffmpeg trick using ALSA
-    USE_FFPLAY = False  # technically, we still use ffmpeg, but we can't do anything else.
-else:
-    raise NoAudioIOAvailableError('unable to locate a suitable program to do audio I/O')
+# What the player is doing, for /metrics.
+PROCESS_SPAWNS = metrics.Counter('webstereo_player_process_spawns_total', 'ffmpeg and ffplay processes started by the player.', ['process'])
+SEEKS = metrics.Counter('webstereo_player_seeks_total', 'Seeks within the current track.')
+TRACK_ADVANCES = metrics.Counter('webstereo_player_track_advances_total', 'Tracks started: gapless when playback ran on into a queued track, restart when '
+                                 'the decoder was started afresh.', ['mode'])
+AUDIO_START_SECONDS = metrics.Histogram('webstereo_player_audio_start_seconds', 'Time from a play or seek command to its first audio reaching the output '
+                                        'process.', buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+
+# Every track is decoded by ffmpeg into raw PCM, which is handed to a single long-lived output process (see PlaybackEngine). On Darwin, ffplay plays that
+# PCM; elsewhere, ffmpeg writes it to ALSA.
+def use_ffplay():
+    # Whether the output process is ffplay, rather than ffmpeg writing to ALSA. Raises NoAudioIOAvailableError if there is nothing to play audio with. This is
+    # looked for when a PlaybackEngine is made, rather than on import, so that importing webstereo has no such requirement and create_app() reports it instead.
+    if not shutil.which('ffmpeg'):
+        raise NoAudioIOAvailableError('unable to locate ffmpeg, which is needed to decode audio')
+
+    if shutil.which('ffplay'):
+        return True
+    elif sys.platform not in ['win32', 'darwin']:
+        # Linux-specific ffmpeg trick using ALSA
+        return False  # technically, we still use ffmpeg, but we can't do anything else.
+    else:
+        raise NoAudioIOAvailableError('unable to locate a suitable program to do audio I/O')
+
+
+def prebuffer_file(filename):
+    # Ask the operating system to read a file into its cache ahead of time, so that the player starts on it without waiting for the disk.
+    try:
+        with open(filename, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                while f.read(1 << 20):
+                    pass
+    except OSError as e:
+        log.debug('could not prebuffer %s: %s' % (filename, e))
+
+
+class TrackBoundary:
+    # Placed in the PlaybackEngine's buffer between the last sample of one track and the first of the next, so that the output stage knows when the listener
+    # actually hears the change.
+    def __init__(self, filename, token, gain=0):
+        self.filename = filename
+        self.token = token
+        self.gain = gain
+
+
+END_OF_QUEUE = object()  # placed in the buffer after the last sample of a track with nothing queued behind it
+
+
+class PlaybackEngine:
+    # Plays PCM through one output process that stays open for as long as webstereo runs. Each track is decoded by an ffmpeg process writing raw samples to a
+    # pipe; a reader thread moves them into a bounded buffer, and the output thread moves them from there to the output process. Pausing simply stops the output
+    # thread, so nothing is restarted; seeking restarts the decoder alone, with -ss ahead of -i so that ffmpeg decodes from the nearest keyframe and discards
+    # samples up to the exact position. The position reported is the number of samples handed to the output, rather than a wall-clock estimate.
+    # The file to play after the current one can be queued ahead of time (see queue_next()); its decoder is started as soon as the current one reaches the
+    # end, and its samples follow on in the same buffer, so that there is no gap between tracks.
+    SAMPLE_RATE = 44100
+    CHANNELS = 2
+    FRAME_BYTES = 2 * CHANNELS  # signed 16-bit samples
+    CHUNK_FRAMES = 2048  # frames moved at a time, about 46 ms
+    BUFFER_CHUNKS = 64  # about three seconds of read-ahead
+    OUTPUT_PIPE_SIZE = 16384  # bytes; the smaller the pipe to the output process, the less plays on after a pause
+
+    def __init__(self, on_track_change=None, on_finish=None):
+        # on_track_change(token) is called when playback crosses into a file queued with queue_next(), and on_finish() when a track ends with nothing queued
+        # behind it. Both are called from the output thread.
+        self.on_track_change = on_track_change
+        self.on_finish = on_finish
+        self.use_ffplay = use_ffplay()
+        self.lock = threading.Condition()  # guards everything below, and wakes the output thread when it is paused
+        self.buffer = queue.Queue(self.BUFFER_CHUNKS)  # (generation, PCM bytes, TrackBoundary or END_OF_QUEUE)
+        self.generation = 0  # bumped whenever the buffer is flushed; anything tagged with an older generation is stale and is dropped
+        self.filename = None
+        self.gain = 0  # dB, applied to the current file by its decoder
+        self.decoder = None
+        self.pending = None  # (filename, token, gain) to decode straight after the current file
+        self.paused = False
+        self.frames = 0  # frames of the current track handed to the output so far
+        self.output = None
+        self.command_time = None  # (generation, time) of the last play or seek, until its first audio is written; see AUDIO_START_SECONDS
+        self.output_thread = None  # started by the first load(), so that nothing runs until there is something to play
+
+    def position(self):
+        # Seconds into the current track.
+        with self.lock:
+            return self.frames / self.SAMPLE_RATE
+
+    def play(self, filename, start=0, paused=False, gain=0):
+        # Play filename from `start` seconds in, replacing whatever is playing and whatever was queued to follow it. With paused, the decoder fills the buffer but
+        # nothing is heard until resume(). gain is in dB; see AudioController.gain().
+        with self.lock:
+            self.pending = None
+            self.paused = paused
+        TRACK_ADVANCES.inc(1, 'restart')
+        self.load(filename, start, gain)
+
+    def seek(self, start):
+        # Move to `start` seconds into the current track, keeping the pause state and the queued file.
+        if self.filename:
+            SEEKS.inc()
+            self.load(self.filename, max(0, start), self.gain)
+
+    def stop(self):
+        with self.lock:
+            self.pending = None
+            self.filename = None
+        self.flush()
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+            self.command_time = None  # time spent paused is not the player's doing
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self.lock.notify_all()
+
+    def queue_next(self, filename, token=None, gain=0):
+        # Decode filename straight after the current one; None cancels. If the current file has already been read to its end, this is too late, and on_finish()
+        # will be called as usual.
+        with self.lock:
+            self.pending = (filename, token, gain) if filename else None
+
+    def flush(self):
+        # Throw away everything buffered and stop the decoder. Returns the new generation.
+        with self.lock:
+            self.generation += 1
+            decoder = self.decoder
+            self.decoder = None
+            while True:
+                try:
+                    self.buffer.get_nowait()
+                except queue.Empty:
+                    break
+            self.lock.notify_all()
+            generation = self.generation
+        if decoder:
+            decoder.kill()
+        return generation
+
+    def load(self, filename, start, gain=0):
+        generation = self.flush()
+        with self.lock:
+            self.filename = filename
+            self.gain = gain
+            self.frames = round(start * self.SAMPLE_RATE)
+            self.command_time = None if self.paused else (generation, time.perf_counter())
+            if self.output_thread is None:
+                self.output_thread = threading.Thread(target=self.run_output, daemon=True)
+                self.output_thread.start()
+        threading.Thread(target=self.run_decoder, args=(generation, filename, start, gain), daemon=True).start()
+
+    def decoder_command(self, filename, start, gain=0):
+        # The gain is applied as the file is decoded, so it takes effect exactly at the start of the file, even when it follows on from the last without a gap.
+        volume = ['-af', 'volume=%.2fdB' % gain] if gain else []
+        return (['ffmpeg', '-hide_banner', '-loglevel', 'fatal', '-nostdin', '-ss', '%.6f' % start, '-i', filename, '-vn'] + volume
+                + ['-f', 's16le', '-ar', str(self.SAMPLE_RATE), '-ac', str(self.CHANNELS), 'pipe:1'])
+
+    def output_command(self):
+        if self.use_ffplay:
+            # The raw PCM demuxer's options; -ch_layout needs ffmpeg 5.1 or later.
+            return ['ffplay', '-nodisp', '-loglevel', 'error', '-f', 's16le', '-sample_rate', str(self.SAMPLE_RATE), '-ch_layout', 'stereo', 'pipe:0']
+        return ['ffmpeg', '-hide_banner', '-loglevel', 'fatal', '-f', 's16le', '-ar', str(self.SAMPLE_RATE), '-ac', str(self.CHANNELS), '-i', 'pipe:0',
+                '-f', 'alsa', 'default']
+
+    def put(self, generation, item):
+        # Add to the buffer, waiting for room. Returns False, without adding anything, once the buffer has been flushed from under the caller.
+        while True:
+            with self.lock:
+                if generation != self.generation:
+                    return False
+            try:
+                self.buffer.put((generation, item), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+    def run_decoder(self, generation, filename, start, gain):
+        # Read PCM from the decoder into the buffer, going straight on to the queued file, if there is one, at the end of each.
+        while True:
+            decoder = subprocess.Popen(self.decoder_command(filename, start, gain), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=None)
+            PROCESS_SPAWNS.inc(1, 'decoder')
+            with self.lock:
+                if generation != self.generation:
+                    decoder.kill()
+                    return
+                self.decoder = decoder
+
+            while True:
+                chunk = decoder.stdout.read(self.CHUNK_FRAMES * self.FRAME_BYTES)
+                if not chunk:
+                    break
+                if not self.put(generation, chunk):
+                    decoder.kill()
+                    decoder.wait()
+                    return
+            decoder.wait()
+
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.decoder = None
+                pending = self.pending
+                self.pending = None
+
+            if not pending:
+                self.put(generation, END_OF_QUEUE)
+                return
+            if not self.put(generation, TrackBoundary(*pending)):
+                return
+            filename, start, gain = pending[0], 0, pending[2]
+
+    def run_output(self):
+        while True:
+            generation, item = self.buffer.get()
+            with self.lock:
+                self.lock.wait_for(lambda: not self.paused or generation != self.generation)
+                if generation != self.generation:
+                    continue  # flushed while this was waiting
+
+            if item is END_OF_QUEUE:
+                self.notify(self.on_finish)
+            elif isinstance(item, TrackBoundary):
+                with self.lock:
+                    self.filename = item.filename
+                    self.gain = item.gain
+                    self.frames = 0
+                TRACK_ADVANCES.inc(1, 'gapless')
+                self.notify(self.on_track_change, item.token)
+            elif self.write(item):
+                with self.lock:
+                    if generation == self.generation:
+                        self.frames += len(item) // self.FRAME_BYTES
+                    if self.command_time and self.command_time[0] == generation:
+                        AUDIO_START_SECONDS.observe(time.perf_counter() - self.command_time[1])
+                        self.command_time = None
+
+    def notify(self, callback, *args):
+        if not callback:
+            return
+        try:
+            callback(*args)
+        except Exception as e:
+            log.error('error in playback callback: %s' % e)
+
+    def write(self, chunk):
+        # Write to the output process, starting it if it has not been started yet or has died since.
+        if self.output is None or self.output.poll() is not None:
+            log.debug('starting audio output')
+            self.output = subprocess.Popen(self.output_command(), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=None, bufsize=0)
+            PROCESS_SPAWNS.inc(1, 'output')
+            try:
+                fcntl.fcntl(self.output.stdin.fileno(), fcntl.F_SETPIPE_SZ, self.OUTPUT_PIPE_SIZE)
+            except (AttributeError, OSError):
+                pass  # Linux only
+        try:
+            self.output.stdin.write(chunk)
+            return True
+        except (BrokenPipeError, OSError) as e:
+            log.error('audio output failed: %s' % e)
+            self.output = None
+            return False
+
+
+def synchronized(method):
+    # Run an AudioController method holding the controller's lock. Tracks are advanced both by requests and, when a track ends, by the engine's output thread;
+    # holding the lock for the whole of each change keeps two of them from interleaving (and, say, both taking the head of the queue).
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class AudioController:
-    def __init__(self, db):
+    def __init__(self, db, on_track_end=None):
         self.db = db
-        self.up_next = queue.Queue() # Store songs to be played next
-        self.up_prev = []  # Store previously played songs
+        self.lock = threading.RLock()  # see synchronized(); reentrant, as one change is often made of others (next_track() stops, then plays)
+        # Called (from a background thread) when a track plays to its end, as opposed to being stopped, paused or skipped. By default, go on to the next one.
+        self.on_track_end = on_track_end or self.next_track
+        self.engine = PlaybackEngine(on_track_change=self.track_changed, on_finish=lambda: self.on_track_end())
+        self.prepared = None  # (unique ID, database row) for the track expected to play next; see prepare_next()
+        # Every change a listener might care about (track, queue, pause state, position after a seek) bumps state_version and wakes anything waiting in
+        # wait_for_change(), which is how webstereo.py pushes updates to the browser.
+        self.state_changed = threading.Condition()
+        self.state_version = 0
+        self.state_cache = None  # (version, state) for the most recent call to state()
+        self.up_prev = []  # Store previously played songs. Songs to be played next are kept in the database; see queued().
         self.playing = False
         self.paused = False
         self.filename = ''
@@ -45,14 +328,12 @@ class AudioController:
         self.album = ''
         self.track = 0
         self.length = ''
-        self.start_time = 0
         self.proc = None
         self.reset_metadata()
-        self.paused_time = 0  # Used to track when playback was paused
-        self.shuffle_pool = []  # stores songs to play when on shuffle
-        self.shuffle_pool_size = 0  # size of preceding array
+        self.shuffle = None  # a shuffle.Shuffle when on shuffle
         self.shuffle_on = False  # track whether we are in random shuffle mode
         
+    @synchronized
     def reset_metadata(self):
         #if self.album != 'Not playing' and self.song != 'Not playing' and self.album != '' and self.song != '':
         #    # prevent adding blank strings or "Not playing" to the list of previously played tracks
@@ -61,23 +342,72 @@ class AudioController:
         self.filename = ''
         self.song = 'Not playing'
         self.album = 'Not playing'
+        self.song_id = None
+        self.album_id = None
         self.track = 0
         self.length = '0:00'
+        self.notify_change()
+
+    def notify_change(self):
+        with self.state_changed:
+            self.state_version += 1
+            self.state_changed.notify_all()
+
+    def wait_for_change(self, version, timeout=None):
+        # Block until the state moves past `version`, or the timeout expires. Returns the current version either way.
+        with self.state_changed:
+            self.state_changed.wait_for(lambda: self.state_version != version, timeout)
+            return self.state_version
+
+    def position(self):
+        # Seconds into the current track.
+        if not self.playing:
+            return 0
+        return self.engine.position()
+
+    def queued(self, limit=None):
+        # The IDs of the songs in the queue, in order.
+        return [i[1] for i in self.db.queue_entries(limit)]
+
+    def queued_positions(self, limit=None):
+        # The positions of the entries in the queue, in order; these identify entries to move_queued() and remove_queued().
+        return [i[0] for i in self.db.queue_entries(limit)]
+
+    def state(self):
+        # A JSON-friendly summary of what is playing and what is queued. Queue titles are looked up once per change, in one query for each queue.
+        version = self.state_version
+        if self.state_cache is None or self.state_cache[0] != version:
+            up_next_entries = self.db.queue_entries(10)
+            up_next = [i[1] for i in up_next_entries]
+            up_prev = list(self.up_prev)
+            titles = {i[db.DB_SONG_ID]: i[db.DB_SONG_TITLE] for i in self.db.find_songs_by_ids(up_next[:10] + up_prev)}
+            self.state_cache = (version, {
+                'version': version,
+                'playing': self.playing,
+                'paused': self.paused,
+                'shuffle': self.shuffle_on,
+                'song': self.song,
+                'song_id': self.song_id,
+                'album': self.album,
+                'album_id': self.album_id,
+                'track': self.track,
+                'length': self.length,
+                'up_next': [[i, titles.get(i, '')] for i in up_next],
+                'up_next_positions': [i[0] for i in up_next_entries],
+                'up_next_count': self.db.queue_length(),
+                'up_prev': [[i, titles.get(i, '')] for i in up_prev],
+            })
+        return dict(self.state_cache[1], position=round(self.position(), 3))
 
     def play_file(self, filename):
         self.filename = filename
         self.play()
 
-    def play(self, time_continue=0):
-        if self.proc:
-            self.proc.kill()
-
-        if USE_FFPLAY:
-            self.proc = subprocess.Popen(['ffplay', '-nodisp', '-loglevel', 'error', '-ss', str(time_continue), self.filename], stdout=None, stdin=None, stderr=None)
-        else:
-            self.proc = subprocess.Popen(['ffmpeg', '--hide-banner', '-sS', str(time_continue), '-i', self.filename, '-f', 'alsa', 'default'], stdout=None, stdin=None, stderr=None)
-
+    def play(self, time_continue=0, paused=False):
+        self.engine.play(self.filename, time_continue, paused, self.gain(self.song_id))
         self.playing = True
+        self.paused = paused
+
     def _play(self, time_continue=0):
         try:
             self.proc.kill()
@@ -103,58 +433,43 @@ class AudioController:
                 
         self.playing = True
 
+    @synchronized
     def stop(self):
         self.kill_proc()
         self.reset_metadata()
 
+    @synchronized
     def pause(self):
-        self.kill_proc()  # Stop playback
-        self.paused_time = int(time.time()) - self.start_time  # Store progression of song when paused
-        self.paused_timestamp = int(time.time())  # Store time song is paused, so that the counter in the front end may resume properly.
-        self.paused = True  # Set paused flag to set other bits into motion
+        self.engine.pause()  # The output stops taking samples; the decoder and the output process are left as they are.
+        self.paused = True
+        self.notify_change()
 
+    @synchronized
     def resume(self):
-        self.play(self.paused_time)
-        diff = int(time.time()) - self.paused_timestamp  # Determine duration for which song is paused
-        self.start_time += diff  # Set counter properly.
+        self.engine.resume()
         self.paused = False
+        self.notify_change()
 
     def kill_proc(self):
-        if self.proc:  # Don't call kill() on a NoneType object.
-            self.proc.kill()
-
-        self.proc = None  # Set proc to None to destroy the old process
+        self.engine.stop()
 
+    @synchronized
     def go_time(self, time_continue):
-        self.kill_proc()
-        self.playing = False
-        self.play(time_continue=time_continue)
+        self.engine.seek(time_continue)
+        self.notify_change()
 
     def rewind(self, secs):
-        duration = int(time.time()) - self.start_time
-        self.start_time += secs  # Compensate for the fact that we are x seconds behind where we started
-        self.go_time(duration - secs)
+        self.go_time(self.position() - secs)
 
     def forward(self, secs):
-        duration = int(time.time()) - self.start_time
-        self.start_time -= secs  # Compensate for the fact that we are x seconds ahead of where we started
-        self.go_time(duration + secs)
+        self.go_time(self.position() + secs)
 
+    @synchronized
     def next_track(self):
         print('SONG IS: ' + self.song)
 
         if self.shuffle_on:
-            if self.shuffle_pool_size == 0:
-                # Stop playing when the pool is empty, do not increment pool size to be lower than zero
-                self.stop()
-                return
-            
-            result = self.shuffle_pool[random.randint(0,self.shuffle_pool_size)]
-            # Don't play the same song twice
-            self.shuffle_pool.remove(result)
-            self.shuffle_pool_size-=1
-            self.stop()
-            self.play_track(result)
+            self.play_shuffled(self.shuffle.next())
         else:
             if self.song != 'Not playing':
                 log.debug('will not add null')
@@ -162,23 +477,55 @@ class AudioController:
             if self.playing:
                 self.stop()
 
-            try:
-                result = self.up_next.get_nowait() #.split('\n')  # song and album separated by LF
-                print('NEXT TRACK IS', result)
-                self.play_track(result)
-                
-            except queue.Empty:
-                pass
+            head = self.db.queue_pop()
+            if head:
+                print('NEXT TRACK IS', head[1])
+                self.play_track(head[1])
+
+    @synchronized
+    def previous_track(self):
+        # Go back to the song played before this one when shuffling, or to the start of this one otherwise.
+        if self.shuffle_on:
+            song_data = self.shuffle.previous()
+            if song_data:
+                self.play_shuffled(song_data)
+        elif self.playing:
+            self.go_time(0)
+
+    def play_shuffled(self, song_data):
+        # Play a song chosen by the shuffle, or stop once the shuffle has run out.
+        self.stop()
+        if not song_data:
+            return
+        self.prepared = (song_data[db.DB_SONG_ID], song_data)
+        self.play_track(song_data[db.DB_SONG_ID])
 
+    @synchronized
     def play_track(self, uid):
-        try:
-            song_data = self.db.find_song_by_id(uid)
-        except:  # stop on nonexistent song
+        song_data = self.take_prepared(uid)
+        if not song_data:  # stop on nonexistent song
             log.debug('failed to find song with id: %s' % uid)
             self.kill_proc()
             self.reset_metadata()
             return
-        
+
+        self.load_track(song_data)
+        self.play()
+        self.notify_change()
+        self.prepare_next()
+
+    def take_prepared(self, uid):
+        # The database row for uid, from prepare_next() if it has already been looked up.
+        if self.prepared and self.prepared[0] == uid:
+            song_data = self.prepared[1]
+        else:
+            song_data = self.db.find_song_by_id(uid)
+        self.prepared = None
+        return song_data
+
+    def load_track(self, song_data):
+        # Make song_data the current track, as far as everything but the engine is concerned.
+        uid = song_data[db.DB_SONG_ID]
         if len(self.up_prev) == 0 or self.up_prev[-1] != uid:  # avoid duplicate entries
             self.up_prev.append(uid)  # add to prev queue here; it is simplest this way
             
@@ -190,9 +537,57 @@ class AudioController:
         self.album = song_data[2]
         self.track = song_data[3]
         self.length = song_data[4]
-        self.start_time = int(time.time())
-        assert int(time.time()) - self.start_time == 0
-        self.play()
+        self.song_id = song_data[db.DB_SONG_ID]
+        self.album_id = song_data[db.DB_SONG_ALBUM_ID]
+
+    @synchronized
+    def track_changed(self, position):
+        # Called by the engine when playback runs on, without a gap, into the track prepare_next() queued, which is identified by its position in the queue. If the
+        # queue has changed since then, the engine is playing something that is no longer wanted; play whatever is at the head of the queue now instead.
+        head = self.db.queue_pop(position)
+        if head is None:
+            self.next_track()
+            return
+
+        song_data = self.take_prepared(head[1])
+        if not song_data:
+            self.next_track()
+            return
+        self.load_track(song_data)
+        self.notify_change()
+        self.prepare_next()
+
+    @synchronized
+    def prepare_next(self):
+        # Look up the track at the head of the queue and have its file read into the cache while this one plays, then queue it in the engine, which goes on to it
+        # without a gap when this track ends. Shuffle doesn't draw from the queue, so in shuffle mode the next track is only chosen when this one ends.
+        head = self.db.queue_head()
+        if head is None:
+            self.engine.queue_next(None)
+            return
+        position, uid = head
+        if not (self.prepared and self.prepared[0] == uid):
+            song_data = self.db.find_song_by_id(uid)
+            if not song_data:
+                return
+            self.prepared = (uid, song_data)
+            threading.Thread(target=prebuffer_file, args=(song_data[db.DB_SONG_FILE],), daemon=True).start()
+        self.engine.queue_next(None if self.shuffle_on else self.prepared[1][db.DB_SONG_FILE], position, self.gain(uid))
+
+    def gain(self, song_id):
+        # The change in volume, in dB, that brings a song to loudness-target, going by the loudness measured by loudness.py: by the song's own with
+        # normalize-loudness set to 'track', or by its album's with 'album', so that the quiet songs on an album stay quieter than the loud ones. Never so much
+        # that the loudest sample would clip; a song not yet measured itself still takes its album's. 0 with normalize-loudness 'off', and where there is no
+        # measurement to go by.
+        mode = data.configuration.get('normalize-loudness', data.CONFIGURATION_TEMPLATE['normalize-loudness'])
+        if mode not in ['track', 'album'] or song_id is None:
+            return 0
+        track, album = self.db.song_loudness(song_id)
+        measured = album if mode == 'album' else track
+        if measured is None:
+            return 0
+        loudness, peak = measured
+        return min(data.configuration.get('loudness-target', data.CONFIGURATION_TEMPLATE['loudness-target']) - loudness, -peak)
         
     def old_play_track(self, name, album):
         if name == 'Not playing':
@@ -251,41 +646,109 @@ class AudioController:
         self.start_time = int(time.time())
         self.play()
 
+    @synchronized
     def clear_queue(self):
-        tracks = list(self.up_next.queue)
-        for i in tracks:
-            self.up_next.get_nowait()
-
-    def enqueue_song(self, song_id, priority=False):
-        if not priority:
-            self.up_next.put(song_id)
+        self.db.queue_clear()
+        self.prepared = None
+        self.engine.queue_next(None)
+        self.notify_change()
+
+    def enqueue_song(self, song_id, priority=False, before=None):
+        # Add a song to the end of the queue, or just before the entry at position `before` (see queued_positions()).
+        self.enqueue_songs([song_id], before, start=not priority)
+
+    @synchronized
+    def enqueue_songs(self, song_ids, before=None, start=True):
+        # Add songs to the queue, in order, all at once: they are written in one transaction, listeners are told once, and playback (if start is set and nothing
+        # is playing) is started once, with the first of them. Returns the number of songs queued.
+        song_ids = list(song_ids)
+        if not song_ids:
+            return 0
+        self.db.queue_insert(song_ids, before)
+        self.notify_change()
+        if start:
             if not self.playing:  # Don't end current song, but start as soon as we have anything to play
                 self.next_track()
-        else:
-            self.up_next.put(song_id)
-
-    def begin_shuffle(self, playlist=None):
+            else:
+                self.prepare_next()
+        return len(song_ids)
+
+    @synchronized
+    def move_queued(self, position, before=None):
+        # Move the queue entry at `position` to just before the entry at `before`, or to the end. Returns False if there is no such entry.
+        if self.db.queue_move(position, before) is None:
+            return False
+        self.notify_change()
+        self.prepare_next()  # the head of the queue may have changed
+        return True
+
+    @synchronized
+    def remove_queued(self, position):
+        # Returns False if there is no such entry.
+        if self.db.queue_remove(position) is None:
+            return False
+        self.notify_change()
+        self.prepare_next()
+        return True
+
+    @synchronized
+    def begin_shuffle(self, playlist=None, seed=None, spread_artists=False):
+        # begin playing the specified playlist if specified, otherwise, play the entire music library. The same seed gives the same order; with spread_artists, the
+        # same artist is not played twice in a row where that can be avoided.
         log.debug("Starting shuffle IO")
-        # begin playing the specified playlist if specified, otherwise, play the entire music library
-        if playlist:
-            log.debug('playlist')
-            # we can get an error if playlist does not exist, but that should never happen in normal usage
-            self.shuffle_pool = self.db.fetch_playlist_contents(playlist)
-            self.shuffle_on = True
-            
-        else:
-            songs = self.db.fetch_songs()
-            for i in songs:
-                self.shuffle_pool.append(i[data.WebStereoDB.DB_SONG_ID])  # index 0 is file path
-
-            self.shuffle_on = True
-
-        self.shuffle_pool_size = len(self.shuffle_pool)
+        self.shuffle = shuffle.Shuffle(self.db, playlist, seed, spread_artists)
+        self.shuffle_on = True
+        log.debug('shuffling %s with seed %d' % (playlist or 'library', self.shuffle.seed))
+        self.engine.queue_next(None)
         self.next_track()
-        log.debug("{}".format(self.shuffle_pool))
 
+    @synchronized
     def end_shuffle(self):
         # Turn shuffle off and delete its data
         self.shuffle_on = False
-        self.shuffle_pool = []
-        self.shuffle_pool_size = 0
+        self.shuffle = None
+        self.notify_change()
+
+    def snapshot(self):
+        # What restore_state() needs to carry on from here: the current track and how far into it, whether it was paused, what was played before it, and the
+        # shuffle, if there is one. The queue is already in the database.
+        return {
+            'song_id': self.song_id if self.playing else None,
+            'position': round(self.position(), 3),
+            'paused': self.paused,
+            'up_prev': list(self.up_prev),
+            'shuffle': self.shuffle.state() if self.shuffle_on and self.shuffle else None,
+        }
+
+    @synchronized
+    def restore_state(self):
+        # Pick up where the last snapshot left off, then keep saving snapshots from here on. Playback carries on paused, unless resume-playback is set, so that a
+        # restart at an odd hour doesn't start the music by itself.
+        state = self.db.load_player_state()
+        if state:
+            self.up_prev = [i for i in state['up_prev'] if isinstance(i, int)]
+            if state['shuffle']:
+                self.shuffle = shuffle.Shuffle.restore(self.db, state['shuffle'])
+                self.shuffle_on = True
+            song_data = self.db.find_song_by_id(state['song_id']) if state['song_id'] is not None else None
+            if song_data:
+                log.info('resuming %s at %.1f seconds' % (song_data[db.DB_SONG_TITLE], state['position']))
+                self.load_track(song_data)
+                self.play(state['position'], state['paused'] or not data.configuration.get('resume-playback', False))
+                self.prepare_next()
+            self.notify_change()
+        threading.Thread(target=self.save_state, daemon=True).start()
+
+    def save_state(self):
+        # Runs in the background, writing a snapshot whenever something changes, and every player-state-interval seconds while a track plays, so that the
+        # position saved is never far behind.
+        interval = data.configuration.get('player-state-interval', 5)
+        version = None
+        while True:
+            new_version = self.wait_for_change(version, interval)
+            if new_version != version or (self.playing and not self.paused):
+                try:
+                    self.db.save_player_state(self.snapshot())
+                except Exception as e:  # keep trying; a write that fails now (say, the database is locked by a long sync) may well succeed next time
+                    log.error('could not save player state: %s' % e)
+            version = new_version
@@ -0,0 +1,366 @@
+import os
+import os.path
+import sys
+import json
+import time
+import wave
+import random
+import shutil
+import struct
+import sqlite3
+import platform
+import tempfile
+import statistics
+import subprocess
+import multiprocessing
+import mutagen.mp4
+import mutagen.mp3
+import mutagen.id3
+import mutagen.flac
+
+# Benchmarks for webstereo. A synthetic library of any size is generated - artist, album and song folders of tiny, tagged WAV, FLAC, MP3 and M4A files, the same
+# library every time for the same size and seed - and a database is built from it. Then the library queries and the main pages are timed, and the results are
+# written out as JSON, so that runs against different versions (or different sizes: 10k, 100k, 1M tracks) can be compared with --compare.
+# data.py and webstereo.py read config.json from the current directory, so the benchmark writes its own to a scratch folder and changes to it before loading it.
+
+USAGE = '''
+Usage: python3 benchmark.py [OPTIONS]
+
+-r, --run
+        Generate a library, build a database from it and time the scenarios below, printing the results as JSON:
+        build (data.py -b), sync (data.py -s, with nothing to do), pages of songs and albums, searches, the /songs,
+        /albums, /playlists, /nowplaying and /search pages, and starting webstereo in a new process.
+-g, --generate [PATH]
+        Only generate a library, in PATH.
+-c, --compare [OLD] [NEW]
+        Compare two results files, and exit with status 1 if any scenario has become slower than --threshold allows.
+-t, --tracks [N]
+        The number of tracks in the library (default 10000). There are 10 tracks to an album and 5 albums to an artist.
+-l, --library [PATH]
+        With --run, use a library already made with --generate, rather than generating one.
+-o, --output [FILE]
+        With --run, write the results to FILE as well.
+-w, --work-dir [PATH]
+        With --run, keep the library, config.json and database in PATH, rather than in a temporary folder that is deleted afterwards.
+-n, --repeat [N]
+        Time each scenario N times, after one run that is not timed (default 5). Building the database is timed once.
+-j, --jobs [N]
+        Processes used to generate the library and to read it (default: the number of CPUs).
+-s, --seed [N]
+        Seed for the generated library (default 0).
+--threshold [RATIO]
+        With --compare, how much slower a scenario may get before it counts as a regression (default 1.25).
+'''
+
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 5
+FORMATS = ['wav', 'flac', 'mp3', 'm4a']
+GENRES = ['Rock', 'Jazz', 'Classical', 'Electronic', 'Folk', 'Hip-Hop', 'Ambient', 'Blues']
+WORDS = ['amber', 'anchor', 'autumn', 'blue', 'bright', 'broken', 'canyon', 'cedar', 'city', 'cold', 'copper', 'crystal', 'dark', 'dawn', 'desert', 'distant',
+         'dream', 'echo', 'ember', 'empty', 'evening', 'falling', 'field', 'fire', 'forest', 'ghost', 'glass', 'golden', 'harbor', 'heart', 'hollow', 'iron',
+         'lantern', 'last', 'light', 'lonely', 'midnight', 'mirror', 'morning', 'night', 'ocean', 'paper', 'quiet', 'rain', 'red', 'river', 'salt', 'shadow',
+         'silver', 'slow', 'song', 'spring', 'star', 'stone', 'storm', 'summer', 'sweet', 'thunder', 'velvet', 'waiting', 'wild', 'winter', 'wire', 'young']
+COMMON_QUERY = 'river'  # in a few percent of titles
+
+
+def box(kind, payload):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def full_box(kind, payload, flags=0):
+    return box(kind, struct.pack('>I', flags) + payload)
+
+
+def write_wav(path, seconds, tags):
+    # WAV files have no tags that webstereo reads, and are really as long as they say, so they are kept short: a tenth of a second of 8 kHz silence.
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(1)
+        f.setframerate(8000)
+        f.writeframes(b'\x80' * 800)
+
+
+def write_flac(path, seconds, tags):
+    # Just the STREAMINFO block, which is where the length comes from; no audio frames.
+    rate = 44100
+    info = struct.pack('>HH', 4096, 4096) + bytes(6) + ((rate << 44) | (1 << 41) | (15 << 36) | int(seconds * rate)).to_bytes(8, 'big') + bytes(16)
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80]) + len(info).to_bytes(3, 'big') + info)
+    song_file = mutagen.flac.FLAC(path)
+    for key, value in tags.items():
+        song_file[key] = value
+    song_file.save(padding=lambda info: 0)
+
+
+def write_mp3(path, seconds, tags):
+    # Three silent frames of MPEG-1 layer III at 32 kbit/s, 32 kHz, mono (144 bytes each). The first carries a Xing header giving the number of frames the song
+    # would have, which is what its length is worked out from.
+    header = b'\xff\xfb\x18\xc0'
+    first = header + bytes(17) + b'Xing' + struct.pack('>II', 1, int(seconds * 32000 / 1152))
+    with open(path, 'wb') as f:
+        f.write(first.ljust(144, b'\0') + header.ljust(144, b'\0') * 2)
+    song_file = mutagen.mp3.MP3(path)
+    song_file.add_tags()
+    frames = {'title': mutagen.id3.TIT2, 'album': mutagen.id3.TALB, 'artist': mutagen.id3.TPE1, 'albumartist': mutagen.id3.TPE2, 'genre': mutagen.id3.TCON,
+              'date': mutagen.id3.TDRC, 'tracknumber': mutagen.id3.TRCK, 'discnumber': mutagen.id3.TPOS}
+    for key, value in tags.items():
+        song_file.tags.add(frames[key](encoding=3, text=value))
+    song_file.save(padding=lambda info: 0)
+
+
+def write_m4a(path, seconds, tags):
+    # A movie with one AAC track and no samples: the track's header gives its length, and its sample description the sample rate and bitrate.
+    rate = 44100
+    mdhd = full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, rate, int(seconds * rate), 0x55c4, 0))
+    hdlr = full_box(b'hdlr', struct.pack('>I4s12s', 0, b'soun', b'') + b'\0')
+    esds = full_box(b'esds', bytes([3, 25, 0, 1, 0, 4, 17, 0x40, 0x15, 0, 0, 0]) + struct.pack('>II', 128000, 128000) + bytes([6, 1, 2]))
+    mp4a = box(b'mp4a', bytes(6) + struct.pack('>H', 1) + bytes(8) + struct.pack('>HHHHI', 2, 16, 0, 0, rate << 16) + esds)
+    stbl = box(b'stbl', full_box(b'stsd', struct.pack('>I', 1) + mp4a) + full_box(b'stts', struct.pack('>I', 0)) + full_box(b'stsc', struct.pack('>I', 0))
+               + full_box(b'stsz', struct.pack('>II', 0, 0)) + full_box(b'stco', struct.pack('>I', 0)))
+    mdia = box(b'mdia', mdhd + hdlr + box(b'minf', full_box(b'smhd', struct.pack('>I', 0)) + stbl))
+    trak = box(b'trak', full_box(b'tkhd', struct.pack('>IIIII', 0, 0, 1, 0, int(seconds * 1000)) + bytes(60), flags=7) + mdia)
+    mvhd = full_box(b'mvhd', struct.pack('>IIIIIH', 0, 0, 1000, int(seconds * 1000), 0x10000, 0x100) + bytes(70) + struct.pack('>I', 2))
+    with open(path, 'wb') as f:
+        f.write(box(b'ftyp', b'M4A ' + struct.pack('>I', 0) + b'M4A mp42isom') + box(b'moov', mvhd + trak) + box(b'mdat', b''))
+
+    song_file = mutagen.mp4.MP4(path)
+    song_file.add_tags()
+    atoms = {'title': '\xa9nam', 'album': '\xa9alb', 'artist': '\xa9ART', 'albumartist': 'aART', 'genre': '\xa9gen', 'date': '\xa9day'}
+    for key, value in tags.items():
+        if key == 'tracknumber':
+            song_file.tags['trkn'] = [(int(value), TRACKS_PER_ALBUM)]
+        elif key == 'discnumber':
+            song_file.tags['disk'] = [(int(value), 2)]
+        else:
+            song_file.tags[atoms[key]] = [value]
+    song_file.save(padding=lambda info: 0)
+
+
+WRITERS = {'wav': write_wav, 'flac': write_flac, 'mp3': write_mp3, 'm4a': write_m4a}
+
+
+def words(rng, count):
+    return ' '.join(rng.choice(WORDS) for i in range(count)).title()
+
+
+def write_album(spec):
+    # spec is (location, seed, artist index, album index, number of tracks). Everything about an album comes from a generator seeded with those, so albums can be
+    # written in any order, by any number of processes, and still come out the same.
+    location, seed, artist_index, album_index, tracks = spec
+    artist = '%s %d' % (words(random.Random('%d:artist:%d' % (seed, artist_index)), 2), artist_index)
+    rng = random.Random('%d:album:%d:%d' % (seed, artist_index, album_index))
+    album = '%s %d' % (words(rng, rng.randint(1, 3)), artist_index * ALBUMS_PER_ARTIST + album_index)
+    audio_format = rng.choice(FORMATS)
+    genre = rng.choice(GENRES)
+    year = str(rng.randint(1960, 2024))
+    discs = 2 if rng.random() < 0.1 else 1
+
+    folder = os.path.join(location, artist, album)
+    os.makedirs(folder, exist_ok=True)
+    for number in range(1, tracks + 1):
+        title = words(rng, rng.randint(1, 4))
+        seconds = rng.uniform(90, 420)
+        disc = 1 if number <= (tracks + 1) // 2 or discs == 1 else 2
+        path = os.path.join(folder, '%02d %s.%s' % (number, title, audio_format))
+        tags = {'title': title, 'album': album, 'artist': artist, 'albumartist': artist, 'genre': genre, 'date': year, 'tracknumber': str(number),
+                'discnumber': str(disc)}
+        WRITERS[audio_format](path, seconds, tags)
+    return tracks
+
+
+def generate_library(location, tracks, seed=0, jobs=1):
+    # Write a library of `tracks` songs to location, in the artist/album/song layout data.py expects.
+    specs = []
+    for i in range(0, tracks, TRACKS_PER_ALBUM):
+        album_number = i // TRACKS_PER_ALBUM
+        specs.append((location, seed, album_number // ALBUMS_PER_ARTIST, album_number % ALBUMS_PER_ARTIST, min(TRACKS_PER_ALBUM, tracks - i)))
+
+    os.makedirs(location, exist_ok=True)
+    if jobs <= 1:
+        return sum(map(write_album, specs))
+    with multiprocessing.Pool(jobs) as pool:
+        return sum(pool.imap_unordered(write_album, specs, chunksize=16))
+
+
+def measure(function, repeat):
+    # Run function once untimed (to warm the page cache and SQLite's), then `repeat` times; timings in milliseconds.
+    function()
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'runs': repeat, 'min_ms': round(min(timings), 3), 'median_ms': round(statistics.median(timings), 3), 'mean_ms': round(statistics.mean(timings), 3)}
+
+
+# Start webstereo as a WSGI server's worker would, and answer one request; run in a new process in the benchmark's folder.
+COLD_START = '''
+import sys
+sys.path.insert(0, %r)
+import webstereo
+webstereo.create_app().test_client().get('/nowplaying')
+'''
+
+
+def time_once(function):
+    start = time.perf_counter()
+    function()
+    elapsed = (time.perf_counter() - start) * 1000
+    return {'runs': 1, 'min_ms': round(elapsed, 3), 'median_ms': round(elapsed, 3), 'mean_ms': round(elapsed, 3)}
+
+
+def source_version():
+    # The commit the benchmarked code comes from, if it is in a git repository.
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(work_dir, tracks, seed=0, repeat=5, jobs=1, library=None):
+    # Everything happens in work_dir, which becomes the current directory. Returns the results, ready to be written out as JSON.
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    setup = {}
+    if library is None:
+        library = os.path.join(work_dir, 'library')
+        start = time.perf_counter()
+        generate_library(library, tracks, seed, jobs)
+        setup['generate_s'] = round(time.perf_counter() - start, 3)
+    library = os.path.abspath(library) + '/'
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(work_dir)
+    with open('config.json', 'w') as f:
+        json.dump({'authenticate': False, 'library-path': library, 'db-path': 'media.db', 'password-hash': ''}, f, indent=2)
+    import data
+    data.log.setLevel('WARNING')
+    data.load_configuration()
+
+    db = data.WebStereoDB(data.DB_PATH)
+    results = {}
+    results['build_from'] = time_once(lambda: db.build_from(library, jobs))
+    results['sync_from_unchanged'] = time_once(lambda: db.sync_from(library, jobs))
+    song_count = db.query('SELECT COUNT(*) FROM SONGS')[0][0]
+
+    # A page from the middle of the library, as the songs page asks for after scrolling half way down.
+    page = 100
+    middle = db.query('SELECT SORTING, UNIQUE_ID FROM SONGS ORDER BY SORTING COLLATE NOCASE, UNIQUE_ID LIMIT 1 OFFSET ?', [song_count // 2])[0]
+    rare_query = db.query('SELECT ARTIST FROM ALBUMS ORDER BY UNIQUE_ID LIMIT 1')[0][0]
+    scenarios = {
+        'fetch_songs_first_page': lambda: db.fetch_songs(limit=page),
+        'fetch_songs_middle_page': lambda: db.fetch_songs(limit=page, after=list(middle)),
+        'fetch_songs_by_album': lambda: db.fetch_songs('ALBUM', limit=page),
+        'fetch_albums_first_page': lambda: db.fetch_albums(silence=True, limit=page),
+        'fetch_albums_by_year': lambda: db.fetch_albums('YEAR', silence=True, limit=page),
+        'search_in_songs_common': lambda: db.search_in_songs(COMMON_QUERY, limit=page),
+        'search_in_songs_rare': lambda: db.search_in_songs(rare_query, limit=page),
+    }
+    for name, function in scenarios.items():
+        results[name] = measure(function, repeat)
+
+    # Ten playlists of a hundred songs each, for the playlists page.
+    rng = random.Random(seed)
+    max_id = db.max_song_id()
+    with db.transaction():
+        for i in range(10):
+            db.create_playlist('Playlist %d' % i)
+            for j in range(100):
+                db.append_to_playlist('Playlist %d' % i, rng.randint(0, max_id))
+
+    import webstereo
+    webstereo.log.setLevel('WARNING')
+    client = webstereo.create_app().test_client()
+    for route in ['/songs', '/albums', '/playlists', '/nowplaying', '/search?q=' + COMMON_QUERY]:
+        def get(route=route):
+            response = client.get(route)
+            if response.status_code != 200:
+                raise RuntimeError('%s returned %d' % (route, response.status_code))
+        results['GET ' + route] = measure(get, repeat)
+
+    cold_start = COLD_START % os.path.dirname(os.path.abspath(__file__))
+    results['cold_start'] = measure(lambda: subprocess.run([sys.executable, '-c', cold_start], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True),
+                                    repeat)
+
+    return {
+        'webstereo': source_version(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'tracks': song_count,
+        'seed': seed,
+        'jobs': jobs,
+        'setup': setup,
+        'results': results,
+    }
+
+
+def compare(old, new, threshold=1.25):
+    # Print the median time of every scenario in both results, and return the names of those that got slower by more than threshold.
+    regressions = []
+    print('%-36s %12s %12s %8s' % ('scenario', 'old ms', 'new ms', 'ratio'))
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before = old['results'][name]['median_ms']
+        after = new['results'][name]['median_ms']
+        ratio = after / before if before else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        print('%-36s %12.3f %12.3f %8.2f%s' % (name, before, after, ratio, flag))
+    if old.get('tracks') != new.get('tracks'):
+        print('note: the results are for libraries of different sizes (%s and %s tracks)' % (old.get('tracks'), new.get('tracks')))
+    return regressions
+
+
+def option(names, default=None, convert=str):
+    for i in names:
+        if i in sys.argv:
+            return convert(sys.argv[sys.argv.index(i) + 1])
+    return default
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] in ['--usage', '--help', '-h']:
+        print(USAGE)
+        raise SystemExit
+
+    tracks = option(['--tracks', '-t'], 10000, int)
+    seed = option(['--seed', '-s'], 0, int)
+    jobs = option(['--jobs', '-j'], os.cpu_count() or 1, int)
+
+    if sys.argv[1] in ['--generate', '-g']:
+        start = time.time()
+        count = generate_library(sys.argv[2], tracks, seed, jobs)
+        print('%d tracks in %d seconds' % (count, time.time() - start))
+
+    elif sys.argv[1] in ['--compare', '-c']:
+        with open(sys.argv[2]) as f:
+            old = json.load(f)
+        with open(sys.argv[3]) as f:
+            new = json.load(f)
+        if compare(old, new, option(['--threshold'], 1.25, float)):
+            raise SystemExit(1)
+
+    elif sys.argv[1] in ['--run', '-r']:
+        output = option(['--output', '-o'])
+        output = output and os.path.abspath(output)  # relative to where the benchmark was started, not to the work directory
+        library = option(['--library', '-l'])
+        library = library and os.path.abspath(library)
+        work_dir = option(['--work-dir', '-w'])
+        scratch = work_dir is None
+        if scratch:
+            work_dir = tempfile.mkdtemp(prefix='webstereo-benchmark-')
+        try:
+            results = run(work_dir, tracks, seed, option(['--repeat', '-n'], 5, int), jobs, library)
+        finally:
+            if scratch:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        print(json.dumps(results, indent=2))
+        if output:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    else:
+        print('Unsupported usage. Use with --usage or --help to view usage.')
@@ -6,22 +6,22 @@ import sys
 import re
 import threading
 import subprocess
-import mutagen.mp4
-import mutagen.aiff
-import mutagen.wave
-import mutagen.flac
-import mutagen.mp3
-import mutagen.ogg
+import multiprocessing
 import contextlib
+import itertools
 import io
 import json
 import time
+import math
 import warnings
 #import urllib.parse
 #import urllib.request
 import logging
 
 from itunes_artwork import AppleDownloader, MetadataContainer
+from thumbnails import ArtworkCache
+from transcoding import TranscodeCache
+import metrics
 
 PRODUCTION = True  # Determines whether the application uses a development-grade or production-grade server
 configuration = {}
@@ -34,11 +34,19 @@ log.setLevel(logging.DEBUG)
 
 
 pbkdf2.salt = os.urandom(32)
-lock = threading.Lock()  # This is a multithreaded application, use a lock to prevent the entire program from doing segfault.
-# I was previously unaware it was even possible to cause Python to segfault. Isn't this something that should only exist in the depths
-# of C somewhere, a holdover from the 1980s?
+lock = threading.Lock()  # This is a multithreaded application. Every thread has its own connection to the database, so reads run concurrently, but writes are
+# serialized through this lock so that they queue up here, where the wait can be measured, rather than inside SQLite.
+# (Once upon a time, every query went through one shared cursor behind this lock, to prevent the entire program from doing segfault. I was previously unaware
+# it was even possible to cause Python to segfault.)
 
-# Define structure of database.
+# Where database time goes, for /metrics. Statements are labelled select or write by their first word; executemany() batches from a library scan are batch.
+QUERY_SECONDS = metrics.Histogram('webstereo_sql_query_duration_seconds', 'Time spent executing SQL statements and fetching their results.', ['statement'])
+ROWS_RETURNED = metrics.Counter('webstereo_sql_rows_returned_total', 'Rows returned by SQL statements.')
+LOCK_WAIT_SECONDS = metrics.Histogram('webstereo_sql_write_lock_wait_seconds', 'Time spent waiting for the write lock, per write or transaction.')
+LOCK_HELD_SECONDS = metrics.Histogram('webstereo_sql_write_lock_held_seconds', 'Time the write lock was held, per write or transaction.')
+
+# Define structure of database. These always describe the current version of the schema, which is what a new database is created with; existing databases are
+# brought up to date by the migrations at the end of this file.
 
 STRUCTURE_ALBUMS = '''
 CREATE TABLE ALBUMS(
@@ -47,7 +55,7 @@ ARTIST TEXT NOT NULL,
 GENRE TEXT NOT NULL,
 ARTWORK TEXT NOT NULL,
 YEAR TEXT NOT NULL,
-UNIQUE_ID INTEGER NOT NULL,
+UNIQUE_ID INTEGER PRIMARY KEY,
 ARTIST_SORTED TEXT NOT NULL)
 '''
 
@@ -55,41 +63,177 @@ STRUCTURE_SONGS = '''
 CREATE TABLE SONGS(
 FILE TEXT NOT NULL,
 TITLE TEXT NOT NULL,
-ALBUM TEXT NOT NULL,
-NUMBER TEXT NOT NULL,
+ALBUM_ID INTEGER NOT NULL REFERENCES ALBUMS(UNIQUE_ID),
+NUMBER INTEGER NOT NULL DEFAULT 0,
 LENGTH TEXT NOT NULL,
 ENCTYPE TEXT NOT NULL,
-UNIQUE_ID INTEGER NOT NULL,
-SORTING TEXT NOT NULL)
+UNIQUE_ID INTEGER PRIMARY KEY,
+SORTING TEXT NOT NULL,
+SIZE INTEGER NOT NULL DEFAULT 0,
+MTIME INTEGER NOT NULL DEFAULT 0,
+DURATION INTEGER NOT NULL DEFAULT 0,
+DISC INTEGER NOT NULL DEFAULT 1,
+SAMPLE_RATE INTEGER NOT NULL DEFAULT 0,
+BITRATE INTEGER NOT NULL DEFAULT 0,
+LOUDNESS REAL,
+PEAK REAL,
+LOUDNESS_MTIME INTEGER)
 '''
 
+# Songs refer to their album by ID. Every query for songs goes through this join, so the rows handed to the rest of the application carry the album's title, ID and
+# artist without a further query per song; see the DB_SONG_ constants for the layout. SIZE and MTIME record the state of each file when it was last read, so that
+# sync_from() can tell which files have changed, and are deliberately left out. DURATION is LENGTH in milliseconds, for arithmetic; LENGTH is what is displayed.
+# SAMPLE_RATE is in Hz and BITRATE in bits per second, or 0 where the file doesn't say. LOUDNESS (LUFS) and PEAK (dBFS) are measured by loudness.py, from the file
+# as it was when its MTIME was LOUDNESS_MTIME, which is NULL until then; LOUDNESS is NULL for files that are silent. See song_loudness().
+SONG_COLUMNS = 'SONGS.FILE, SONGS.TITLE, ALBUMS.TITLE, SONGS.NUMBER, SONGS.LENGTH, SONGS.ENCTYPE, SONGS.UNIQUE_ID, SONGS.SORTING, SONGS.ALBUM_ID, ALBUMS.ARTIST'
+SONG_SELECT = '''SELECT %s
+FROM SONGS JOIN ALBUMS ON ALBUMS.UNIQUE_ID = SONGS.ALBUM_ID''' % SONG_COLUMNS
+
 STRUCTURE_PLAYLISTS = '''
 CREATE TABLE PLAYLISTS(
-NAME TEXT NOT NULL,
-CONTENTS TEXT NOT NULL,
+NAME TEXT NOT NULL UNIQUE,
+UNIQUE_ID INTEGER PRIMARY KEY,
 MODIFIED_TIME INTEGER NOT NULL)
 '''
 
+# One row per entry in a playlist, in order of POSITION. Positions are spaced PLAYLIST_POSITION_STEP apart, so that an entry can be moved by giving it a position
+# between those of its new neighbours without touching any other row; only when there is no room left between them is the playlist renumbered.
+# Keyed by (PLAYLIST_ID, POSITION), so that reading a playlist in order, appending to it and moving an entry are each a single walk down the key.
+STRUCTURE_PLAYLIST_ITEMS = '''
+CREATE TABLE PLAYLIST_ITEMS(
+PLAYLIST_ID INTEGER NOT NULL REFERENCES PLAYLISTS(UNIQUE_ID),
+POSITION INTEGER NOT NULL,
+SONG_ID INTEGER NOT NULL REFERENCES SONGS(UNIQUE_ID),
+PRIMARY KEY (PLAYLIST_ID, POSITION)) WITHOUT ROWID
+'''
+
+PLAYLIST_POSITION_STEP = 1024
 
-# Set these to -1 so that the first id is 0; they are incremented before the value is returned because `return` causes the function to exit
-#SQLite may have a way to do this automatically, but to keep things isolated, I do it this way. If I used SQL IDs, I don't think I would get separate
-# namespaces for songs and albums.
+# The songs waiting to be played, in order of POSITION. Like playlist entries, positions are spaced apart (by PLAYLIST_POSITION_STEP) so that songs can be
+# inserted and moved without renumbering the rest; see queue_insert().
+STRUCTURE_PLAY_QUEUE = '''
+CREATE TABLE PLAY_QUEUE(
+POSITION INTEGER PRIMARY KEY,
+SONG_ID INTEGER NOT NULL REFERENCES SONGS(UNIQUE_ID))
+'''
 
-ID_COUNTER_SONGS = -1
-ID_COUNTER_ALBUMS = -1
+# What the player was doing, as JSON (see AudioController.snapshot()), so that it can carry on after a restart. NAME is 'player'.
+STRUCTURE_PLAYER_STATE = '''
+CREATE TABLE PLAYER_STATE(
+NAME TEXT PRIMARY KEY,
+VALUE TEXT NOT NULL)
+'''
 
+# Songs as they appear in playlists: the usual columns, followed by the entry's position and playlist (see DB_PLAYLIST_ITEM_ constants).
+PLAYLIST_SONG_SELECT = '''SELECT %s, PLAYLIST_ITEMS.POSITION, PLAYLIST_ITEMS.PLAYLIST_ID
+FROM PLAYLIST_ITEMS JOIN SONGS ON SONGS.UNIQUE_ID = PLAYLIST_ITEMS.SONG_ID JOIN ALBUMS ON ALBUMS.UNIQUE_ID = SONGS.ALBUM_ID''' % SONG_COLUMNS
+
+# Playlists without their contents: the PLAYLISTS columns, followed by the number of songs and their total length in milliseconds (see DB_PLAYLIST_ constants).
+PLAYLIST_SUMMARY_SELECT = '''SELECT PLAYLISTS.NAME, PLAYLISTS.UNIQUE_ID, PLAYLISTS.MODIFIED_TIME, COUNT(SONGS.UNIQUE_ID), COALESCE(SUM(SONGS.DURATION), 0)
+FROM PLAYLISTS LEFT JOIN PLAYLIST_ITEMS ON PLAYLIST_ITEMS.PLAYLIST_ID = PLAYLISTS.UNIQUE_ID LEFT JOIN SONGS ON SONGS.UNIQUE_ID = PLAYLIST_ITEMS.SONG_ID
+GROUP BY PLAYLISTS.UNIQUE_ID ORDER BY PLAYLISTS.MODIFIED_TIME'''
+
+# Songs are sorted by SORTING, which is already lowercase; it is indexed COLLATE NOCASE so that the index matches the ORDER BY clauses in fetch_songs() and fetch_albums().
+STRUCTURE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS SONGS_ALBUM_ID_DISC_NUMBER ON SONGS(ALBUM_ID, DISC, NUMBER)',
+    'CREATE INDEX IF NOT EXISTS SONGS_FILE ON SONGS(FILE)',
+    'CREATE INDEX IF NOT EXISTS SONGS_SORTING ON SONGS(SORTING COLLATE NOCASE)',
+    # An album is known by its title and artist together, so that two albums of the same name ("Greatest Hits", say) by different artists are kept apart.
+    'CREATE UNIQUE INDEX IF NOT EXISTS ALBUMS_TITLE_ARTIST ON ALBUMS(TITLE, ARTIST)',
+    'CREATE INDEX IF NOT EXISTS ALBUMS_ARTIST_SORTED_YEAR ON ALBUMS(ARTIST_SORTED COLLATE NOCASE, YEAR)',
+    'CREATE INDEX IF NOT EXISTS PLAYLIST_ITEMS_SONG_ID ON PLAYLIST_ITEMS(SONG_ID, PLAYLIST_ID)',
+    # A song that is deleted disappears from every playlist it was in. (Dropping SONGS, as build_from() does, doesn't fire this; a rebuild renumbers every song anyway.)
+    '''CREATE TRIGGER IF NOT EXISTS PLAYLIST_ITEMS_SONG_DELETE AFTER DELETE ON SONGS BEGIN
+DELETE FROM PLAYLIST_ITEMS WHERE SONG_ID = OLD.UNIQUE_ID;
+END''',
+    'CREATE INDEX IF NOT EXISTS PLAY_QUEUE_SONG_ID ON PLAY_QUEUE(SONG_ID)',
+    # and from the play queue
+    '''CREATE TRIGGER IF NOT EXISTS PLAY_QUEUE_SONG_DELETE AFTER DELETE ON SONGS BEGIN
+DELETE FROM PLAY_QUEUE WHERE SONG_ID = OLD.UNIQUE_ID;
+END''',
+]
+
+# Counts and total durations for the whole library (KIND 'library', NAME ''), and for each genre, artist and format (KIND 'genre', 'artist' or 'format', NAME the
+# genre and so on), so that none of them needs a scan of SONGS. The triggers below keep them up to date as songs and albums are added, edited and removed; rows
+# that drop to zero are left in place, and ignored. Formats have no albums. DURATION is in milliseconds.
+STRUCTURE_LIBRARY_STATISTICS = '''
+CREATE TABLE LIBRARY_STATISTICS(
+KIND TEXT NOT NULL,
+NAME TEXT NOT NULL,
+SONGS INTEGER NOT NULL DEFAULT 0,
+ALBUMS INTEGER NOT NULL DEFAULT 0,
+DURATION INTEGER NOT NULL DEFAULT 0,
+PRIMARY KEY (KIND, NAME)) WITHOUT ROWID
+'''
 
-def generate_song_id():
-    global ID_COUNTER_SONGS
-    ID_COUNTER_SONGS += 1
-    assert not ID_COUNTER_SONGS < 0  # sanity check
-    return ID_COUNTER_SONGS
 
-def generate_album_id():
-    global ID_COUNTER_ALBUMS
-    ID_COUNTER_ALBUMS += 1
-    assert not ID_COUNTER_ALBUMS < 0
-    return ID_COUNTER_ALBUMS
+def statistics_change(keys, songs, albums, duration):
+    # Trigger statements adding songs, albums and duration (SQL expressions, negative to subtract) to the LIBRARY_STATISTICS rows for keys, a list of (KIND, NAME)
+    # SQL expressions, creating the rows first as needed. A NAME that is NULL (an album that doesn't exist) matches nothing.
+    values = ', '.join(['(%s, %s)' % i for i in keys])
+    return '''INSERT OR IGNORE INTO LIBRARY_STATISTICS (KIND, NAME) VALUES %s;
+UPDATE LIBRARY_STATISTICS SET SONGS = SONGS + %s, ALBUMS = ALBUMS + %s, DURATION = DURATION + %s WHERE (KIND, NAME) IN (VALUES %s);''' % (values, songs, albums, duration, values)
+
+
+def song_statistics_keys(row):
+    # The LIBRARY_STATISTICS rows a song (NEW or OLD, in a trigger on SONGS) counts towards.
+    album = '(SELECT %%s FROM ALBUMS WHERE UNIQUE_ID = %s.ALBUM_ID)' % row
+    return [("'library'", "''"), ("'genre'", album % 'GENRE'), ("'artist'", album % 'ARTIST'), ("'format'", row + '.ENCTYPE')]
+
+
+def album_statistics_keys(row):
+    return [("'library'", "''"), ("'genre'", row + '.GENRE'), ("'artist'", row + '.ARTIST')]
+
+
+# Changing an album's genre or artist moves it, with all of its songs, from one row to another.
+ALBUM_SONGS = '(SELECT COUNT(*) FROM SONGS WHERE ALBUM_ID = OLD.UNIQUE_ID)'
+ALBUM_DURATION = '(SELECT COALESCE(SUM(DURATION), 0) FROM SONGS WHERE ALBUM_ID = OLD.UNIQUE_ID)'
+
+STRUCTURE_STATISTICS_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS SONGS_STATISTICS_INSERT AFTER INSERT ON SONGS BEGIN\n%s\nEND' % statistics_change(song_statistics_keys('NEW'), '1', '0', 'NEW.DURATION'),
+    'CREATE TRIGGER IF NOT EXISTS SONGS_STATISTICS_UPDATE AFTER UPDATE OF ALBUM_ID, ENCTYPE, DURATION ON SONGS BEGIN\n%s\n%s\nEND'
+    % (statistics_change(song_statistics_keys('OLD'), '-1', '0', '-OLD.DURATION'), statistics_change(song_statistics_keys('NEW'), '1', '0', 'NEW.DURATION')),
+    'CREATE TRIGGER IF NOT EXISTS SONGS_STATISTICS_DELETE AFTER DELETE ON SONGS BEGIN\n%s\nEND' % statistics_change(song_statistics_keys('OLD'), '-1', '0', '-OLD.DURATION'),
+    'CREATE TRIGGER IF NOT EXISTS ALBUMS_STATISTICS_INSERT AFTER INSERT ON ALBUMS BEGIN\n%s\nEND' % statistics_change(album_statistics_keys('NEW'), '0', '1', '0'),
+    'CREATE TRIGGER IF NOT EXISTS ALBUMS_STATISTICS_UPDATE AFTER UPDATE OF ARTIST, GENRE ON ALBUMS BEGIN\n%s\n%s\nEND'
+    % (statistics_change(album_statistics_keys('OLD')[1:], '-' + ALBUM_SONGS, '-1', '-' + ALBUM_DURATION),
+       statistics_change(album_statistics_keys('NEW')[1:], ALBUM_SONGS, '1', ALBUM_DURATION)),
+    'CREATE TRIGGER IF NOT EXISTS ALBUMS_STATISTICS_DELETE AFTER DELETE ON ALBUMS BEGIN\n%s\nEND' % statistics_change(album_statistics_keys('OLD'), '0', '-1', '0'),
+]
+
+# Full-text search. The rowid of each entry is the UNIQUE_ID of its song or album; the triggers keep both indexes in step with every insert, edit and deletion.
+# Prefix indexes on the first two and three characters make type-ahead (prefix) queries cheap.
+STRUCTURE_SEARCH = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS SONGS_FTS USING fts5(TITLE, ALBUM, ARTIST, GENRE, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS ALBUMS_FTS USING fts5(TITLE, ARTIST, GENRE, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+]
+
+STRUCTURE_SEARCH_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS SONGS_FTS_INSERT AFTER INSERT ON SONGS BEGIN
+INSERT INTO SONGS_FTS (rowid, TITLE, ALBUM, ARTIST, GENRE) SELECT NEW.UNIQUE_ID, NEW.TITLE, TITLE, ARTIST, GENRE FROM ALBUMS WHERE UNIQUE_ID = NEW.ALBUM_ID;
+END''',
+    '''CREATE TRIGGER IF NOT EXISTS SONGS_FTS_UPDATE AFTER UPDATE OF TITLE, ALBUM_ID ON SONGS BEGIN
+DELETE FROM SONGS_FTS WHERE rowid = OLD.UNIQUE_ID;
+INSERT INTO SONGS_FTS (rowid, TITLE, ALBUM, ARTIST, GENRE) SELECT NEW.UNIQUE_ID, NEW.TITLE, TITLE, ARTIST, GENRE FROM ALBUMS WHERE UNIQUE_ID = NEW.ALBUM_ID;
+END''',
+    '''CREATE TRIGGER IF NOT EXISTS SONGS_FTS_DELETE AFTER DELETE ON SONGS BEGIN
+DELETE FROM SONGS_FTS WHERE rowid = OLD.UNIQUE_ID;
+END''',
+    '''CREATE TRIGGER IF NOT EXISTS ALBUMS_FTS_INSERT AFTER INSERT ON ALBUMS BEGIN
+INSERT INTO ALBUMS_FTS (rowid, TITLE, ARTIST, GENRE) VALUES (NEW.UNIQUE_ID, NEW.TITLE, NEW.ARTIST, NEW.GENRE);
+END''',
+    '''CREATE TRIGGER IF NOT EXISTS ALBUMS_FTS_UPDATE AFTER UPDATE OF TITLE, ARTIST, GENRE ON ALBUMS BEGIN
+UPDATE ALBUMS_FTS SET TITLE = NEW.TITLE, ARTIST = NEW.ARTIST, GENRE = NEW.GENRE WHERE rowid = NEW.UNIQUE_ID;
+UPDATE SONGS_FTS SET ALBUM = NEW.TITLE, ARTIST = NEW.ARTIST, GENRE = NEW.GENRE WHERE rowid IN (SELECT UNIQUE_ID FROM SONGS WHERE ALBUM_ID = NEW.UNIQUE_ID);
+END''',
+    '''CREATE TRIGGER IF NOT EXISTS ALBUMS_FTS_DELETE AFTER DELETE ON ALBUMS BEGIN
+DELETE FROM ALBUMS_FTS WHERE rowid = OLD.UNIQUE_ID;
+END''',
+]
+
+# bm25() weights for the columns of each index, in order: a match in the title counts for more than one in the genre.
+SONGS_FTS_WEIGHTS = '10.0, 4.0, 4.0, 1.0'
+ALBUMS_FTS_WEIGHTS = '10.0, 5.0, 1.0'
 
 
 class DuplicateCreationError(Exception):
@@ -104,21 +248,279 @@ class DuplicateAdditionError(Exception):
 
 class PlaylistContainer:
     # contains playlist information in named quantites, used to work around a problem with Jinja templates caused by esoteric three- and four-dimensional arrays
-    def __init__(self, array, db):
-        # array is presumed to be the result of webstereoDB.fetch_all_playlists()[0]
-        self.title = array[0]
-        self.contents = []
-        self.modified_time = time.ctime(int(array[2]))
-        pl_songs = array[1].split('\t')
-        if len(pl_songs) > 1:
-            for i in pl_songs:
-                try:
-                    self.contents.append(db.find_song_by_id(i))
-                except IndexError:
-                    pass
+    def __init__(self, array, contents=None):
+        # array is a row from WebStereoDB.fetch_playlist_summaries(), and contents the rows for its songs, as returned by WebStereoDB.fetch_playlist_songs(), if
+        # they have been fetched at all.
+        self.title = array[WebStereoDB.DB_PLAYLIST_NAME]
+        self.id = array[WebStereoDB.DB_PLAYLIST_ID]
+        self.modified_time = time.ctime(int(array[WebStereoDB.DB_PLAYLIST_MODIFIED_TIME]))
+        self.song_count = array[WebStereoDB.DB_PLAYLIST_SONG_COUNT]
+        self.length = format_length(array[WebStereoDB.DB_PLAYLIST_DURATION] / 1000)
+        self.contents = contents
+
+
+# Reading metadata from audio files. Each supported format has its own reader, which returns a SongMetadata object (or None if the file should be skipped);
+# the database code never needs to know which tagging scheme a particular file uses.
+
+SUPPORTED_EXTENSIONS = {'.m4a': 'MP4', '.aif': 'AIFF', '.aiff': 'AIFF', '.aifc': 'AIFF', '.flac': 'FLAC', '.mp3': 'MP3', '.wav': 'WAVE', '.ogg': 'OGG'}
+DEFAULT_YEAR = '2021'  # This tag in particular has given me problems with KeyError
+DEFAULT_GENRE = 'Unknown Genre'
+
+
+class SongMetadata:
+    # contains the information read from a single audio file, along with what is needed to create its album should it not exist yet.
+    def __init__(self, file, title, album, number, info, enctype, artist, genre, year, artwork, size=0, mtime=0, disc=1):
+        # info is mutagen's stream information for the file; only the numbers are kept, as this is passed between processes.
+        self.file = file
+        self.title = title
+        self.album = album
+        self.number = number
+        self.disc = disc
+        self.length = format_length(info.length)
+        self.duration = int(round(info.length * 1000))
+        self.sample_rate = int(getattr(info, 'sample_rate', 0) or 0)
+        self.bitrate = int(getattr(info, 'bitrate', 0) or 0)
+        self.enctype = enctype
+        self.artist = artist
+        self.genre = genre
+        self.year = year
+        self.artwork = artwork  # path to artwork.jpg in the album directory, whether or not it exists
+        self.size = size
+        self.mtime = mtime
+
+
+def walk_library(location, artists=None):
+    # Yield (artist, album, song, song_index) for every audio file in the library, or in the folders of the given artists. webstereo expects a folder for each artist,
+    # inside of which there is a folder for each album; files outside of that structure are ignored.
+    for artist in os.listdir(location) if artists is None else artists:
+        if not os.path.isdir(location + artist):
+            continue
+        for album in os.listdir(location + artist):
+            yield from walk_album(location, artist, album)
+
+
+def walk_album(location, artist, album):
+    # walk_library() for a single album folder; nothing, if it doesn't exist. The songs are numbered in order of name, so the same folder is always numbered the same way.
+    album_path = location + artist + '/' + album
+    if not os.path.isdir(album_path):
+        return
+    song_index = 1  # used to assign track numbers if all else fails.
+    for song in sorted(os.listdir(album_path)):
+        # MacOS X (presumably for Spotlight search indexing) creates files that have the exact same name- and thus, crucially, the same extension
+        # that are prepended with ._. Should mutagen try to read these, it dies. Do this to prevent that unpleasant outcome.
+        if song.startswith('._'):
+            os.remove(album_path + '/' + song)
+            continue
+        if os.path.splitext(song)[1].lower() not in SUPPORTED_EXTENSIONS:
+            continue
+        yield artist, album, song, song_index
+        song_index += 1
+
+
+def format_length(seconds):
+    # Convert a duration in seconds to m:ss, adding a leading zero to the seconds as needed.
+    return '%d:%02d' % (int(seconds / 60), int(seconds % 60))
+
+
+def tag_number(value, default=None):
+    # The number in a track or disc number tag, which may be a number, text such as '3/12', or (in MP4 files) a (number, total) tuple. Only the first part counts.
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    if value is None:
+        return default
+    value = str(value).split('/')[0].strip()
+    return int(value) if value.isdigit() else default
+
+
+def guess_track_number(song, song_index, tag_value=None):
+    # Tags are preferred; failing that, iTunes libraries will often put the number before the song name, and if that isn't there either, the position of the file in
+    # its directory is used.
+    for candidate in [tag_value, song.split(' ')[0]]:
+        number = tag_number(candidate)
+        if number is not None:
+            return number
+
+    return song_index
+
+
+def first_tag(tags, keys, default=None):
+    # Return the first value present under any of keys. Some formats return None for tags, some raise KeyError, and some return empty lists; all of those fall through to default.
+    if tags is None:
+        return default
+    for key in keys:
+        try:
+            value = tags[key]
+        except (KeyError, TypeError, ValueError):
+            continue
+        if isinstance(value, (list, tuple)) or hasattr(value, 'text'):
+            value = list(getattr(value, 'text', value))
+            if not value:
+                continue
+            value = value[0]
+        if str(value).strip():
+            return value
+    return default
+
+
+def directory_artist(artist):
+    # This is in the 'compilations' directory from iTunes. Make artist name 'Various Artists'
+    if artist.lower() == 'compilations':
+        return 'Various Artists'
+    return artist
+
+
+def save_embedded_artwork(image_data, artwork_path, song_path):
+    # Write cover art extracted from a file's metadata to artwork.jpg in its album directory. Every song on an album usually carries the same image, so only
+    # rewrite it when the audio file is newer than the artwork already on disk; this keeps artwork up-to-date without writing the same file a dozen times per album.
+    if not image_data:
+        return
+    try:
+        if os.path.getmtime(artwork_path) >= os.path.getmtime(song_path):
+            return
+    except OSError:
+        pass  # no artwork yet
+
+    tmp_path = '%s.%d.tmp' % (artwork_path, os.getpid())
+    with open(tmp_path, 'wb') as fbuf:
+        fbuf.write(bytes(image_data))
+    os.replace(tmp_path, artwork_path)
+
+
+# The mutagen module for each format is only imported once a file of that format is read: a library scan needs them, but starting the web interface doesn't.
+
+def read_mp4(path, artist, album, song, song_index):
+    import mutagen.mp4
+    song_file = mutagen.mp4.MP4(path)  # mutagen.M4A is depreciated, use this as a replacement
+    tags = song_file.tags
+    track = first_tag(tags, ['trkn'])
+    if tags is not None and tags.get('covr'):
+        save_embedded_artwork(tags['covr'][0], os.path.dirname(path) + '/artwork.jpg', path)
+    return SongMetadata(path,
+                        str(first_tag(tags, ['\xa9nam'], os.path.splitext(song)[0])),
+                        str(first_tag(tags, ['\xa9alb'], album)),
+                        guess_track_number(song, song_index, track),
+                        song_file.info,
+                        'MP4',
+                        str(first_tag(tags, ['aART', '\xa9ART'], directory_artist(artist))),
+                        str(first_tag(tags, ['\xa9gen'], DEFAULT_GENRE)),
+                        str(first_tag(tags, ['\xa9day'], DEFAULT_YEAR))[0:4],  # Only use the year, omit the rest of this timestamp.
+                        os.path.dirname(path) + '/artwork.jpg',
+                        disc=tag_number(first_tag(tags, ['disk']), 1))
+
+
+def read_id3(path, artist, album, song, song_index, enctype):
+    # AIFF and MP3 files both carry ID3 tags.
+    if enctype == 'AIFF':
+        import mutagen.aiff
+        song_file = mutagen.aiff.AIFF(path)
+    else:
+        import mutagen.mp3
+        song_file = mutagen.mp3.MP3(path)
+
+    tags = song_file.tags
+    if tags is not None:
+        pictures = tags.getall('APIC')
+        if pictures:
+            save_embedded_artwork(pictures[0].data, os.path.dirname(path) + '/artwork.jpg', path)
+
+    return SongMetadata(path,
+                        str(first_tag(tags, ['TIT2'], os.path.splitext(song)[0])),  # If the title tag can't be read, use the filename without the extension
+                        str(first_tag(tags, ['TALB'], album)),  # If the album tag can't be read, use the folder name
+                        guess_track_number(song, song_index, first_tag(tags, ['TRCK'])),
+                        song_file.info,
+                        enctype,
+                        str(first_tag(tags, ['TPE2', 'TPE1', 'TOPE'], directory_artist(artist))),
+                        str(first_tag(tags, ['TCON'], DEFAULT_GENRE)),
+                        str(first_tag(tags, ['TYER', 'TDRC'], DEFAULT_YEAR))[0:4],
+                        os.path.dirname(path) + '/artwork.jpg',
+                        disc=tag_number(first_tag(tags, ['TPOS']), 1))
+
+
+def read_vorbis(path, artist, album, song, song_index, enctype):
+    # FLAC and OGG files both use Vorbis comments, whose keys are case-insensitive.
+    if enctype == 'FLAC':
+        import mutagen.flac
+        song_file = mutagen.flac.FLAC(path)
+        if song_file.pictures:
+            save_embedded_artwork(song_file.pictures[0].data, os.path.dirname(path) + '/artwork.jpg', path)
+    else:
+        import mutagen
+        song_file = mutagen.File(path)
+        if song_file is None:
+            raise ValueError('unrecognized OGG stream')
+
+    tags = song_file.tags
+    return SongMetadata(path,
+                        str(first_tag(tags, ['title'], os.path.splitext(song)[0])),
+                        str(first_tag(tags, ['album'], album)),
+                        guess_track_number(song, song_index, first_tag(tags, ['tracknumber'])),
+                        song_file.info,
+                        enctype,
+                        str(first_tag(tags, ['albumartist', 'artist'], directory_artist(artist))),
+                        str(first_tag(tags, ['genre'], DEFAULT_GENRE)),
+                        str(first_tag(tags, ['date', 'year'], DEFAULT_YEAR))[0:4],
+                        os.path.dirname(path) + '/artwork.jpg',
+                        disc=tag_number(first_tag(tags, ['discnumber']), 1))
+
+
+def read_wave(path, artist, album, song, song_index):
+    # WAV files don't have portable metadata. Just use file names etc.
+    import mutagen.wave
+    song_file = mutagen.wave.WAVE(path)
+    return SongMetadata(path,
+                        os.path.splitext(song)[0],
+                        album,
+                        guess_track_number(song, song_index),
+                        song_file.info,
+                        'WAVE',
+                        directory_artist(artist),
+                        DEFAULT_GENRE,
+                        DEFAULT_YEAR,
+                        os.path.dirname(path) + '/artwork.jpg')
+
+
+def read_library_entry(entry):
+    # Pool.imap() passes a single argument; unpack it for read_song_file().
+    return read_song_file(*entry)
+
+
+def read_library_files(entries, jobs=1):
+    # Read (location, artist, album, song, song_index) entries, yielding a SongMetadata (or None) for each in the same order. With more than one job, the tags are read in
+    # a pool of worker processes; entries are fed to it lazily, so the walk, the reading and the caller writing the results to the database all overlap.
+    if jobs <= 1:
+        for entry in entries:
+            yield read_library_entry(entry)
+        return
+
+    with multiprocessing.Pool(jobs) as pool:
+        for meta in pool.imap(read_library_entry, entries, chunksize=32):
+            yield meta
+
+
+def read_song_file(location, artist, album, song, song_index):
+    # Read the metadata of a single file in the library. Returns None for files that cannot be read; a broad array of errors can occur in mutagen and none of them
+    # really matter beyond the one file being skipped.
+    path = location + artist + '/' + album + '/' + song
+    enctype = SUPPORTED_EXTENSIONS.get(os.path.splitext(song)[1].lower())
+    try:
+        if enctype == 'MP4':
+            meta = read_mp4(path, artist, album, song, song_index)
+        elif enctype in ['AIFF', 'MP3']:
+            meta = read_id3(path, artist, album, song, song_index, enctype)
+        elif enctype in ['FLAC', 'OGG']:
+            meta = read_vorbis(path, artist, album, song, song_index, enctype)
+        elif enctype == 'WAVE':
+            meta = read_wave(path, artist, album, song, song_index)
         else:
-            self.contents = []
-        log.debug('contents: %s' % self.contents)
+            return None
+    except Exception as e:
+        log.error('failed to read %s: %s' % (path, str(e)))
+        return None
+
+    stat = os.stat(path)
+    meta.size = stat.st_size
+    meta.mtime = int(stat.st_mtime)
+    return meta
 
 
 class WebStereoDB:
@@ -131,9 +533,12 @@ class WebStereoDB:
     DB_SONG_LENGTH = 4
     DB_SONG_ENCTYPE = 5
     DB_SONG_ID = 6
-    # Don't expose the sorting mechanism in the database. However, some routes in webstereo.py add data onto the arrays returned by the database using append. In the event that the structure of the SQL table is ever expanded, use
+    # Index 7 is the sorting mechanism in the database; don't expose it.
+    DB_SONG_ALBUM_ID = 8
+    DB_SONG_ARTIST = 9
+    # Some routes in webstereo.py add data onto the arrays returned by the database using append. In the event that the structure of the SQL table is ever expanded, use
     # this variable referring to a nonexistent space so as to make that data accessible without magic-number constants in certain routes/templates and, relatedly, without requiring major refactors each time that happens
-    DB_SONG_UNALLOCATED_SPACE = 8  
+    DB_SONG_UNALLOCATED_SPACE = 10
     
     DB_ALBUM_TITLE = 0
     DB_ALBUM_ARTIST = 1
@@ -144,10 +549,34 @@ class WebStereoDB:
     DB_ALBUM_UNALLOCATED_SPACE = 7 # See above note for songs
     
     DB_PLAYLIST_NAME = 0
-    DB_PLAYLIST_CONTENTS = 1
+    DB_PLAYLIST_ID = 1
     DB_PLAYLIST_MODIFIED_TIME = 2
+    # Rows from fetch_playlist_summaries() carry these as well.
+    DB_PLAYLIST_SONG_COUNT = 3
+    DB_PLAYLIST_DURATION = 4
+
+    # Rows from fetch_playlist_songs() carry these after the usual song columns.
+    DB_PLAYLIST_ITEM_POSITION = 10
+    DB_PLAYLIST_ITEM_PLAYLIST_ID = 11
+
+    # Orderings for fetch_songs() and fetch_albums(): the SQL expression for each sort key, and where its value is found in the rows returned. The unique ID always comes last,
+    # so that every row has a distinct position; that position is what a page cursor records.
+    SONG_SORT_KEYS = {
+        'NUMBER': [('SONGS.NUMBER', DB_SONG_TRACK_NUMBER), ('SONGS.UNIQUE_ID', DB_SONG_ID)],
+        'ALBUM': [('ALBUMS.TITLE COLLATE NOCASE', DB_SONG_ALBUM), ('SONGS.UNIQUE_ID', DB_SONG_ID)],
+        'TITLE': [('SONGS.SORTING COLLATE NOCASE', 7), ('SONGS.UNIQUE_ID', DB_SONG_ID)],
+    }
+    ALBUM_SORT_KEYS = {
+        'ARTIST': [('ARTIST_SORTED COLLATE NOCASE', 6), ('YEAR', DB_ALBUM_YEAR), ('UNIQUE_ID', DB_ALBUM_ID)],
+        'TITLE': [('TITLE COLLATE NOCASE', DB_ALBUM_TITLE), ('UNIQUE_ID', DB_ALBUM_ID)],
+        'GENRE': [('GENRE COLLATE NOCASE', DB_ALBUM_GENRE), ('UNIQUE_ID', DB_ALBUM_ID)],
+        'YEAR': [('YEAR COLLATE NOCASE', DB_ALBUM_YEAR), ('UNIQUE_ID', DB_ALBUM_ID)],
+    }
+    # Entries in a playlist have only the one order; their positions are unique within it.
+    PLAYLIST_ITEM_SORT_KEYS = {
+        'POSITION': [('PLAYLIST_ITEMS.POSITION', DB_PLAYLIST_ITEM_POSITION)],
+    }
 
-    PAUSE_COMMIT = False  # When this is set to true, query() will not automatically commit changes to disk. This helps to optimize situations (such as in build_from()) where there are hundreds or thousands of database transactions.
     IGNORE_SORTING_CHARACTERS = ['the ', 'a ', "'", '(', '[', '...']  # Don't include the following at the beginnig of the database field that controls sorting, to avoid placing "The" under T and so forth.
 
     def __init__(self, dbpath=None):
@@ -155,86 +584,278 @@ class WebStereoDB:
         if dbpath:
             path = dbpath
         else:
-            path = configuration['db-path']
+            path = (configuration or load_configuration())['db-path']
+
+        # Connections are opened per thread, as they are needed; see the connection property. The first one writes (if it does not already exist) the structure defined
+        # above, or upgrades an existing database to it.
+        self.path = path
+        self.local = threading.local()
+        self.migrate()
+
+
+    @property
+    def connection(self):
+        # The calling thread's connection, opened on first use. In WAL mode, readers never block each other or the writer, so page renders, the background
+        # thread and a library sync running in another process all proceed concurrently.
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sql.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')  # safe in WAL mode, and avoids an fsync on every commit
+            self.local.connection = connection
+            self.local.depth = 0
+        return connection
+
+    def query_statistics(self):
+        # Totals of the database metrics above, for everything in this process.
+        queries, query_seconds = QUERY_SECONDS.total()
+        lock_acquisitions, lock_wait_seconds = LOCK_WAIT_SECONDS.total()
+        return {
+            'queries': queries,  # statements executed
+            'query_seconds': query_seconds,  # time spent executing them and fetching their results
+            'rows': ROWS_RETURNED.total(),  # rows returned
+            'lock_acquisitions': lock_acquisitions,  # writes and transactions that took the write lock
+            'lock_wait_seconds': lock_wait_seconds,  # time spent waiting for it
+            'lock_held_seconds': LOCK_HELD_SECONDS.total()[1],  # time it was held
+        }
+
+    def acquire_write_lock(self):
+        wait_start = time.perf_counter()
+        lock.acquire(True)
+        acquired = time.perf_counter()
+        LOCK_WAIT_SECONDS.observe(acquired - wait_start)
+        return acquired
+
+    def release_write_lock(self, acquired):
+        lock.release()
+        LOCK_HELD_SECONDS.observe(time.perf_counter() - acquired)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Group writes into one transaction, committed when the block exits (or rolled back, if it raises). The write lock is held throughout. Transactions nest;
+        # only the outermost one commits.
+        connection = self.connection
+        if self.local.depth:
+            self.local.depth += 1
+            try:
+                yield
+            finally:
+                self.local.depth -= 1
+            return
 
-        # Connect to the database and write (if it does not already exist) the structure defined above
-        self.connection = sql.connect(path, check_same_thread=False)
-        self.cursor = self.connection.cursor()
+        acquired = self.acquire_write_lock()
+        self.local.depth = 1
         try:
-            self.cursor.execute(STRUCTURE_ALBUMS)
-            self.cursor.execute(STRUCTURE_SONGS)
-            self.cursor.execute(STRUCTURE_PLAYLISTS)
-        except sql.OperationalError as e:
-            sys.stderr.write(str(e))
-            sys.stderr.write('\n')
-
-        # Get statistics on DB
-        albums_count = len(self.fetch_albums(silence=True))
-        songs_count = len(self.fetch_songs())
-        self.STATISTICS_MSG = "{} albums, {} songs".format(albums_count, songs_count)
+            connection.execute('BEGIN IMMEDIATE')
+            yield
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            self.local.depth = 0
+            self.release_write_lock(acquired)
 
     def query(self, command, data=None):
         # Perform an SQL query on the database. This wrapper function exists so that another SQL client/implementation could be used as a (at any rate, more of a) drop-in replacement for Python's built-in SQLite.
-        if data:
-            try:
-                lock.acquire(True)
-                cmd = self.cursor.execute(command, data)
-            finally:
-                lock.release()
-        else:
-            try:
-                lock.acquire(True)
-                cmd = self.cursor.execute(command)
-            finally:
-                lock.release()
+        # Anything other than a SELECT is a write: outside of a transaction(), it takes the write lock and is committed immediately.
+        connection = self.connection
+        statement = 'select' if command.lstrip()[:6].upper() == 'SELECT' else 'write'
+        writing = not self.local.depth and statement == 'write'
+        if writing:
+            acquired = self.acquire_write_lock()
         try:
-            lock.acquire(True)
-            result = cmd.fetchall()
+            start = time.perf_counter()
+            result = connection.execute(command, data or []).fetchall()
+            if writing and connection.in_transaction:
+                connection.commit()
+            QUERY_SECONDS.observe(time.perf_counter() - start, statement)
+            ROWS_RETURNED.inc(len(result))
+        except BaseException:
+            # sqlite3 opened a transaction of its own for the write; left open, it would keep the database locked to every other connection.
+            if writing and connection.in_transaction:
+                connection.rollback()
+            raise
         finally:
-            lock.release()
-            
-        if not self.PAUSE_COMMIT:
-            self.commit()
+            if writing:
+                self.release_write_lock(acquired)
 
         return result
 
+    def query_many(self, command, rows):
+        # executemany() counterpart to query(), used to write the results of a library scan in large batches.
+        with self.transaction():
+            start = time.perf_counter()
+            self.connection.executemany(command, rows)
+            QUERY_SECONDS.observe(time.perf_counter() - start, 'batch')
+
     def commit(self):
-        self.connection.commit()
+        # Writes made with query() outside of a transaction() are already committed, and those inside one are committed when it ends; this remains for the
+        # benefit of code written before that was the case.
+        if not self.local.depth:
+            self.connection.commit()
+
+    def migrate(self):
+        # The version of the schema is kept in SQLite's user_version field. A new database is created at the current version; an older one has each migration it
+        # has not yet seen applied in turn, each in its own transaction, so that media.db files are upgraded in place the first time a new version of webstereo opens them.
+        tables = [i[0] for i in self.query("SELECT NAME FROM sqlite_master WHERE TYPE = 'table'")]
+        if 'SONGS' not in tables:
+            for i in [STRUCTURE_ALBUMS, STRUCTURE_SONGS, STRUCTURE_PLAYLISTS, STRUCTURE_PLAYLIST_ITEMS, STRUCTURE_PLAY_QUEUE, STRUCTURE_PLAYER_STATE,
+                      STRUCTURE_LIBRARY_STATISTICS]:
+                self.query(i)
+            self.query('PRAGMA user_version = %d' % len(MIGRATIONS))
+            migrated = False
+        else:
+            version = self.query('PRAGMA user_version')[0][0]
+            for i in range(version, len(MIGRATIONS)):
+                log.info('migrating database to version %d: %s' % (i + 1, MIGRATIONS[i].__name__))
+                with self.transaction():
+                    MIGRATIONS[i](self)
+                    self.query('PRAGMA user_version = %d' % (i + 1))
+            migrated = version < len(MIGRATIONS)
+
+        self.create_indexes()
+        self.create_search_index()
+        if migrated:
+            # A migration may have rebuilt SONGS or ALBUMS, and the statistics triggers with them, so count everything afresh.
+            self.rebuild_statistics()
+
+    def create_indexes(self):
+        for i in STRUCTURE_INDEXES + STRUCTURE_STATISTICS_TRIGGERS:
+            self.query(i)
+
+    def rebuild_statistics(self):
+        # Fill LIBRARY_STATISTICS from scratch, in one pass over each table, for when the triggers were not there to keep it up to date (see build_from()).
+        with self.transaction():
+            self.query('DELETE FROM LIBRARY_STATISTICS')
+            self.query('''INSERT INTO LIBRARY_STATISTICS (KIND, NAME, SONGS, ALBUMS, DURATION)
+SELECT 'library', '', (SELECT COUNT(*) FROM SONGS), (SELECT COUNT(*) FROM ALBUMS), (SELECT COALESCE(SUM(DURATION), 0) FROM SONGS)''')
+            for kind, column in [('genre', 'GENRE'), ('artist', 'ARTIST')]:
+                self.query('''INSERT INTO LIBRARY_STATISTICS (KIND, NAME, SONGS, ALBUMS, DURATION)
+SELECT ?, ALBUMS.%s, COUNT(SONGS.UNIQUE_ID), COUNT(DISTINCT ALBUMS.UNIQUE_ID), COALESCE(SUM(SONGS.DURATION), 0)
+FROM ALBUMS LEFT JOIN SONGS ON SONGS.ALBUM_ID = ALBUMS.UNIQUE_ID GROUP BY ALBUMS.%s''' % (column, column), [kind])
+            self.query('''INSERT INTO LIBRARY_STATISTICS (KIND, NAME, SONGS, ALBUMS, DURATION)
+SELECT 'format', ENCTYPE, COUNT(*), 0, COALESCE(SUM(DURATION), 0) FROM SONGS GROUP BY ENCTYPE''')
+
+    def library_totals(self):
+        # (songs, albums, duration in milliseconds) for the whole library.
+        result = self.query("SELECT SONGS, ALBUMS, DURATION FROM LIBRARY_STATISTICS WHERE KIND = 'library' AND NAME = ''")
+        return tuple(result[0]) if result else (0, 0, 0)
+
+    def library_breakdown(self, kind, limit=None):
+        # (name, songs, albums, duration in milliseconds) for each genre, artist or format (see STRUCTURE_LIBRARY_STATISTICS), most songs first.
+        return self.query('SELECT NAME, SONGS, ALBUMS, DURATION FROM LIBRARY_STATISTICS WHERE KIND = ? AND (SONGS > 0 OR ALBUMS > 0) ORDER BY SONGS DESC, NAME'
+                          + (' LIMIT %d' % int(limit) if limit else ''), [kind])
+
+    def statistics_message(self):
+        # The generic message about library size displayed on every page.
+        songs, albums, duration = self.library_totals()
+        return '{} albums, {} songs'.format(albums, songs)
+
+    full_text_search = True  # cleared if this build of SQLite lacks FTS5, in which case searches fall back on LIKE
+
+    def create_search_index(self):
+        # Create the full-text indexes and their triggers, filling the indexes from the existing tables if they are new.
+        if not self.full_text_search:
+            return
+        with self.transaction():
+            populate = not self.query("SELECT name FROM sqlite_master WHERE name = 'SONGS_FTS'")
+            try:
+                for i in STRUCTURE_SEARCH:
+                    self.query(i)
+            except sql.OperationalError as e:
+                log.warning('full-text search is unavailable (%s), falling back on LIKE' % e)
+                self.full_text_search = False
+                return
+            if populate:
+                self.query('INSERT INTO ALBUMS_FTS (rowid, TITLE, ARTIST, GENRE) SELECT UNIQUE_ID, TITLE, ARTIST, GENRE FROM ALBUMS')
+                self.query('''INSERT INTO SONGS_FTS (rowid, TITLE, ALBUM, ARTIST, GENRE)
+SELECT SONGS.UNIQUE_ID, SONGS.TITLE, ALBUMS.TITLE, ALBUMS.ARTIST, ALBUMS.GENRE FROM SONGS JOIN ALBUMS ON ALBUMS.UNIQUE_ID = SONGS.ALBUM_ID''')
+            for i in STRUCTURE_SEARCH_TRIGGERS:
+                self.query(i)
+
+    def match_expression(self, search_query, column=None):
+        # Turn what the user typed into an FTS5 query: every word must appear, as a word or the start of one, so that partial words match as they are typed.
+        # Words are quoted, so that characters FTS5 would treat as syntax are searched for literally.
+        words = re.findall(r'\w+', search_query)
+        if not words:
+            return None
+        expression = ' '.join(['"%s"*' % i for i in words])
+        if column:
+            expression = '%s : (%s)' % (column, expression)
+        return expression
+
+    def rebuild_table(self, table, structure):
+        # SQLite cannot change the type or constraints of an existing column, so create the table anew and copy across the columns the two versions have in common.
+        # Columns new to this version take their defaults. Left to itself, SQLite would point the references other tables and triggers make to this one at the old
+        # copy when it is renamed; legacy_alter_table leaves them referring to the table by name, which will be the new copy.
+        old_columns = [i[1] for i in self.query('PRAGMA table_info(%s)' % table)]
+        self.query('PRAGMA legacy_alter_table = ON')
+        self.query('ALTER TABLE %s RENAME TO %s_OLD' % (table, table))
+        self.query(structure)
+        columns = ', '.join([i[1] for i in self.query('PRAGMA table_info(%s)' % table) if i[1] in old_columns])
+        self.query('INSERT OR IGNORE INTO %s (%s) SELECT %s FROM %s_OLD' % (table, columns, columns, table))
+        self.query('DROP TABLE %s_OLD' % table)
+        self.query('PRAGMA legacy_alter_table = OFF')
+
+    INSERT_ALBUM = 'INSERT INTO ALBUMS (TITLE, ARTIST, GENRE, ARTWORK, YEAR, UNIQUE_ID, ARTIST_SORTED) VALUES (?, ?, ?, ?, ?, ?, ?)'
+    INSERT_SONG = '''INSERT INTO SONGS (FILE, TITLE, ALBUM_ID, NUMBER, LENGTH, ENCTYPE, UNIQUE_ID, SORTING, SIZE, MTIME, DURATION, DISC, SAMPLE_RATE, BITRATE)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    UPDATE_SONG = '''UPDATE SONGS SET TITLE = ?, ALBUM_ID = ?, NUMBER = ?, LENGTH = ?, ENCTYPE = ?, SORTING = ?, SIZE = ?, MTIME = ?, DURATION = ?, DISC = ?, SAMPLE_RATE = ?,
+BITRATE = ? WHERE UNIQUE_ID = ?'''
+    BATCH_SIZE = 1000  # rows per executemany() call when writing the results of a library scan
+
+    # New songs and albums are given a unique ID of NULL, which SQLite replaces with one higher than the highest in use when the row is written. The write lock
+    # is held from then until the transaction commits, so another thread or process writing to the database at the same time (webstereo.py and data.py -s, say)
+    # can never be given the same one.
+    def album_row(self, title, artist, genre, year, artwork=''):
+        return [str(title), str(artist), str(genre), str(artwork), str(year), None, self.sorting_title(str(artist))]
 
     def create_album(self, title, artist, genre, year, artwork=''):
-        artist_sorted = artist
-        for i in self.IGNORE_SORTING_CHARACTERS:
-            artist_sorted = artist_sorted.removeprefix(i)
-        
-        self.query('INSERT INTO ALBUMS (TITLE, ARTIST, GENRE, ARTWORK, YEAR, UNIQUE_ID, ARTIST_SORTED) VALUES (?, ?, ?, ?, ?, ?, ?)', [str(title),
-                                                                                                                     str(artist),
-                                                                                                                     str(genre),
-                                                                                                                     str(artwork),
-                                                                                                                     str(year),
-                                                                                                                                       generate_album_id(),
-                                                                                                                                       artist_sorted
-                                                                                                                     ])
-        self.commit()
+        # Returns the new album's unique ID.
+        with self.transaction():
+            self.query(self.INSERT_ALBUM, self.album_row(title, artist, genre, year, artwork))
+            return self.query('SELECT last_insert_rowid()')[0][0]
 
     def edit_album(self, album_id, data):
-        self.query('UPDATE ALBUMS SET TITLE = ?, ARTIST = ?, GENRE = ?, YEAR = ? WHERE UNIQUE_ID = ?',
-                   [data['title'], data['artist'], data['genre'], data['year'], album_id])
-        self.commit()
-
-    def fetch_albums(self, sort_by='ARTIST', silence=False):
-        # Ideally, this would pass sort_by directly into the SQL, but that doesn't work- I'm not quite certain as to why.
-        
-        if sort_by == 'ARTIST':
-            result = self.query('SELECT * FROM ALBUMS ORDER BY ARTIST, YEAR COLLATE NOCASE ASC')  #  [sort_by])
-
-        elif sort_by == 'TITLE':
-            result = self.query('SELECT * FROM ALBUMS ORDER BY TITLE COLLATE NOCASE ASC')
-
-        elif sort_by == 'GENRE':
-            result = self.query('SELECT * FROM ALBUMS ORDER BY GENRE COLLATE NOCASE ASC')
+        # Returns the album's ID. Giving an album the title and artist of another merges the two, under the other one's ID.
+        with self.transaction():
+            other = self.find_album_id(data['title'], data['artist'])
+            if other is not None and other != album_id:
+                self.query('UPDATE SONGS SET ALBUM_ID = ? WHERE ALBUM_ID = ?', [other, album_id])
+                self.query('DELETE FROM ALBUMS WHERE UNIQUE_ID = ?', [album_id])
+                album_id = other
+            self.query('UPDATE ALBUMS SET TITLE = ?, ARTIST = ?, GENRE = ?, YEAR = ? WHERE UNIQUE_ID = ?',
+                       [data['title'], data['artist'], data['genre'], data['year'], album_id])
+        return album_id
+
+    def paged_query(self, select, keys, limit=None, after=None, params=()):
+        # Keyset pagination: rather than OFFSET, which makes SQLite count its way past every row before the page, continue from the sort keys of the last row of the
+        # previous page (as returned by page_cursor()). With the sort keys indexed, every page costs the same no matter how deep into the table it is.
+        # Placeholders cannot stand in for column names, so the ORDER BY clause is assembled from the fixed expressions in SONG_SORT_KEYS and ALBUM_SORT_KEYS.
+        # params are the values for any placeholders already in select.
+        params = list(params)
+        if after:
+            clauses = []
+            for i in range(len(keys)):
+                clauses.append('(' + ' AND '.join(['%s = ?' % keys[j][0] for j in range(i)] + ['%s > ?' % keys[i][0]]) + ')')
+                params.extend(list(after[:i]) + [after[i]])
+            select += (' AND ' if ' WHERE ' in select else ' WHERE ') + '(' + ' OR '.join(clauses) + ')'
+
+        select += ' ORDER BY ' + ', '.join([i[0] + ' ASC' for i in keys])
+        if limit:
+            select += ' LIMIT %d' % int(limit)
+
+        return self.query(select, params)
+
+    def page_cursor(self, rows, keys):
+        # The position after which the next page begins, or None if there are no more rows.
+        if not rows:
+            return None
+        return [rows[-1][i[1]] for i in keys]
 
-        elif sort_by == 'YEAR':
-            result = self.query('SELECT * FROM ALBUMS ORDER BY YEAR COLLATE NOCASE ASC')
+    def fetch_albums(self, sort_by='ARTIST', silence=False, limit=None, after=None):
+        result = self.paged_query('SELECT * FROM ALBUMS', self.ALBUM_SORT_KEYS[sort_by], limit, after)
 
         if not silence:
             log.debug('ALBUMS: %s' % result)
@@ -244,6 +865,11 @@ class WebStereoDB:
         result = self.query('SELECT * FROM ALBUMS WHERE TITLE = ?', [str(title)])
         return result
 
+    def find_album_id(self, title, artist):
+        # The ID of the album with this title and artist, or None.
+        result = self.query('SELECT UNIQUE_ID FROM ALBUMS WHERE TITLE = ? AND ARTIST = ?', [str(title), str(artist)])
+        return result[0][0] if result else None
+
     def find_album_by_id(self, uid):
         result = self.query('SELECT * FROM ALBUMS WHERE UNIQUE_ID = ?', [uid])
         return result[0]
@@ -263,86 +889,115 @@ class WebStereoDB:
         else:
             return None
 
-    def fetch_album_contents(self, name):
-        result = self.query('SELECT * FROM SONGS WHERE ALBUM = ? ORDER BY NUMBER', [name])
-        songs = []
+    def fetch_album_contents(self, album_id):
+        return self.query(SONG_SELECT + ' WHERE SONGS.ALBUM_ID = ? ORDER BY SONGS.DISC, SONGS.NUMBER', [album_id])
 
-        return result # songs
+    def search_in_albums(self, search_query, limit=None):
+        # Albums whose title, artist or genre match, best matches first.
+        limit_clause = ' LIMIT %d' % limit if limit else ''
+        if not self.full_text_search:
+            q = '%' + search_query + '%'
+            return self.query('SELECT * FROM ALBUMS WHERE TITLE LIKE ? OR ARTIST LIKE ?' + limit_clause, [q, q])
 
-    def search_in_albums(self, search_query):
-        q = '%' + search_query + '%'
-        results = self.query('SELECT * FROM ALBUMS WHERE TITLE like ?', [q])
-        return results
+        expression = self.match_expression(search_query)
+        if not expression:
+            return []
+        return self.query('SELECT ALBUMS.* FROM ALBUMS_FTS JOIN ALBUMS ON ALBUMS.UNIQUE_ID = ALBUMS_FTS.rowid WHERE ALBUMS_FTS MATCH ? ORDER BY bm25(ALBUMS_FTS, %s)%s'
+                          % (ALBUMS_FTS_WEIGHTS, limit_clause), [expression])
+
+    def search_artists(self, search_query, limit=None):
+        # [(artist, number of albums)] for artists whose names match, those with the most albums first.
+        limit_clause = ' LIMIT %d' % limit if limit else ''
+        if not self.full_text_search:
+            return self.query('SELECT ARTIST, COUNT(*) FROM ALBUMS WHERE ARTIST LIKE ? GROUP BY ARTIST ORDER BY COUNT(*) DESC' + limit_clause, ['%' + search_query + '%'])
+
+        expression = self.match_expression(search_query, 'ARTIST')
+        if not expression:
+            return []
+        return self.query('SELECT ARTIST, COUNT(*) FROM ALBUMS_FTS WHERE ALBUMS_FTS MATCH ? GROUP BY ARTIST ORDER BY COUNT(*) DESC' + limit_clause, [expression])
     
-    def create_song(self, file, title, album, number, length=0, enctype=''):
+    def sorting_title(self, title):
         # Create a separate field without leading special characters or articles to prevent placing songs with "The" under T and similar problems.
         sorted_title = title.lower()  # case-insensitive
         for i in self.IGNORE_SORTING_CHARACTERS:
             sorted_title = sorted_title.removeprefix(i)
-    
-        self.query('INSERT INTO SONGS (FILE, TITLE, ALBUM, NUMBER, LENGTH, ENCTYPE, UNIQUE_ID, SORTING) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
-            str(file),
-            str(title),
-            str(album),
-            str(number),
-            str(length),
-            str(enctype),
-            generate_song_id(),
-            sorted_title
-        ])
+        return sorted_title
+
+    def song_row(self, file, title, album_id, number, length=0, enctype='', size=0, mtime=0, duration=0, disc=1, sample_rate=0, bitrate=0):
+        return [str(file), str(title), int(album_id), int(number), str(length), str(enctype), None, self.sorting_title(str(title)), int(size), int(mtime),
+                int(duration), int(disc), int(sample_rate), int(bitrate)]
 
+    def create_song(self, file, title, album_id, number, length=0, enctype='', size=0, mtime=0, duration=0, disc=1, sample_rate=0, bitrate=0):
+        self.query(self.INSERT_SONG, self.song_row(file, title, album_id, number, length, enctype, size, mtime, duration, disc, sample_rate, bitrate))
         self.commit()
 
     def edit_song(self, song_id, data):
-        global VERBOSE
+        song = self.find_song_by_id(song_id)
+        # Songs refer to their album by ID. A song moves to the album of that title by the same artist; if there isn't one, it is created, borrowing the rest of its
+        # details from the old one.
+        old_album = self.find_album_by_id(song[self.DB_SONG_ALBUM_ID])
+        album_id = self.find_album_id(data['album'], old_album[self.DB_ALBUM_ARTIST])
+        if album_id is None:
+            album_id = self.create_album(data['album'], old_album[self.DB_ALBUM_ARTIST], old_album[self.DB_ALBUM_GENRE], old_album[self.DB_ALBUM_YEAR], old_album[self.DB_ALBUM_ARTWORK])
+
         # Update values in database
-        self.query('UPDATE SONGS SET TITLE = ?, ALBUM = ?, NUMBER = ? WHERE UNIQUE_ID = ?',
+        self.query('UPDATE SONGS SET TITLE = ?, ALBUM_ID = ?, NUMBER = ?, SORTING = ? WHERE UNIQUE_ID = ?',
                    [data['new_title'],
-                    data['album'],
-                    data['number'],
-                    unique_id])
-        # Write metadata to the file itself on disk
+                    album_id,
+                    int(data['number']),
+                    self.sorting_title(data['new_title']),
+                    song_id])
+        self.delete_empty_albums()
+        self.commit()
+
+        # Write metadata to the file itself on disk, so that it survives the next sync.
         try:
-            result = self.query('SELECT * FROM SONGS WHERE TITLE = ?', [data['title']])
-            file_path = result[0]  # [0]  # Get first attribute of first result.
-            file_type = os.path.splitext(file_path)  # Extension
-            if file_type == 'm4a':
+            file_path = song[self.DB_SONG_FILE]
+            file_type = os.path.splitext(file_path)[1].lower()  # Extension
+            if file_type == '.m4a':
+                import mutagen.mp4
                 file = mutagen.mp4.MP4(file_path)
+                file['\xa9nam'] = data['new_title']
                 file['\xa9alb'] = data['album']
-            elif file_type == 'flac':
+                file.save()
+            elif file_type == '.flac':
+                import mutagen.flac
                 file = mutagen.flac.FLAC(file_path)
-                file['TALB'] = data['album']
-
-            self.commit()
+                file['title'] = data['new_title']
+                file['album'] = data['album']
+                file.save()
         except Exception as e:
                 log.debug('Encountered the following exception in writing metadata: %s' % str(e))
     
-    def fetch_songs(self, sort_by='TITLE'):
-        # See the fetch_albums function an explanation of this inelegant approach
-        if sort_by == 'NUMBER':
-            q = 'SELECT * FROM SONGS ORDER BY NUMBER COLLATE NOCASE ASC'
-            
-        elif sort_by == 'ALBUM':
-            q = 'SELECT * FROM SONGS ORDER BY ALBUM COLLATE NOCASE ASC'
-            
-        elif sort_by == 'TITLE':
-            q = 'SELECT * FROM SONGS ORDER BY SORTING COLLATE NOCASE ASC'
-            
-        # result = self.query('SELECT * FROM SONG S ORDER BY ?', [sort_by])
-        result = self.query(q)
-        
-        return result
+    def fetch_songs(self, sort_by='TITLE', limit=None, after=None):
+        # See paged_query() for limit and after; without them, this returns the entire library.
+        return self.paged_query(SONG_SELECT, self.SONG_SORT_KEYS[sort_by], limit, after)
 
-    def fetch_all_song_data(self, sort_by='NUMBER, TITLE'):
-        song_query = self.query('SELECT * FROM SONGS ORDER BY ?', [sort_by])
-        return song_query
+    def fetch_all_song_data(self):
+        return self.query(SONG_SELECT + ' ORDER BY SONGS.NUMBER, SONGS.TITLE')
 
     def find_songs(self, name):
-        result = self.query('SELECT * FROM SONGS WHERE TITLE = ?', [name])
+        result = self.query(SONG_SELECT + ' WHERE SONGS.TITLE = ?', [name])
         return result[0]
 
+    def find_songs_by_ids(self, uids):
+        # Fetch several songs at once, in the order given; IDs that no longer exist are left out. Used wherever a list of IDs (a playlist, the queue) must be shown.
+        found = {}
+        uids = list(uids)
+        for i in range(0, len(uids), 500):  # stay well inside SQLite's limit on the number of parameters
+            chunk = uids[i:i + 500]
+            for row in self.query(SONG_SELECT + ' WHERE SONGS.UNIQUE_ID IN (%s)' % ', '.join(['?'] * len(chunk)), chunk):
+                found[row[self.DB_SONG_ID]] = row
+
+        return [found[int(i)] for i in uids if str(i).isdigit() and int(i) in found]
+
+    def max_song_id(self):
+        # The highest song ID in use, or -1 if there are no songs.
+        result = self.query('SELECT MAX(UNIQUE_ID) FROM SONGS')[0][0]
+        return -1 if result is None else result
+
     def find_song_by_id(self, uid):
-        result = self.query('SELECT * FROM SONGS WHERE UNIQUE_ID = ?', [uid])
+        result = self.query(SONG_SELECT + ' WHERE SONGS.UNIQUE_ID = ?', [uid])
         
         if len(result) == 0:
             # Don't throw an IndexError if there are no results.
@@ -351,55 +1006,103 @@ class WebStereoDB:
         return result[0]  # only one result, so nothing is lost here.
     
     def find_songs_with_album(self, name, album):
-        result = self.query('SELECT * FROM SONGS WHERE TITLE = ? AND ALBUM = ?', [name, album])[0]  # There should only ever be one result
+        result = self.query(SONG_SELECT + ' WHERE SONGS.TITLE = ? AND ALBUMS.TITLE = ?', [name, album])[0]  # There should only ever be one result
         return result
 
-    def search_in_songs(self, search_query):
-        q = '%' + search_query + '%'
-        results = self.query('SELECT * FROM SONGS WHERE TITLE like ?', [q])
-        return results
+    def search_in_songs(self, search_query, limit=None):
+        # Songs whose title, album, artist or genre match, best matches first.
+        limit_clause = ' LIMIT %d' % limit if limit else ''
+        if not self.full_text_search:
+            q = '%' + search_query + '%'
+            return self.query(SONG_SELECT + ' WHERE SONGS.TITLE LIKE ? OR ALBUMS.TITLE LIKE ? OR ALBUMS.ARTIST LIKE ?' + limit_clause, [q, q, q])
+
+        expression = self.match_expression(search_query)
+        if not expression:
+            return []
+        return self.query(SONG_SELECT + ' JOIN SONGS_FTS ON SONGS_FTS.rowid = SONGS.UNIQUE_ID WHERE SONGS_FTS MATCH ? ORDER BY bm25(SONGS_FTS, %s)%s'
+                          % (SONGS_FTS_WEIGHTS, limit_clause), [expression])
         
     def check_if_song_exists(self, file):
         # Used to determine whether to index a song - does it exist.
-        result = self.query('SELECT * FROM SONGS WHERE FILE = ?', [file])
+        result = self.query('SELECT UNIQUE_ID FROM SONGS WHERE FILE = ?', [file])
         if result:
             return True
         else:
             return False
 
-    # Playlist contents are stored as strings with song IDs delineated by \t.
+    # Playlists are rows in PLAYLISTS, and their contents rows in PLAYLIST_ITEMS; see STRUCTURE_PLAYLIST_ITEMS. They are referred to by name.
     def create_playlist(self, name):
-        # creates a new playlist of name, with a delimiter string as initial contents
-        (self.search_playlist(name))
         if self.search_playlist(name):
             raise DuplicateCreationError('cannot create duplicate playlist')
         else:
-            self.query('INSERT INTO PLAYLISTS (NAME, CONTENTS, MODIFIED_TIME) VALUES (?, ?, ?)', [name, '', int(time.time())])
+            self.query('INSERT INTO PLAYLISTS (NAME, MODIFIED_TIME) VALUES (?, ?)', [name, int(time.time())])
+
+    def playlist_id(self, plist):
+        # Raises IndexError if there is no such playlist.
+        return self.query('SELECT UNIQUE_ID FROM PLAYLISTS WHERE NAME = ?', [plist])[0][0]
+
+    def touch_playlist(self, playlist_id):
+        self.query('UPDATE PLAYLISTS SET MODIFIED_TIME = ? WHERE UNIQUE_ID = ?', [int(time.time()), playlist_id])
  
     def append_to_playlist(self, plist, song_id):
         log.debug('playlist is %s, song is %d' % (plist, song_id))
-        contents = self.query('SELECT * from PLAYLISTS WHERE NAME = ?', [plist])[0][1] # Get present contents of playlist
-        log.debug('playlist contents are %s' % contents)
-        contents = contents + '\t' + str(song_id)
-        self.query('UPDATE PLAYLISTS SET CONTENTS = ?, MODIFIED_TIME = ? WHERE NAME = ?', [contents, int(time.time()), plist])
-        log.debug('playlist contents set to %s' % contents)
-        log.debug('playlist contents accessible as %s' % self.fetch_playlist_contents(plist))
-        self.commit()
+        with self.transaction():
+            playlist_id = self.playlist_id(plist)
+            last = self.query('SELECT MAX(POSITION) FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ?', [playlist_id])[0][0]
+            self.query('INSERT INTO PLAYLIST_ITEMS (PLAYLIST_ID, POSITION, SONG_ID) VALUES (?, ?, ?)',
+                       [playlist_id, (last or 0) + PLAYLIST_POSITION_STEP, song_id])
+            self.touch_playlist(playlist_id)
         
     def delete_from_playlist(self, plist, song_id):
-        contents = self.query('SELECT * FROM PLAYLISTS WHERE NAME = ?', [plist])[0][1]
-        contents = contents.replace('\t{}'.format(song_id), '\t')  # preserve delineating tab character while removing value
-        while '\t\t' in contents:
-            contents = contents.replace('\t\t', '\t')  # If a value occurs at the end of the contents string, duplicate \t s are possible; pre-empt them here.
-
-        # Empty song spaces will appear if this is only one tab characters; contents will create the object over which Jinja iterates.
-        if contents == '\t':
-            contents = ""
-        self.query('UPDATE PLAYLISTS SET CONTENTS = ? WHERE NAME = ?', [contents, plist])
+        # Delete every instance of a song from a playlist. Raises ValueError if it isn't there.
+        with self.transaction():
+            playlist_id = self.playlist_id(plist)
+            if not self.query('SELECT 1 FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ? AND SONG_ID = ?', [playlist_id, song_id]):
+                raise ValueError('song %d is not in playlist %s' % (song_id, plist))
+            self.query('DELETE FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ? AND SONG_ID = ?', [playlist_id, song_id])
+            self.touch_playlist(playlist_id)
+
+    def move_in_playlist(self, plist, position, before=None):
+        # Move the entry at `position` so that it comes just before the entry at `before`, or to the end if before is None. Returns its new position.
+        with self.transaction():
+            playlist_id = self.playlist_id(plist)
+            if before is None:
+                last = self.query('SELECT MAX(POSITION) FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ?', [playlist_id])[0][0]
+                new_position = (last or 0) + PLAYLIST_POSITION_STEP
+            else:
+                previous = self.query('SELECT MAX(POSITION) FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ? AND POSITION < ?', [playlist_id, before])[0][0]
+                if previous == position:
+                    return position  # already there
+                previous = before - 2 * PLAYLIST_POSITION_STEP if previous is None else previous
+                if before - previous < 2:
+                    # No room between the two; spread the playlist out again and look afresh.
+                    position, before = self.renumber_playlist(playlist_id, [position, before])
+                    previous = self.query('SELECT MAX(POSITION) FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ? AND POSITION < ?', [playlist_id, before])[0][0]
+                    previous = before - 2 * PLAYLIST_POSITION_STEP if previous is None else previous
+                new_position = (previous + before) // 2
+
+            self.query('UPDATE PLAYLIST_ITEMS SET POSITION = ? WHERE PLAYLIST_ID = ? AND POSITION = ?', [new_position, playlist_id, position])
+            self.touch_playlist(playlist_id)
+        return new_position
+
+    def renumber_playlist(self, playlist_id, positions=()):
+        # Space the entries of a playlist PLAYLIST_POSITION_STEP apart again, keeping their order. Returns the new values of `positions`.
+        rows = self.query('SELECT POSITION, SONG_ID FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ? ORDER BY POSITION', [playlist_id])
+        renumbered = {row[0]: (i + 1) * PLAYLIST_POSITION_STEP for i, row in enumerate(rows)}
+        with self.transaction():
+            self.query('DELETE FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ?', [playlist_id])
+            self.query_many('INSERT INTO PLAYLIST_ITEMS (PLAYLIST_ID, POSITION, SONG_ID) VALUES (?, ?, ?)',
+                            [[playlist_id, renumbered[row[0]], row[1]] for row in rows])
+        return [renumbered.get(i, i) for i in positions]
 
     def fetch_playlist_contents(self, plist):
-        results = self.query('SELECT * FROM PLAYLISTS WHERE NAME = ?', [plist])[0][1].split('\t')
-        return results
+        # The IDs of the songs in a playlist, in order.
+        return [i[0] for i in self.query('SELECT SONG_ID FROM PLAYLIST_ITEMS WHERE PLAYLIST_ID = ? ORDER BY POSITION', [self.playlist_id(plist)])]
+
+    def fetch_playlist_songs(self, plist, sort_by='POSITION', limit=None, after=None):
+        # The songs in a playlist, in order, each followed by its position in the playlist. Paged like fetch_songs(); positions serve as the cursor.
+        return self.paged_query(PLAYLIST_SONG_SELECT + ' WHERE PLAYLIST_ITEMS.PLAYLIST_ID = ?', self.PLAYLIST_ITEM_SORT_KEYS[sort_by], limit, after,
+                                [self.playlist_id(plist)])
     
     def fetch_all_playlist_names(self):
         _results = self.query('SELECT * FROM PLAYLISTS ORDER BY MODIFIED_TIME')
@@ -409,657 +1112,293 @@ class WebStereoDB:
 
         return results
     
-    def fetch_all_playlists(self):
-        sql_results = self.query('SELECT * FROM PLAYLISTS ORDER BY MODIFIED_TIME')
-        playlists = []
-        for i in sql_results:
-            playlists.append(PlaylistContainer(i, self))
-            # a webstereoDB object must be passed because this object's constructor calls a non-static method on it; do that unsightly part here, safely obscured in the database
-            # logic that is already unpleasant to look at.
-
-        return playlists
+    def fetch_playlist_summaries(self):
+        # Every playlist, with the number of songs in it and their total length but not the songs themselves (see fetch_playlist_songs()), in one query.
+        return [PlaylistContainer(i) for i in self.query(PLAYLIST_SUMMARY_SELECT)]
     
     def search_playlist(self, name):
         results = self.query('SELECT * FROM PLAYLISTS WHERE NAME = ? ORDER BY MODIFIED_TIME', [name])
         return results
+
+    # The play queue (see STRUCTURE_PLAY_QUEUE), kept here rather than in memory so that it survives a restart. Entries are (position, song ID) pairs; the position
+    # identifies an entry, as the same song may be queued more than once.
+    def queue_entries(self, limit=None):
+        return self.query('SELECT POSITION, SONG_ID FROM PLAY_QUEUE ORDER BY POSITION' + (' LIMIT %d' % int(limit) if limit else ''))
+
+    def queue_head(self):
+        # The first entry in the queue, or None if it is empty.
+        result = self.queue_entries(1)
+        return tuple(result[0]) if result else None
+
+    def queue_length(self):
+        return self.query('SELECT COUNT(*) FROM PLAY_QUEUE')[0][0]
+
+    def queue_insert(self, song_ids, before=None):
+        # Queue song_ids, in order, just before the entry at position `before`, or at the end if before is None. Returns their positions.
+        song_ids = list(song_ids)
+        if not song_ids:
+            return []
+        with self.transaction():
+            if before is None:
+                last = self.query('SELECT MAX(POSITION) FROM PLAY_QUEUE')[0][0] or 0
+                positions = [last + (i + 1) * PLAYLIST_POSITION_STEP for i in range(len(song_ids))]
+            else:
+                previous = self.queue_position_before(before, len(song_ids))
+                if before - previous <= len(song_ids):
+                    # No room between the two; spread the queue out again, leaving a gap large enough, and look afresh.
+                    before = self.renumber_queue(before, len(song_ids))
+                    previous = self.queue_position_before(before, len(song_ids))
+                step = (before - previous) // (len(song_ids) + 1)
+                positions = [previous + (i + 1) * step for i in range(len(song_ids))]
+            self.query_many('INSERT INTO PLAY_QUEUE (POSITION, SONG_ID) VALUES (?, ?)', list(zip(positions, song_ids)))
+        return positions
+
+    def queue_position_before(self, position, count=1):
+        # The position of the entry before `position`, or, if there is none, one far enough before it to leave room for `count` entries.
+        previous = self.query('SELECT MAX(POSITION) FROM PLAY_QUEUE WHERE POSITION < ?', [position])[0][0]
+        return position - (count + 1) * PLAYLIST_POSITION_STEP if previous is None else previous
+
+    def queue_remove(self, position):
+        # Returns the ID of the song that was at `position`, or None if there was nothing there.
+        with self.transaction():
+            result = self.query('SELECT SONG_ID FROM PLAY_QUEUE WHERE POSITION = ?', [position])
+            self.query('DELETE FROM PLAY_QUEUE WHERE POSITION = ?', [position])
+        return result[0][0] if result else None
+
+    def queue_pop(self, position=None):
+        # Remove the first entry in the queue and return it as (position, song ID), or return None if the queue is empty or, given position, if the first entry is
+        # not the one at position. Looking and removing are one transaction, so that two callers can never both take the same entry.
+        with self.transaction():
+            head = self.queue_head()
+            if head is None or (position is not None and head[0] != position):
+                return None
+            self.query('DELETE FROM PLAY_QUEUE WHERE POSITION = ?', [head[0]])
+        return head
+
+    def queue_move(self, position, before=None):
+        # Move the entry at `position` to just before the entry at `before`, or to the end. Returns its new position, or None if there was no such entry.
+        with self.transaction():
+            song_id = self.queue_remove(position)
+            if song_id is None:
+                return None
+            return self.queue_insert([song_id], before)[0]
+
+    def queue_clear(self):
+        self.query('DELETE FROM PLAY_QUEUE')
+
+    def renumber_queue(self, gap_before=None, gap=0):
+        # Space the queue PLAYLIST_POSITION_STEP apart again, keeping its order, with room for `gap` more entries before the entry at `gap_before`. Returns the new
+        # position of that entry.
+        rows = self.queue_entries()
+        renumbered = {}
+        position = 0
+        for old_position, song_id in rows:
+            position += PLAYLIST_POSITION_STEP * (gap + 1 if old_position == gap_before else 1)
+            renumbered[old_position] = position
+        with self.transaction():
+            self.query('DELETE FROM PLAY_QUEUE')
+            self.query_many('INSERT INTO PLAY_QUEUE (POSITION, SONG_ID) VALUES (?, ?)', [[renumbered[i[0]], i[1]] for i in rows])
+        return renumbered.get(gap_before, gap_before)
+
+    # Loudness, as measured by loudness.py. Songs are due to be measured when their file has changed since they last were, which includes never.
+
+    def loudness_pending(self, after=-1, limit=100):
+        # (unique ID, file, MTIME) for up to `limit` songs due to be measured, in order of ID starting after `after`, so that a pass over the library can be taken
+        # a batch at a time without looking at the same songs twice.
+        return self.query('SELECT UNIQUE_ID, FILE, MTIME FROM SONGS WHERE UNIQUE_ID > ? AND LOUDNESS_MTIME IS NOT MTIME ORDER BY UNIQUE_ID LIMIT ?', [after, limit])
+
+    def loudness_pending_count(self):
+        return self.query('SELECT COUNT(*) FROM SONGS WHERE LOUDNESS_MTIME IS NOT MTIME')[0][0]
+
+    def save_loudness(self, results):
+        # results are (unique ID, MTIME, loudness, peak) for songs measured from the file as it was at MTIME, with a loudness and peak of None for silent ones;
+        # any whose file has been read again by a sync since are left to be measured again.
+        self.query_many('UPDATE SONGS SET LOUDNESS = ?, PEAK = ?, LOUDNESS_MTIME = MTIME WHERE UNIQUE_ID = ? AND MTIME = ?',
+                        [[loudness, peak, song_id, mtime] for song_id, mtime, loudness, peak in results])
+
+    def song_loudness(self, song_id):
+        # ((loudness, peak), (loudness, peak)) for the song, and for its album as a whole, or None in place of either if there is no current measurement. The
+        # loudness of an album is the mean power of the songs on it that have been measured, weighted by their length, and its peak the highest of theirs.
+        rows = self.query('''SELECT UNIQUE_ID, DURATION, LOUDNESS, PEAK FROM SONGS WHERE ALBUM_ID = (SELECT ALBUM_ID FROM SONGS WHERE UNIQUE_ID = ?)
+AND LOUDNESS IS NOT NULL AND LOUDNESS_MTIME = MTIME''', [song_id])
+        if not rows:
+            return None, None
+        track = next(((i[2], i[3]) for i in rows if i[0] == song_id), None)
+        weights = [max(i[1], 1) for i in rows]
+        power = sum(weight * 10 ** (i[2] / 10) for weight, i in zip(weights, rows)) / sum(weights)
+        return track, (10 * math.log10(power), max(i[3] for i in rows))
+
+    def save_player_state(self, state):
+        self.query('INSERT OR REPLACE INTO PLAYER_STATE (NAME, VALUE) VALUES (?, ?)', ['player', json.dumps(state)])
+
+    def load_player_state(self):
+        # The state last saved by save_player_state(), or None.
+        result = self.query("SELECT VALUE FROM PLAYER_STATE WHERE NAME = 'player'")
+        return json.loads(result[0][0]) if result else None
     
-    def build_from(self, location):
-        # Here be dragons, to borrow the time-honored adage
+    def write_songs(self, results):
+        # The writing end of the library scan: consume (SongMetadata, unique ID) pairs, where the ID is None for new songs, and write them in batches. Albums are
+        # tracked in memory, by title and artist, rather than with a query per song. Rows are numbered in the order they arrive, so the IDs depend only on the order
+        # of the walk. Returns (MetadataContainer, artwork path) for each new album without artwork, for AppleDownloader.download_all().
+        albums = dict(((title, artist), uid) for title, artist, uid in self.query('SELECT TITLE, ARTIST, UNIQUE_ID FROM ALBUMS'))
+        missing_artwork = []
+        pending = []
+        for meta, song_id in results:
+            if meta is None:
+                continue  # unreadable file
+
+            pending.append((meta, song_id))
+            if len(pending) >= self.BATCH_SIZE:
+                self.flush_rows(albums, pending, missing_artwork)
+
+        self.flush_rows(albums, pending, missing_artwork)
+        return missing_artwork
+
+    def downloader(self):
+        return AppleDownloader(True, 1, DO_ARTWORK, cache_path=configuration.get('artwork-lookup-cache', CONFIGURATION_TEMPLATE['artwork-lookup-cache']),
+                               workers=configuration.get('artwork-download-workers', CONFIGURATION_TEMPLATE['artwork-download-workers']))
+
+    def render_artwork(self, jobs=1):
+        # Make the resized copies of every album's artwork (and the default artwork) that the albums and songs pages ask for; see thumbnails.py.
+        paths = [i[0] for i in self.query('SELECT ARTWORK FROM ALBUMS')] + [DEFAULT_ARTWORK]
+        artwork_cache().prerender(paths, jobs)
+
+    def flush_rows(self, albums, pending, missing_artwork):
+        # Write a batch of write_songs(): the albums that are new, then the songs. Each batch is its own transaction, unless the caller has wrapped the whole scan in
+        # one; the IDs of new albums are only known once they are written, so the song rows are put together here as well.
+        with self.transaction():
+            for meta, song_id in pending:
+                key = (meta.album, meta.artist)
+                if key in albums:
+                    continue
+                albums[key] = self.find_album_id(meta.album, meta.artist)  # another process may have added it since write_songs() began
+                if albums[key] is None:
+                    if not os.path.isfile(meta.artwork):
+                        log.debug('could not read cover art from metadata, will download from network')
+                        missing_artwork.append((MetadataContainer(meta.album, meta.artist), meta.artwork))
+                    albums[key] = self.create_album(meta.album, meta.artist, meta.genre, meta.year, artwork=meta.artwork)
+
+            song_rows = [self.song_row(meta.file, meta.title, albums[(meta.album, meta.artist)], meta.number, meta.length, meta.enctype, meta.size, meta.mtime,
+                                       meta.duration, meta.disc, meta.sample_rate, meta.bitrate) for meta, song_id in pending if song_id is None]
+            # Keep the unique ID of a changed file so that playlists and queues referring to it remain valid.
+            update_rows = [[meta.title, albums[(meta.album, meta.artist)], meta.number, meta.length, meta.enctype, self.sorting_title(meta.title), meta.size,
+                            meta.mtime, meta.duration, meta.disc, meta.sample_rate, meta.bitrate, song_id] for meta, song_id in pending if song_id is not None]
+            for command, rows in [(self.INSERT_SONG, song_rows), (self.UPDATE_SONG, update_rows)]:
+                if rows:
+                    self.query_many(command, rows)
+        pending.clear()
+
+    def delete_empty_albums(self, album_ids=None):
+        # Albums exist only by virtue of their songs; once the last one is gone, so is the album. Given the IDs of the albums that might have lost songs, only those
+        # are looked at, rather than every album.
+        if album_ids is None:
+            self.query('DELETE FROM ALBUMS WHERE UNIQUE_ID NOT IN (SELECT ALBUM_ID FROM SONGS)')
+        else:
+            self.query_many('DELETE FROM ALBUMS WHERE UNIQUE_ID = ? AND NOT EXISTS (SELECT 1 FROM SONGS WHERE ALBUM_ID = ?)', [(i, i) for i in album_ids])
+
+    def build_from(self, location, jobs=1):
+        # Drop everything and read the entire library again. This renumbers every song and album; use sync_from() to bring an existing database up to date.
+        # Tags are read by `jobs` worker processes while this process walks the library and writes the results.
         build_timer = time.time()
-        self.PAUSE_COMMIT = True
         log.info(location)
-        artists = os.listdir(location)
-        downloader = AppleDownloader(True, True, DO_ARTWORK)
         log.info('WILL REMOVE %s' % location)
-        
-        self.query('DROP TABLE SONGS')
-        self.query('DROP TABLE ALBUMS')
-        self.query(STRUCTURE_SONGS)
-        self.query(STRUCTURE_ALBUMS)
-        
-        for artist in artists:
-            log.debug('level 1: %s' % artist)
-            if os.path.isdir(location + artist):
-                albums = os.listdir(location + artist)
-                for album in albums:
-                    log.debug('level 2: %s' % album)
-                    if os.path.isdir(location + artist + '/' + album):
-                        songs = sorted(os.listdir(location + artist + '/' + album))
-                        song_index = 1  # used to assign track numbers if all else fails.
-                        for song in songs:
-                            log.info(song) 
-                            # MacOS X (presumably for Spotlight search indexing) creates files that have the exact same name- and thus, crucially, the same extension
-                             #that are prepended with ._. Should mutagen try to read these, it dies. Do this to prevent that unpleasant outcome.
-                            if song[0] == '.' and song[1] == '_':
-                                os.remove(location + artist + '/' + album + '/' + song)
-                                continue
-                            
-                            log.debug('level 3: %s' % song)
-                            encoding_type = os.path.splitext(song)[1]
-
-                            #APPLE M4A AAC IMPORT ENGINE
-                            if encoding_type.__contains__('m4a'): # song.__contains__('m4a'):
-                                # Song is an AAC MP4 audio file, process it accordingly
-                                song_file = mutagen.mp4.MP4(location + artist + '/' + album + '/' + song)  # mutagen.M4A is depreciated, use this as a replacement
-                                song_file.pprint()
-                                song_album = song_file.tags['\xa9alb'][0]
-                                try:
-                                    song_number = song_file.tags['TRCK']
-                                except KeyError:
-                                    # sometimes iTunes libraries will put this before the song name. We can't remove it, because there is a chance that it's not there, and some song titles consist only of numbers
-                                    # see "99" by Toto and "7" by Prince, for example.
-                                    song_number = song.split(' ')[0] 
-                                except TypeError:
-                                    song_number = song.split(' ')[0]
-
-                                for i in song_number:
-                                    if i not in '1234567890':  # non-numerical value
-                                        if song_index > 10:
-                                            song_number = str(song_index)
-                                        else:
-                                            song_number = '0' + str(song_index)
-                                            
-                                        break
-
-                                song_title = song_file.tags['\xa9nam'][0]
-                                # The _ operator in Python is used to denote hidden / preliminary things but also has some semantic meaning. This seems to work, however, and I really, really do not want to refactor it.
-                                _length = song_file.info.length
-                                _length_minutes = int(_length / 60)
-                                _length_seconds = int(_length % 60)
-                                if _length_seconds < 10:
-                                    # Add leading zero if needed
-                                    _length_seconds = '0{}'.format(_length_seconds)
-                                    
-                                song_length = str(_length_minutes) + ':' + str(_length_seconds)
-
-                                # If this album does not exist, create it
-                                if not self.search_albums(song_album):
-                                    album_artist = song_file.tags['\xa9ART'][0]
-                                    try:
-                                        album_year = song_file.tags['\xa9day'][0][
-                                            0:4]  # Only use the year, omit the rest of this timestamp.
-                                        album_genre = song_file.tags['\xa9gen'][0]
-                                    except KeyError:
-                                        album_year = '2021'  # This tag in particular has given me problems with KeyError
-                                        album_genre = 'Unknown Genre'
-                                    artwork_path = location + artist + '/' + album + '/' + 'artwork.jpg'
-                                    try:
-                                        album_cover = song_file.tags['covr']
-                                        try:
-                                            os.remove(artwork_path)  # Keep artwork up-to-date
-                                        except FileNotFoundError:
-                                            pass
-                                        except UnboundLocalError:
-                                            pass
-                                        fbuf = open(artwork_path, 'wb')
-                                        fbuf.write(album_cover[0])
-                                        
-                                        fbuf.flush()
-                                        fbuf.close()
-                                        
-                                    except KeyError:
-                                        log.error('could not read cover art from metadata, downloading from network')
-                                        meta = MetadataContainer(album, artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    self.create_album(song_album,
-                                                      album_artist,
-                                                      album_genre,
-                                                      album_year,
-                                                      artwork=artwork_path)
-                                if not self.check_if_song_exists(
-                                        location + artist + '/' + album + '/' + song):
-                                    self.create_song(location + artist + '/' + album + '/' + song,
-                                                     song_title,
-                                                     song_album,
-                                                     song_number,
-                                                     song_length,
-                                                     'MP4')
-                                else:
-                                    log.debug("song exists")
-
-                            # APPLE LOSSLESS (AIFF) IMPORT CODE
-                            elif encoding_type.__contains__('aif'):
-                                # Song is in Apple lossless format, process its tags accordingly.
-                                song_path = location + artist + '/' + album + '/' + song
-                                try:
-                                    song_file = mutagen.aiff.AIFF(song_path)
-                                except Exception as e:
-                                    log.error('failed to read :%s' % song, )
-                                    continue
-                                
-                                song_file.pprint()
-                                try:
-                                    song_album = song_file.tags['TALB'][0]
-                                except KeyError:
-                                    # If the album tag can't be read, use the folder name
-                                    song_album = album
-                                except TypeError:
-                                    # NoneType returned, not subscriptable
-                                    song_album = album
-
-
-                                if song_file.tags is None: continue
-                                
-                                try:
-                                    song_number = song_file.tags['TRCK']
-                                except KeyError:
-                                    song_number = song.split(' ')[0]
-
-                                for i in song_number:
-                                    if i not in '1234567890':  # non-numerical data
-                                        if song_index > 10:
-                                            song_number = str(song_index)
-                                        else:
-                                            song_number = '0' + str(song_index)
-                                            
-                                        break
-                                    
-                                try:
-                                    song_title = song_file.tags['TIT2'][0]
-                                except KeyError:
-                                    # If the title tag can't be read, use the filename without the extensions
-                                    song_title = os.path.splitext(song)[0]
-                                except TypeError:
-                                    # NoneType returned, not subscriptable
-                                    song_album = album
-
-                                _length = song_file.info.length
-                                _length_minutes = int(_length / 60)
-                                _length_seconds = int(_length % 60)
-                                if _length_seconds < 10:
-                                    _length_seconds = '0{}'.format(_length_seconds)
-
-                                song_length = str(_length_minutes) + ':' + str(_length_seconds)
-                                # If this album does not exist, create it
-                                if not self.search_albums(song_album):
-                                    artwork_path = location + artist + '/' + album + '/' + 'artwork.jpg'
-                                    try:
-                                        album_cover = song_file.tags['covr']
-                                        try:
-                                            os.remove(artwork_path)  # Keep artwork up-to-date
-                                        except FileNotFoundError:
-                                            pass
-                                        fbuf = open(artwork_path, 'wb')
-                                        fbuf.write(album_cover[0])
-                                        fbuf.flush()
-                                        fbuf.close()
-                                        
-                                    except KeyError:
-                                        log.error('could not read cover art from metadata, downloading from network')
-                                        if artist.lower() == 'compilations':  # Compilations directory from iTunes
-                                            _artist = 'Various Artists'
-                                        else:
-                                            _artist = artist
-
-                                        meta = MetadataContainer(album, _artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    except TypeError:
-                                        log.debug('could not read cover art from metadata, downloading from network')
-                                        meta = MetadataContainer(album, artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    try:
-                                        album_artist = song_file.tags['TOPE'][0]
-                                    except KeyError:
-                                        # If the album tag can't be read, use the name of the artist directory
-                                        album_artist = artist
-                                        if album_artist == 'Compilations':
-                                            # This is in the 'compilations' directory from iTunes. Make artist name 'Various Artists'
-                                            album_artist = 'Various Artists'
-
-                                    except TypeError:
-                                        album_artist = artist
-                                    try:
-                                        album_genre = song_file.tags[''][0]
-                                    except KeyError:
-                                        # album_year = '2021'  # This tag in particular has given me problems with KeyError
-                                        album_genre = 'Unknown Genre'
-                                    except TypeError:
-                                        # album_year = '2021'  # This tag in particular has given me problems with KeyError
-                                        album_genre = 'Unknown Genre'
-
-                                    try:
-                                        album_year = song_file.tags['TYER'][0]
-                                    except KeyError:
-                                        album_year = '2021'
-                                    except TypeError:
-                                        album_year = '2021'
-
-                                    self.create_album(song_album,
-                                                      album_artist,
-                                                      album_genre,
-                                                      album_year,
-                                                      artwork=artwork_path)
-                                    
-                                # if True: # self.check_if_song_exists(flac_path):
-                                self.create_song(song_path,  # Add FLAC file to database
-                                                 song_title,
-                                                 song_album,
-                                                 song_number,
-                                                 song_length,
-                                                 'AIFF'
-                                                 )
-
-                                # self.create_song(location + artist + '/' + album + '/' + song,
-                                # song_title, song_album, song_number, song_length)
-
-                            elif encoding_type.__contains__('flac'):
-                                # Song is a FLAC file, process it accordingly.
-                                try:
-                                    song_file = mutagen.aiff.AIFF(
-                                        location + artist + '/' + album + '/' + song)
-                                except Exception:
-                                    # bind to Exception because a broad array of errors can occur and none of them really matter.
-                                    log.error('failed to read :%s' % song, )
-                                    continue
-                                
-                                song_file.pprint()
-                                try:
-                                    song_album = song_file.tags['TALB'][0]
-                                except KeyError:
-                                    # If the album tag can't be read, use the folder name
-                                    song_album = album
-                                except TypeError:
-                                    # NoneType returned, not subscriptable
-                                    song_album = album
-
-                                song_number = song.split(' ')[0]
-                                if song_number[0] == '0':
-                                    song_number = song_number[1]
-                                    
-                                try:
-                                    song_title = song_file.tags['TIT2'][0]
-                                except KeyError:
-                                    # If the title tag can't be read, use the filename without the extensions
-                                    song_title = os.path.splitext(song)[0]
-                                except TypeError:
-                                    # NoneType returned, not subscriptable
-                                    song_album = album
-
-                                _length = song_file.info.length
-                                _length_minutes = int(_length / 60)
-                                _length_seconds = int(_length % 60)
-                                if _length_seconds < 10:
-                                    # Add leading zero if needed
-                                    _length_seconds = '0{}'.format(_length_seconds)
-                                    
-                                song_length = str(_length_minutes) + ':' + str(_length_seconds)
-                                # If this album does not exist, create it
-                                if not self.search_albums(song_album):
-                                    artwork_path = location + artist + '/' + album + '/' + 'artwork.jpg'
-                                    try:
-                                        album_cover = song_file.tags['covr']
-                                        try:
-                                            os.remove(artwork_path)  # Keep artwork up-to-date
-                                        except FileNotFoundError:
-                                            pass
-                                        fbuf = open(artwork_path, 'wb')
-                                        fbuf.write(album_cover[0])
-                                        
-                                        fbuf.flush()
-                                        fbuf.close()
-
-                                    except KeyError:
-                                        log.debug('could not read cover art from metadata, downloading from network')
-                                        if artist.lower() == 'compilations':  # Compilations directory from iTunes
-                                            _artist = 'Various Artists'
-                                        else:
-                                            _artist = artist
-
-                                        meta = MetadataContainer(album, _artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    except TypeError:
-                                        log.debug('could not read cover art from metadata, downloading from network')
-                                        meta = MetadataContainer(album, artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    try:
-                                        album_artist = song_file.tags['TOPE'][0]
-                                    except KeyError:
-                                        # If the album tag can't be read, use the name of the artist directory
-                                        album_artist = artist
-                                        if album_artist == 'Compilations':
-                                            # This is in the 'compilations' directory from iTunes. Make artist name 'Various Artists'
-                                            album_artist = 'Various Artists'
-
-                                    except TypeError:
-                                        album_artist = artist
-                                    try:
-                                        album_genre = song_file.tags[''][0]
-                                    except KeyError:
-                                        # album_year = '2021'  # This tag in particular has given me problems with KeyError
-                                        album_genre = 'Unknown Genre'
-                                    except TypeError:
-                                        # album_year = '2021'  # This tag in particular has given me problems with KeyError
-                                        album_genre = 'Unknown Genre'
-
-                                    try:
-                                        album_year = song_file.tags['TYER'][0]
-                                    except KeyError:
-                                        album_year = '2021'
-                                    except TypeError:
-                                        album_year = '2021'
-
-                                    self.create_album(song_album,
-                                                      album_artist,
-                                                      album_genre,
-                                                      album_year,
-                                                      artwork=artwork_path
-                                                      )
-
-                                self.create_song(location + artist + '/' + album + '/' + song,
-                                                 song_title,
-                                                 song_album,
-                                                 song_number,
-                                                 song_length,
-                                                 'FLAC'
-                                                 )
-
-                            # MPEG-3 AUDIO IMPORT CODE
-                            elif encoding_type.__contains__('mp3'):
-                                # Song is an MP3 file, process it accordingly
-                                try:
-                                    song_file = mutagen.mp3.MP3(location + artist + '/' + album + '/' + song)
-
-                                except Exception as e:
-                                    log.error('failed to read :%s' % song, )
-                                    continue
-
-                                song_file.pprint()
-                                try:
-                                    song_album = song_file.tags['TALB'][0]
-                                except KeyError:
-                                    # If the album tag can't be read, use the folder name
-                                    song_album = album
-                                except TypeError:
-                                    # NoneType returned, not subscriptable
-                                    song_album = album
-
-                                try:
-                                    song_number = song_file.tags['TRCK']
-                                finally:
-                                    song_number = song.split(' ')[0]
-
-                                for i in song_number:
-                                    if i not in '1234567890':  # non-numerical data is not a valid track number
-                                        if song_index > 10:
-                                            song_number = str(song_index)
-                                        else:
-                                            song_number = '0' + str(song_index)
-                                        break
-                                    
-                                try:
-                                    song_title = song_file.tags['TIT2'][0]
-                                except KeyError:
-                                    # If the title tag can't be read, use the filename without the extensions
-                                    song_title = os.path.splitext(song)[0]
-                                except TypeError:
-                                    # NoneType returned, not subscriptable
-                                    song_album = album
-
-                                _length = song_file.info.length
-                                _length_minutes = int(_length / 60)
-                                _length_seconds = int(_length % 60)
-                                if _length_seconds < 10:
-                                    _length_seconds = '0%s' % str(_length_seconds)
-                                    
-                                song_length = str(_length_minutes) + ':' + str(_length_seconds)
-                                # If this album does not exist, create it
-                                if not self.search_albums(song_album):
-                                    artwork_path = location + artist + '/' + album + '/' + 'artwork.jpg'
-                                    try:
-                                        album_cover = song_file.tags['covr']
-                                        try:
-                                            os.remove(artwork_path)  # Keep artwork up-to-date
-                                        except FileNotFoundError:
-                                            pass
-                                        fbuf = open(artwork_path, 'wb')
-                                        fbuf.write(album_cover[0])
-                                        log.info('cover data: %s' % album_cover)
-                                        fbuf.flush()
-                                        fbuf.close()
-                                    except KeyError:
-                                        log.debug('could not read cover art from metadata, downloading from network')
-                                        
-                                        if artist.lower() == 'compilations':  # Compilations directory from iTunes
-                                            _artist = 'Various Artists'
-                                        else:
-                                            _artist = artist
-
-                                        meta = MetadataContainer(album, _artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    except TypeError:
-                                        log.info('could not read cover art from metadata, downloading from network')
-                                        meta = MetadataContainer(album, artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    try:
-                                        album_artist = song_file.tags['TOPE'][0]
-                                    except KeyError:
-                                        # If the album tag can't be read, use the name of the artist directory
-                                        album_artist = artist
-                                        if album_artist == 'Compilations':
-                                            # This is in the 'compilations' directory from iTunes. Make artist name 'Various Artists'
-                                            album_artist = 'Various Artists'
-
-                                    except TypeError:
-                                        album_artist = artist
-                                    try:
-                                        album_genre = song_file.tags[''][0]
-                                    except KeyError:
-                                        # album_year = '2021'  # This tag in particular has given me problems with KeyError
-                                        album_genre = 'Unknown Genre'
-                                    except TypeError:
-                                        # album_year = '2021'  # This tag in particular has given me problems with KeyError
-                                        album_genre = 'Unknown Genre'
-
-                                    try:
-                                        album_year = song_file.tags['TYER'][0]
-                                    except KeyError:
-                                        album_year = '2021'
-                                    except TypeError:
-                                        album_year = '2021'
-
-                                    self.create_album(song_album,
-                                                      album_artist,
-                                                      album_genre,
-                                                      album_year,
-                                                      artwork=artwork_path
-                                                      )
-
-                                self.create_song(location + artist + '/' + album + '/' + song,
-                                                 song_title,
-                                                 song_album,
-                                                 song_number,
-                                                 song_length,
-                                                 'MP3'
-                                                 )
-
-                            # WAVE AUDIO IMPORT CODE
-                            elif encoding_type.__contains__('wav'):
-                                # WAV files don't have portable metadata. Just use file names etc.
-                                song_title = os.path.splitext(song)[0]
-                                song_number = song.split(' ')[0]
-                                for i in song_number:  # non-numerical value
-                                    if i not in '1234567890':
-                                        if song_index > 10:
-                                            song_number = str(song_index)
-                                        else:
-                                            song_number = '0' + str(song_index)
-                                        break
-                                    
-                                song_album = album
-                                song_file = mutagen.wave.WAVE(
-                                    location + artist + '/' + album + '/' + song)
-
-                                # Control for track numbers that contain leading zeroes
-                                if song_number[0] == '0' and len(song_number) > 1:
-                                    song_number = song_number[1]
-
-                                _length = song_file.info.length
-                                _length_minutes = int(_length / 60)
-                                _length_seconds = int(_length % 60)
-                                if _length_seconds < 10:
-                                    # Append leading zero if required
-                                    _length_seconds = '0{}'.format(_length_seconds)
-                                    
-                                song_length = str(_length_minutes) + ':' + str(_length_seconds)
-
-                                if not self.search_albums(song_album):
-                                    artwork_path = location + artist + '/' + album + '/' + 'artwork.jpg'
-                                    try:
-                                        album_cover = song_file.tags['covr']
-                                        try:
-                                            os.remove(artwork_path)  # Keep artwork up-to-date
-                                        except FileNotFoundError:
-                                            pass
-                                        fbuf = open(artwork_path, 'wb')
-                                        fbuf.write(album_cover[0])
-                                        log.info('cover data: %s' % album_cover)
-                                        fbuf.flush()
-                                        fbuf.close()
-                                    except KeyError:
-                                        log.debug('could not read cover art from metadata, downloading from network')
-                                        meta = MetadataContainer(album, artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    except TypeError:
-                                        log.info('could not read cover art from metadata, downloading from network')
-                                        meta = MetadataContainer(album, artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    album_title = album
-                                    album_year = '2021'
-                                    album_genre = 'Unknown Genre'
-                                    album_artist = artist
-                                    self.create_album(song_album,
-                                                      album_artist,
-                                                      album_genre,
-                                                      album_year,
-                                                      artwork=artwork_path
-                                                      )
-
-                                self.create_song(location + artist + '/' + album + '/' + song,
-                                                 song_title,
-                                                 song_album,
-                                                 song_number,
-                                                 song_length,
-                                                 'WAVE'
-                                                 )
-                                
-                            # OGG CONTAINER IMPORT CODE
-                            elif encoding_type.__contains__('ogg'):
-                                # Song is an  OGG audio file, process it accordingly
-                                song_file = mutagen.ogg.OggFileType(
-                                    location + artist + '/' + album + '/' + song)
-                                song_file.pprint()
-                                song_album = song_file.tags['\xa9alb'][0]
-                                try:
-                                    song_number = song_file.tags['TRCK']
-                                except KeyError:
-                                    song_number = song.split(' ')[0]
-
-                                for i in song_number:
-                                    if i not in '1234567890':
-                                        if song_index > 10:
-                                            song_number = str(song_index)
-                                        else:
-                                            song_number = '0' + str(song_index)
-                                        break
-                                
-                                song_title = song_file.tags['\xa9nam'][0]
-                                _length = song_file.info.length
-                                _length_minutes = int(_length / 60)
-                                _length_seconds = int(_length % 60)
-                                if _length_seconds < 10:
-                                    # Add leading zero if needed
-                                    _length_seconds = '0{}'.format(_length_seconds)
-                                    
-                                song_length = str(_length_minutes) + ':' + str(_length_seconds)
-
-                                # If this album does not exist, create it
-                                if not self.search_albums(song_album):
-                                    album_artist = song_file.tags['\xa9ART'][0]
-                                    try:
-                                        album_year = song_file.tags['\xa9day'][0][
-                                            0:4]  # Only use the year, omit the rest of this timestamp.
-                                        album_genre = song_file.tags['\xa9gen'][0]
-                                    except KeyError:
-                                        album_year = '2021'  # This tag in particular has given me problems with KeyError
-                                        album_genre = 'Unknown Genre'
-                                    artwork_path = location + artist + '/' + album + '/' + 'artwork.jpg'
-                                    try:
-                                        album_cover = song_file.tags['covr']
-                                        try:
-                                            os.remove(artwork_path)  # Keep artwork up-to-date
-                                        except FileNotFoundError:
-                                            pass
-                                        except UnboundLocalError:
-                                            pass
-                                        fbuf = open(artwork_path, 'wb')
-                                        fbuf.write(album_cover[0])
-
-                                        fbuf.flush()
-                                        fbuf.close()
-                                        
-                                    except KeyError:
-                                        log.error('could not read cover art from metadata, downloading from network')
-                                        meta = MetadataContainer(album, artist)
-                                        downloader.download(meta, artwork_path)
-
-                                    self.create_album(song_album,
-                                                      album_artist,
-                                                      album_genre,
-                                                      album_year,
-                                                      artwork=artwork_path)
-                                if not self.check_if_song_exists(
-                                        location + artist + '/' + album + '/' + song):
-                                    self.create_song(location + artist + '/' + album + '/' + song,
-                                                     song_title,
-                                                     song_album,
-                                                     song_number,
-                                                     song_length,
-                                                     'OGG')
-                                else:
-                                    log.debug("song exists")
-
-                                # end conditional which checks whether the album exists (col 32)
-                            # end conditional to select codec (col 28)
-                            song_index+= 1
-                        #end for loop for songs (col 24)
-                    # end conditional to check whether the album is a directory (col 20)
-                # end for loop for albums (col 16)
-            # end conditional confirming that artist is a directory (col 12)
-        # end for loop for artists (col 8)
-        self.PAUSE_COMMIT = False
-        self.commit()
 
+        # All in one transaction: anything reading the database meanwhile (webstereo.py, say) goes on seeing the old library until the new one is complete.
+        with self.transaction():
+            self.query('DROP TABLE SONGS')
+            self.query('DROP TABLE ALBUMS')
+            self.query('DROP TABLE IF EXISTS SONGS_FTS')
+            self.query('DROP TABLE IF EXISTS ALBUMS_FTS')
+            self.query('DELETE FROM PLAY_QUEUE')  # the IDs in these will refer to different songs, or none
+            self.query('DELETE FROM PLAYER_STATE')
+            self.query(STRUCTURE_SONGS)
+            self.query(STRUCTURE_ALBUMS)
+
+            entries = ((location, artist, album, song, song_index) for artist, album, song, song_index in walk_library(location))
+            missing_artwork = self.write_songs(((meta, None) for meta in read_library_files(entries, jobs)))
+            self.create_indexes()  # cheaper to build once the tables are full than to maintain during the build
+            self.create_search_index()  # likewise
+            self.rebuild_statistics()  # likewise; the triggers went with the old tables
+
+        # Downloading artwork takes a while, and needs nothing from the database, so it is left until the transaction is over.
+        self.downloader().download_all(missing_artwork)
+        self.render_artwork(jobs)
         build_time = int(time.time() - build_timer)
-        print('Done in: ', build_time / 3600, ':', (build_time % 3600) / 60, ':', build_time % 60)
+        print('Done in: ', build_time // 3600, ':', (build_time % 3600) // 60, ':', build_time % 60)
+
+    def sync_from(self, location, jobs=1):
+        # Incremental counterpart to build_from(): only files that are new or whose size or modification time has changed are read again, and songs whose files
+        # have disappeared are deleted. Everything else, unique IDs included, is left alone.
+        build_timer = time.time()
+        pending, removed = self.apply_sync(location, walk_library(location), self.known_files(), jobs)
+        self.render_artwork(jobs)  # only artwork that is new or has changed is actually resized
+        changed = len([i for i in pending if i[1] is not None])
+        print('%d added, %d changed, %d removed in %d seconds' % (len(pending) - changed, changed, removed, int(time.time() - build_timer)))
+
+    def sync_directories(self, location, directories, jobs=1):
+        # sync_from() for part of the library: directories are (artist,) or (artist, album) tuples, relative to location, or () for the whole library. Only the files
+        # in them are looked at, and songs under them whose files are gone are deleted - all of them, if the folder itself is gone. Used by watcher.py.
+        # Returns the number of songs added, changed and removed.
+        directories = set(directories)
+        known = {}
+        walks = []
+        for directory in sorted(directories):
+            if any(directory[:i] in directories for i in range(len(directory))):
+                continue  # covered by a folder further up
+            known.update(self.known_files(location + ''.join(i + '/' for i in directory)))
+            if len(directory) == 2:
+                walks.append(walk_album(location, *directory))
+            else:
+                walks.append(walk_library(location, directory or None))
+
+        album_ids = set(i[3] for i in known.values())  # albums that might be left empty by songs being moved or deleted
+        pending, removed = self.apply_sync(location, itertools.chain(*walks), known, jobs, album_ids)
+        album_paths = set(location + artist + '/' + album for (location, artist, album, song, song_index), uid in pending)
+        artwork_cache().prerender([i + '/artwork.jpg' for i in album_paths], jobs)
+        changed = len([i for i in pending if i[1] is not None])
+        return len(pending) - changed, changed, removed
+
+    def known_files(self, prefix=''):
+        # {file: (size, mtime, unique ID, album ID)} for every song whose file is under prefix. FILE is indexed, so a range query finds them without a full scan.
+        if not prefix:
+            rows = self.query('SELECT FILE, SIZE, MTIME, UNIQUE_ID, ALBUM_ID FROM SONGS')
+        else:
+            rows = self.query('SELECT FILE, SIZE, MTIME, UNIQUE_ID, ALBUM_ID FROM SONGS WHERE FILE >= ? AND FILE < ?', [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def apply_sync(self, location, walk, known, jobs=1, album_ids=None):
+        # The common part of sync_from() and sync_directories(): read the files in walk that are not in known, or whose size or modification time has changed, and
+        # delete the songs in known whose files were not found in walk; see delete_empty_albums() for album_ids. Returns the files read, as (library entry,
+        # existing unique ID or None) pairs, and the number of songs deleted.
+        known = dict(known)
+        pending = []  # files to read, along with the unique ID they already have, if any
+        for artist, album, song, song_index in walk:
+            path = location + artist + '/' + album + '/' + song
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # vanished while walking
+
+            previous = known.pop(path, None)
+            if previous and previous[0] == stat.st_size and previous[1] == int(stat.st_mtime):
+                continue  # unchanged
+
+            log.info('%s %s' % ('updating' if previous else 'adding', path))
+            pending.append(((location, artist, album, song, song_index), previous[2] if previous else None))
+
+        entries = (i[0] for i in pending)
+        missing_artwork = self.write_songs(zip(read_library_files(entries, jobs), (i[1] for i in pending)))
+
+        # Anything left in known was not found on disk.
+        with self.transaction():
+            for path, (size, mtime, uid, album_id) in known.items():
+                log.info('removing %s' % path)
+                self.query('DELETE FROM SONGS WHERE UNIQUE_ID = ?', [uid])
+
+            self.delete_empty_albums(album_ids)
+
+        self.downloader().download_all(missing_artwork)
+        return pending, len(known)
 
 def check_valid_password(password):
     #global PASSWORD
@@ -1071,6 +1410,158 @@ def check_valid_password(password):
         log.info('invalid password')
         return False
 
+# Schema migrations, in order. Each one takes an existing database from the previous version to the next. They describe the schema as it was at the time, so they do
+# not refer to the STRUCTURE_ constants above, which may since have changed.
+
+def migrate_primary_keys(db):
+    # Make UNIQUE_ID the primary key of SONGS and ALBUMS, so that lookups by ID no longer scan the whole table. This also adds SIZE and MTIME to databases
+    # created before sync_from() existed.
+    db.rebuild_table('ALBUMS', '''
+CREATE TABLE ALBUMS(
+TITLE TEXT NOT NULL,
+ARTIST TEXT NOT NULL,
+GENRE TEXT NOT NULL,
+ARTWORK TEXT NOT NULL,
+YEAR TEXT NOT NULL,
+UNIQUE_ID INTEGER PRIMARY KEY,
+ARTIST_SORTED TEXT NOT NULL)
+''')
+    # ARTIST_SORTED was never lowercased, so 'The ' was never actually stripped from it.
+    db.query_many('UPDATE ALBUMS SET ARTIST_SORTED = ? WHERE UNIQUE_ID = ?', [[db.sorting_title(i[1]), i[0]] for i in db.query('SELECT UNIQUE_ID, ARTIST FROM ALBUMS')])
+    db.rebuild_table('SONGS', '''
+CREATE TABLE SONGS(
+FILE TEXT NOT NULL,
+TITLE TEXT NOT NULL,
+ALBUM TEXT NOT NULL,
+NUMBER TEXT NOT NULL,
+LENGTH TEXT NOT NULL,
+ENCTYPE TEXT NOT NULL,
+UNIQUE_ID INTEGER PRIMARY KEY,
+SORTING TEXT NOT NULL,
+SIZE INTEGER NOT NULL DEFAULT 0,
+MTIME INTEGER NOT NULL DEFAULT 0)
+''')
+
+
+def migrate_album_ids(db):
+    # Songs used to refer to their album by title, which meant a query per song whenever the album's ID was needed and orphaned every song on an album that was renamed.
+    # Replace the title with the album's ID. Songs whose album cannot be found could never be displayed, and are dropped.
+    db.query('ALTER TABLE SONGS ADD COLUMN ALBUM_ID INTEGER')
+    db.query('UPDATE SONGS SET ALBUM_ID = (SELECT MIN(ALBUMS.UNIQUE_ID) FROM ALBUMS WHERE ALBUMS.TITLE = SONGS.ALBUM)')
+    db.rebuild_table('SONGS', '''
+CREATE TABLE SONGS(
+FILE TEXT NOT NULL,
+TITLE TEXT NOT NULL,
+ALBUM_ID INTEGER NOT NULL REFERENCES ALBUMS(UNIQUE_ID),
+NUMBER TEXT NOT NULL,
+LENGTH TEXT NOT NULL,
+ENCTYPE TEXT NOT NULL,
+UNIQUE_ID INTEGER PRIMARY KEY,
+SORTING TEXT NOT NULL,
+SIZE INTEGER NOT NULL DEFAULT 0,
+MTIME INTEGER NOT NULL DEFAULT 0)
+''')
+
+
+def migrate_playlist_items(db):
+    # Playlists used to keep their contents in a CONTENTS column, as song IDs separated by tabs. Give each playlist an ID and move its contents into PLAYLIST_ITEMS,
+    # one row per entry. Entries for songs that no longer exist are dropped, as they could never be shown.
+    old_playlists = db.query('SELECT NAME, CONTENTS FROM PLAYLISTS ORDER BY MODIFIED_TIME')
+    db.rebuild_table('PLAYLISTS', '''
+CREATE TABLE PLAYLISTS(
+NAME TEXT NOT NULL UNIQUE,
+UNIQUE_ID INTEGER PRIMARY KEY,
+MODIFIED_TIME INTEGER NOT NULL)
+''')
+    db.query('''
+CREATE TABLE PLAYLIST_ITEMS(
+PLAYLIST_ID INTEGER NOT NULL REFERENCES PLAYLISTS(UNIQUE_ID),
+POSITION INTEGER NOT NULL,
+SONG_ID INTEGER NOT NULL REFERENCES SONGS(UNIQUE_ID),
+PRIMARY KEY (PLAYLIST_ID, POSITION)) WITHOUT ROWID
+''')
+    positions = {}  # playlists with the same name are merged; rebuild_table() keeps only one of them
+    rows = []
+    for name, contents in old_playlists:
+        playlist_id = db.playlist_id(name)
+        for song_id in [i for i in contents.split('\t') if i.isdigit()]:
+            positions[playlist_id] = positions.get(playlist_id, 0) + PLAYLIST_POSITION_STEP
+            rows.append([playlist_id, positions[playlist_id], int(song_id)])
+    db.query_many('INSERT INTO PLAYLIST_ITEMS (PLAYLIST_ID, POSITION, SONG_ID) VALUES (?, ?, ?)', rows)
+    db.query('DELETE FROM PLAYLIST_ITEMS WHERE SONG_ID NOT IN (SELECT UNIQUE_ID FROM SONGS)')
+
+
+def migrate_play_queue(db):
+    # The play queue and the player's state used to be kept only in memory.
+    db.query(STRUCTURE_PLAY_QUEUE)
+    db.query(STRUCTURE_PLAYER_STATE)
+
+
+def migrate_library_statistics(db):
+    # Song lengths used to be kept only as m:ss text. The statistics themselves are filled in by WebStereoDB.migrate() once the triggers are in place.
+    db.query('ALTER TABLE SONGS ADD COLUMN DURATION INTEGER NOT NULL DEFAULT 0')
+    db.query('''UPDATE SONGS SET DURATION = 1000 * (CAST(substr(LENGTH, 1, instr(LENGTH, ':') - 1) AS INTEGER) * 60
++ CAST(substr(LENGTH, instr(LENGTH, ':') + 1) AS INTEGER))''')
+    db.query('''
+CREATE TABLE LIBRARY_STATISTICS(
+KIND TEXT NOT NULL,
+NAME TEXT NOT NULL,
+SONGS INTEGER NOT NULL DEFAULT 0,
+ALBUMS INTEGER NOT NULL DEFAULT 0,
+DURATION INTEGER NOT NULL DEFAULT 0,
+PRIMARY KEY (KIND, NAME)) WITHOUT ROWID
+''')
+
+
+def migrate_typed_song_columns(db):
+    # Track numbers used to be zero-padded text, so that they would sort as numbers; the copy into an INTEGER column turns them into numbers. Disc numbers, sample
+    # rates and bitrates are new, and can only be had from the files themselves: clearing MTIME makes the next sync read every file again.
+    db.rebuild_table('SONGS', '''
+CREATE TABLE SONGS(
+FILE TEXT NOT NULL,
+TITLE TEXT NOT NULL,
+ALBUM_ID INTEGER NOT NULL REFERENCES ALBUMS(UNIQUE_ID),
+NUMBER INTEGER NOT NULL DEFAULT 0,
+LENGTH TEXT NOT NULL,
+ENCTYPE TEXT NOT NULL,
+UNIQUE_ID INTEGER PRIMARY KEY,
+SORTING TEXT NOT NULL,
+SIZE INTEGER NOT NULL DEFAULT 0,
+MTIME INTEGER NOT NULL DEFAULT 0,
+DURATION INTEGER NOT NULL DEFAULT 0,
+DISC INTEGER NOT NULL DEFAULT 1,
+SAMPLE_RATE INTEGER NOT NULL DEFAULT 0,
+BITRATE INTEGER NOT NULL DEFAULT 0)
+''')
+    db.query("UPDATE SONGS SET NUMBER = CAST(NUMBER AS INTEGER) WHERE typeof(NUMBER) != 'integer'")  # anything that wasn't a number at all
+    db.query('UPDATE SONGS SET MTIME = 0')
+
+
+def migrate_loudness(db):
+    # Loudness is new, and is measured in the background by loudness.py; a NULL LOUDNESS_MTIME means that a song has yet to be.
+    db.query('ALTER TABLE SONGS ADD COLUMN LOUDNESS REAL')
+    db.query('ALTER TABLE SONGS ADD COLUMN PEAK REAL')
+    db.query('ALTER TABLE SONGS ADD COLUMN LOUDNESS_MTIME INTEGER')
+
+
+def migrate_album_keys(db):
+    # Albums used to be told apart by title alone, so albums of the same name by different artists were merged into one. Key them on title and artist instead:
+    # merge those that share both, which are the same album, and back the key with a unique index. Clearing SIZE (but not MTIME, which would have loudness.py
+    # measure every song again) makes the next sync read every file again, which splits up the albums that were merged.
+    duplicates = '''(SELECT UNIQUE_ID FROM ALBUMS WHERE EXISTS
+(SELECT 1 FROM ALBUMS AS OTHER WHERE OTHER.TITLE = ALBUMS.TITLE AND OTHER.ARTIST = ALBUMS.ARTIST AND OTHER.UNIQUE_ID < ALBUMS.UNIQUE_ID))'''
+    db.query('''UPDATE SONGS SET ALBUM_ID = (SELECT MIN(OTHER.UNIQUE_ID) FROM ALBUMS JOIN ALBUMS AS OTHER ON OTHER.TITLE = ALBUMS.TITLE AND OTHER.ARTIST = ALBUMS.ARTIST
+WHERE ALBUMS.UNIQUE_ID = SONGS.ALBUM_ID) WHERE ALBUM_ID IN %s''' % duplicates)
+    db.query('DELETE FROM ALBUMS WHERE UNIQUE_ID IN %s' % duplicates)
+    db.query('DROP INDEX IF EXISTS ALBUMS_TITLE')
+    db.query('CREATE UNIQUE INDEX ALBUMS_TITLE_ARTIST ON ALBUMS(TITLE, ARTIST)')
+    db.query('UPDATE SONGS SET SIZE = -1')
+
+
+MIGRATIONS = [migrate_primary_keys, migrate_album_ids, migrate_playlist_items, migrate_play_queue, migrate_library_statistics, migrate_typed_song_columns,
+              migrate_loudness, migrate_album_keys]
+
+
 CONFIGURATION_TEMPLATE = {
     "authenticate": True,
     "host": "0.0.0.0",
@@ -1088,40 +1579,89 @@ CONFIGURATION_TEMPLATE = {
     "library-path": "/path/somewhere",
     "db-path": "media.db",
     "artwork_size": 200,
+    "thumbnail-sizes": [50, 150, 512],
+    "artwork-cache-path": "artwork-cache",
+    "artwork-lookup-cache": "artwork-lookups.json",
+    "artwork-download-workers": 4,
+    "transcode-cache-path": "transcode-cache",
+    "transcode-cache-size": 2048,
+    "transcode-bitrate": 128,
+    "use-x-sendfile": False,
+    "public-metrics": False,
     "default_page": "songs_page",
     "prev-queue-limit": 10,
+    "resume-playback": False,
+    "player-state-interval": 5,
+    "page-size": 100,
+    "watch-library": False,
+    "watch-debounce": 2,
+    "watch-poll-interval": 30,
+    "analyze-loudness": False,
+    "loudness-jobs": 1,
+    "normalize-loudness": "album",
+    "loudness-target": -18,
+    "server-threads": 16,
     "DO NOT EDIT BELOW THIS LINE": True,
     "password-hash": ""
 }
 
+DEFAULT_ARTWORK = 'static/default-artwork.jpg'
+
+
+def artwork_cache():
+    # Resized artwork is made at each of the thumbnail sizes and at the size of the covers on the albums page.
+    sizes = configuration.get('thumbnail-sizes', CONFIGURATION_TEMPLATE['thumbnail-sizes']) + [configuration['artwork_size']]
+    return ArtworkCache(configuration.get('artwork-cache-path', CONFIGURATION_TEMPLATE['artwork-cache-path']), sizes)
+
+
+def transcode_cache():
+    # The cache size is configured in megabytes; 0 means no limit.
+    size = configuration.get('transcode-cache-size', CONFIGURATION_TEMPLATE['transcode-cache-size'])
+    return TranscodeCache(configuration.get('transcode-cache-path', CONFIGURATION_TEMPLATE['transcode-cache-path']), size * 1024 * 1024)
+
+
 def write_configuration_file():
     with open('config.json', 'w') as f:
         json.dump(configuration, f, indent=2)
 
 def reset_configuration_file():
+    global configuration
     if os.path.exists('config.json'):
         os.remove('config.json')
         
     with open('config.json', 'x') as f:
          json.dump(CONFIGURATION_TEMPLATE, f, indent=2)
          
-    #configuration = CONFIGURATION_TEMPLATE
+    configuration = dict(CONFIGURATION_TEMPLATE)
+
+
+def load_configuration(path='config.json'):
+    # Read config.json into configuration, with anything missing from it taken from CONFIGURATION_TEMPLATE. Importing this module doesn't do this; whatever starts
+    # webstereo does (webstereo.create_app(), data.py itself, watcher.py), and WebStereoDB() does if nothing has yet. Nothing is written: without a config.json the
+    # defaults are used as they are, and data.py -c writes them out.
+    global configuration, VALID_PASSWORD, DB_PATH
+    loaded = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            loaded = json.loads(f.read())
+    else:
+        log.warning('%s not found; using the default configuration. Create one with data.py -c' % path)
+    configuration = dict(CONFIGURATION_TEMPLATE)
+    configuration.update(loaded)
+    VALID_PASSWORD = configuration['password-hash']
+    DB_PATH = configuration['db-path']
+    return configuration
 
 
-# Initialize module and application
-if os.path.exists('config.json'):
-    with open('config.json', 'r') as f:
-        configuration = json.loads(f.read())
-else:
-   reset_configuration_file()
+def check_password_set():
+    # Authentication without a password would let nobody in, so refuse to start; see -p.
+    if configuration['authenticate'] and configuration['password-hash'] == '':
+        sys.stderr.write('Authentication is enabled but no password is set. Please set a password using this script with the -p option.')
+        raise SystemExit
 
-try:
-    VALID_PASSWORD = configuration['password-hash']
-except KeyError:
-    if configuration['authenticate']:
-        raise RuntimeError('Authentication is enabled but no password has been set. Please set a password using the -p option')
-    
-DB_PATH = configuration['db-path']
+
+VALID_PASSWORD = ''
+DB_PATH = CONFIGURATION_TEMPLATE['db-path']
 
 USAGE='''
 Usage: python3 data.py [OPTIONS]
@@ -1147,16 +1687,34 @@ Usage: python3 data.py [OPTIONS]
         and the model of its library reflects that: it expects that you have audio files inside folders for
         each album, inside folders for each artist. Cover art will be fetched from the iTunes store. Currently,
         the following audio formats are supported: MP3, MP4 (AAC/M4A), AIFF, WAV (without portable metadata),
-        and FLAC.
+        and FLAC. This renumbers every song and album, which will scramble existing playlists, and empties the play queue; use -s for an existing database.
+        Resized copies of the artwork are made at the sizes in thumbnail-sizes and artwork_size, and kept in artwork-cache-path.
+-s, --sync-db:
+        This will bring the database up to date with the library without rebuilding it: files that are new or have changed
+        since the last build or sync are read, and songs whose files have been removed are deleted. Song and album IDs are
+        preserved, so playlists remain valid.
 -a, --artwork
-        This option, when used with -b, will enable the downloading of artwork from iTunes.
+        This option, when used with -b or -s, will enable the downloading of artwork from iTunes. The result of every search
+        is kept in artwork-lookup-cache, so albums already searched for are not searched for again.
+-j, --jobs [N]
+        This option, when used with -b or -s, sets the number of processes used to read metadata from audio files.
+        It defaults to the number of CPUs.
 
 All of the above commands assume that you are in the same directory as the application file. If that is not the case, unpleasant side effects may result.
 
 (C) 2022 Robert Ryder
 '''
 
+def jobs_option():
+    # Number of tag-reading processes for -b and -s, given as --jobs N or -j N.
+    for i in ['--jobs', '-j']:
+        if i in sys.argv:
+            return max(1, int(sys.argv[sys.argv.index(i) + 1]))
+    return os.cpu_count() or 1
+
+
 if __name__ == '__main__':
+    load_configuration()
     db = WebStereoDB(DB_PATH)
     if len(sys.argv) < 2:
         print('Unsupported usage. Use with --usage or --help to view usage.')
@@ -1198,7 +1756,14 @@ if __name__ == '__main__':
                 DO_ARTWORK = True  # download artwork
 
             print('building database')
-            db.build_from(configuration['library-path'])
+            db.build_from(configuration['library-path'], jobs=jobs_option())
+
+        elif sys.argv[1] in ['--sync-db', '-s']:
+            if '-a' in sys.argv:
+                DO_ARTWORK = True
+
+            print('synchronizing database')
+            db.sync_from(configuration['library-path'], jobs=jobs_option())
 
         elif sys.argv[1] == '--usage' or sys.argv[1] == '--help' or sys.argv[1] == '-h':
             # Print usage message
@@ -1213,7 +1778,5 @@ if __name__ == '__main__':
         # Either an unknown option (ValueError) or missing parameters (IndexError)
         print('Malformed arguments. See usage with --help')
 
-# This must run after checking for command-line switches so that -p has a chance to run before this preempts it.
-if configuration['authenticate'] and VALID_PASSWORD == '':
-    sys.stderr.write('Authentication is enabled but no password is set. Please set a password using this script with the -p option.')
-    raise SystemExit
+    # This must run after checking for command-line switches so that -p has a chance to run before this preempts it.
+    check_password_set()
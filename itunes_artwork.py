@@ -1,10 +1,18 @@
 import urllib.request
 import urllib.parse
+import concurrent.futures
+import threading
+import json
 import time
+import os
 import re
 
 # Download missing cover art.
 # Sourced from https://github.com/regosen/get_cover_art/blob/master/get_cover_art/apple_downloader.py
+# Albums are collected during a library scan and looked up together afterwards (see AppleDownloader.download_all()), by a few threads sharing one rate limit.
+# The result of every search, including searches that found nothing, is kept in a file, so that rebuilding the library does not search for the same albums again.
+
+SEARCH_URL = 'https://itunes.apple.com/search'
 
 # from https://stackoverflow.com/questions/10294032/python-replace-typographical-quotes-dashes-etc-with-their-ascii-counterparts
 NORMALIZATION_TABLE = dict([(ord(x), ord(y)) for x, y in zip(u"‘’´“”–-[{}]", u"'''\"\"--(())")])
@@ -34,20 +42,78 @@ def normalize_album_name(album):
     return album_norm
 
 
+class RateLimiter:
+    # Lets calls to wait() through at most once every `interval` seconds, however many threads are making them.
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class LookupCache:
+    # Search results, keyed by normalized artist and album: the URL of the artwork found, or None if the search found nothing. Kept in a JSON file between runs.
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path and os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as error:
+                print("ERROR: reading artwork lookup cache (%s): %s" % (path, str(error)))
+
+    def key(self, meta):
+        return normalize_artist_name(meta.artist) + '\t' + normalize_album_name(meta.album)
+
+    def get(self, meta):
+        # (True, result) if this album has been searched for before, otherwise (False, None).
+        with self.lock:
+            key = self.key(meta)
+            return key in self.entries, self.entries.get(key)
+
+    def put(self, meta, art):
+        with self.lock:
+            self.entries[self.key(meta)] = art
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
 class AppleDownloader(object):
-    def __init__(self, verbose, throttle, enabled):
+    def __init__(self, verbose, throttle, enabled, cache_path=None, workers=4, search_url=SEARCH_URL):
+        # throttle is the least number of seconds between searches, shared among all `workers` threads. search_url can be pointed at a local server for testing.
         self.verbose = verbose
         self.throttle = throttle
         self.DO_ARTWORK = enabled
+        self.workers = workers
+        self.search_url = search_url
+        self.limiter = RateLimiter(float(throttle or 0))
+        self.cache = LookupCache(cache_path)
 
     def _urlopen_safe(self, url):
         q = urllib.request.Request(url)
         q.add_header('User-Agent',
                      'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36')
-        data = urllib.request.urlopen(q)
+        data = urllib.request.urlopen(q, timeout=30)
         return data.read()
 
     def _urlopen_text(self, url):
+        # None, rather than an empty string, if the request failed, so that failures are not mistaken for searches that found nothing.
         try:
             return self._urlopen_safe(url).decode("utf8")
         except Exception as error:
@@ -56,56 +122,82 @@ class AppleDownloader(object):
                 print("Please run 'Install Certificates.command' from your Python installation directory.")
             else:
                 print("ERROR: reading URL (%s): %s" % (url, str(error)))
-            return ""
+            return None
 
     def _dload(self, image_url, dest_path):
         if not self.DO_ARTWORK: return
         image_data = self._urlopen_safe(image_url)
-        output = open(dest_path, 'wb')
-        output.write(image_data)
-        output.close()
+        tmp_path = '%s.%d.tmp' % (dest_path, threading.get_ident())
+        with open(tmp_path, 'wb') as output:
+            output.write(image_data)
+        os.replace(tmp_path, dest_path)
         print("Downloaded cover art: " + dest_path)
 
-    def download(self, meta, art_path):
-        if not self.DO_ARTWORK: return
-        if 'Ultimate [Disc' in meta.album: return  # overly vague albums will not work
-        if self.throttle:
-            time.sleep(self.throttle)
-            artist_lower = normalize_artist_name(meta.artist)
-            album_lower = normalize_album_name(meta.album)
-            query = "%s %s" % (artist_lower, album_lower)
+    def search(self, meta):
+        # The URL of the artwork for meta's album, or None if there is none to be found. Raises IOError if the search itself failed.
+        artist_lower = normalize_artist_name(meta.artist)
+        album_lower = normalize_album_name(meta.album)
+        query = "%s %s" % (artist_lower, album_lower)
         if album_lower in artist_lower:
             query = artist_lower
         elif artist_lower in album_lower:
             query = album_lower
 
-        url = "https://itunes.apple.com/search?term=%s&media=music&entity=album" % urllib.parse.quote(query)
+        self.limiter.wait()
+        url = "%s?term=%s&media=music&entity=album" % (self.search_url, urllib.parse.quote(query))
         json_text = self._urlopen_text(url)
-        if json_text:
-            try:
-                info = eval(json_text)
-
-                art = ""
-                # go through albums, use exact match or first contains match if no exacts found
-                for album_info in reversed(info['results']):
-                    artist = normalize_artist_name(album_info['artistName'])
-                    album = normalize_album_name(album_info['collectionName'])
-
-                    if not artist_lower in artist.lower():
-                        continue
-                    if not album_lower in album.lower():
-                        continue
-
-                    art = album_info['artworkUrl100'].replace('100x100bb', '500x500bb')
-                    if album_lower == album.lower():
-                        break  # exact match found
-                if art:
-                    self._dload(art, art_path)
-                    return True
-                elif self.verbose:
-                    print("Failed to find matching artist (%s) and album (%s)" % (artist_lower, album_lower))
-                    return False
-            except Exception as error:
-                print("ERROR encountered downloading for %s" % query)
-                print(error)
+        if json_text is None:
+            raise IOError('search failed for %s' % query)
+        try:
+            info = json.loads(json_text)
+        except ValueError:
+            raise IOError('unreadable search results for %s' % query)
+
+        art = None
+        # go through albums, use exact match or first contains match if no exacts found
+        for album_info in reversed(info.get('results', [])):
+            artist = normalize_artist_name(album_info.get('artistName', ''))
+            album = normalize_album_name(album_info.get('collectionName', ''))
+
+            if not artist_lower in artist.lower():
+                continue
+            if not album_lower in album.lower():
+                continue
+
+            art = album_info['artworkUrl100'].replace('100x100bb', '500x500bb')
+            if album_lower == album.lower():
+                break  # exact match found
+        if not art and self.verbose:
+            print("Failed to find matching artist (%s) and album (%s)" % (artist_lower, album_lower))
+        return art
+
+    def lookup(self, meta):
+        # search(), answered from the cache if this album has been searched for before. Failed searches are not cached, so that they are tried again next time.
+        found, art = self.cache.get(meta)
+        if not found:
+            art = self.search(meta)
+            self.cache.put(meta, art)
+        return art
+
+    def download(self, meta, art_path):
+        if not self.DO_ARTWORK: return False
+        if 'Ultimate [Disc' in meta.album: return False  # overly vague albums will not work
+        try:
+            art = self.lookup(meta)
+            if art:
+                self._dload(art, art_path)
+                return True
+        except Exception as error:
+            print("ERROR encountered downloading for %s - %s" % (meta.artist, meta.album))
+            print(error)
         return False
+
+    def download_all(self, albums):
+        # Download artwork for each (MetadataContainer, path) in albums, `workers` at a time, then save what was learned to the cache. Returns the number downloaded.
+        if not self.DO_ARTWORK or not albums:
+            return 0
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max(1, self.workers)) as executor:
+                return sum(executor.map(lambda album: self.download(*album), albums))
+        finally:
+            self.cache.save()
@@ -0,0 +1,120 @@
+import re
+import shutil
+import threading
+import subprocess
+import concurrent.futures
+import logging
+
+import data
+import metrics
+
+# Measure the loudness of every song in the library in the background, so that the player can even out the volume from one song (or album) to the next, as
+# ReplayGain does; see AudioController.gain(). Each file is decoded once by ffmpeg's ebur128 filter, which gives its integrated loudness (EBU R128, in LUFS) and
+# its sample peak (dBFS). The results are kept in SONGS, along with the MTIME of the file they were measured from, so a song is only measured again once its
+# file has changed, and a pass that is stopped part of the way through carries on from where it left off the next time.
+# Run it on its own with `python3 loudness.py`, or set analyze-loudness in config.json to have webstereo.py run it alongside the web interface.
+
+#Initialize logging
+logging.basicConfig(format='%(asctime)s %(levelname)s %(filename)s %(funcName)s:%(lineno)d %(name)s %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+SILENCE = -70  # LUFS; ebur128 gives this for a file with nothing above its gate, which has no loudness to speak of
+BATCH_SIZE = 20  # songs measured between writes to the database; at most this many are measured again after an interruption
+RESCAN_INTERVAL = 600  # seconds; how often the analyzer looks for songs added or changed since its last pass, when run alongside webstereo.py
+
+# The summary ebur128 prints once the whole file has been read. A file with no audio at all has a loudness and peak of -inf.
+INTEGRATED = re.compile(r'I:\s+(-?(?:[0-9.]+|inf)) LUFS')
+SAMPLE_PEAK = re.compile(r'Peak:\s+(-?(?:[0-9.]+|inf)) dBFS')
+
+# Measuring is run at the lowest priority, so that it never holds up playback or the web interface.
+NICE = ['nice', '-n', '19'] if shutil.which('nice') else []
+
+MEASURED = metrics.Counter('webstereo_loudness_measured_total', 'Songs whose loudness has been measured.', ['result'])
+
+
+def measure(path):
+    # (loudness, peak) for the file at path, (None, None) if it is silent, or None if it couldn't be measured: ffmpeg is missing or was killed, the file
+    # can't be read, and so on. A silent file is measured as such, and isn't looked at again until it changes; one that couldn't be is tried again next pass.
+    try:
+        result = subprocess.run(NICE + ['ffmpeg', '-hide_banner', '-nostdin', '-nostats', '-loglevel', 'info', '-i', path, '-map', '0:a:0',
+                                        '-af', 'ebur128=peak=sample:framelog=verbose', '-f', 'null', '-'],
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.debug('could not measure %s: %s' % (path, e))
+        MEASURED.inc(1, 'failed')
+        return None
+
+    output = result.stderr.decode(errors='replace')
+    loudness = INTEGRATED.findall(output)
+    peak = SAMPLE_PEAK.findall(output)
+    if not loudness or not peak:
+        log.debug('could not measure %s: no ebur128 summary' % path)
+        MEASURED.inc(1, 'failed')
+        return None
+    if float(loudness[-1]) <= SILENCE:
+        MEASURED.inc(1, 'silent')
+        return None, None
+    MEASURED.inc(1, 'measured')
+    return float(loudness[-1]), float(peak[-1])
+
+
+class LoudnessAnalyzer:
+    def __init__(self, database, jobs=1):
+        # Each file is measured by an ffmpeg process of its own, so threads are enough to run `jobs` of them at once.
+        self.db = database
+        self.jobs = jobs
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        # Measure every song that is due to be, a batch at a time. Returns the number measured. Songs that couldn't be are left due, and are passed over
+        # until the next pass.
+        total = self.db.loudness_pending_count()
+        if not total:
+            return 0
+        log.info('measuring the loudness of %d songs' % total)
+        count = 0
+        after = -1
+        with concurrent.futures.ThreadPoolExecutor(max(1, self.jobs)) as executor:
+            while not self.stopped.is_set():
+                songs = self.db.loudness_pending(after, BATCH_SIZE)
+                if not songs:
+                    break
+                after = songs[-1][0]
+                results = [(i[0], i[2]) + result for i, result in zip(songs, executor.map(measure, [i[1] for i in songs])) if result is not None]
+                self.db.save_loudness(results)
+                count += len(results)
+                log.debug('measured %d of %d songs' % (count, total))
+        return count
+
+    def run_forever(self):
+        # Run a pass every RESCAN_INTERVAL seconds, to pick up songs added by data.py -s or watcher.py, until stop().
+        while not self.stopped.is_set():
+            try:
+                count = self.run()
+                if count:
+                    log.info('measured the loudness of %d songs' % count)
+            except Exception as e:
+                # As with the watcher, carry on regardless (the database may be locked by a long sync); the songs are still due, and are tried again next time.
+                log.exception('could not measure loudness: %s' % e)
+            self.stopped.wait(RESCAN_INTERVAL)
+
+
+def loudness_analyzer(database):
+    return LoudnessAnalyzer(database, jobs=data.configuration.get('loudness-jobs', data.CONFIGURATION_TEMPLATE['loudness-jobs']))
+
+
+if __name__ == '__main__':
+    data.load_configuration()
+    analyzer = LoudnessAnalyzer(data.WebStereoDB(data.DB_PATH), jobs=data.jobs_option())
+    try:
+        print('measured the loudness of %d songs' % analyzer.run())
+    except KeyboardInterrupt:
+        pass
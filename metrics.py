@@ -0,0 +1,127 @@
+import bisect
+import threading
+
+# Counters, gauges and histograms for /metrics, in the Prometheus text format. This is all of prometheus_client that webstereo needs, without another dependency.
+# Recording a value is a dictionary lookup, a bisection and an addition under a lock of its own, so they can be left on; the text is only put together when
+# /metrics is asked for. Metrics are kept for the life of the process, and every one made is listed by render().
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+
+registry = []
+registry_lock = threading.Lock()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+
+def format_number(value):
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        # labels are the names of the labels; values for them are passed, in the same order, each time a value is recorded.
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # tuple of label values: value
+        with registry_lock:
+            registry.append(self)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description.replace('\\', '\\\\').replace('\n', '\\n')), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.extend(self.render_value(label_values, value))
+        return lines
+
+
+class Counter(Metric):
+    # By convention, the name of a counter ends in _total.
+    kind = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def total(self):
+        # The sum over every combination of labels.
+        with self.lock:
+            return sum(self.values.values())
+
+    def render_value(self, label_values, value):
+        return ['%s%s %s' % (self.name, format_labels(self.labels, label_values), format_number(value))]
+
+
+class Gauge(Metric):
+    # A value that is set, rather than added to.
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def render_value(self, label_values, value):
+        return ['%s%s %s' % (self.name, format_labels(self.labels, label_values), format_number(value))]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        # Bucket bounds are inclusive, so a value lands in the first bucket at least as large as it; anything larger than the last only counts towards +Inf.
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * len(self.buckets), 0, 0.0]  # count per bucket (not cumulative), count, sum
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def total(self):
+        # (count, sum) over every combination of labels.
+        with self.lock:
+            return sum(i[1] for i in self.values.values()), sum(i[2] for i in self.values.values())
+
+    def render_value(self, label_values, value):
+        counts, count, total = value
+        names = self.labels + ('le',)
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(names, label_values + (format_number(float(bound)),)), cumulative))
+        lines.append('%s_bucket%s %d' % (self.name, format_labels(names, label_values + ('+Inf',)), count))
+        lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, label_values), format_number(total)))
+        lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, label_values), count))
+        return lines
+
+
+def render():
+    # Every metric, as the body of a /metrics response.
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
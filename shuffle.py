@@ -0,0 +1,158 @@
+import random
+import hashlib
+import logging
+
+import data
+
+# Shuffle, without ever making a list of the songs to be shuffled. A random permutation of the positions 0..n - 1 is computed one position at a time (see
+# Permutation); in library mode the positions are song IDs, and in playlist mode they index the playlist. Everything needed to carry on where a shuffle left off
+# fits in a few numbers - see Shuffle.state() - and the same seed always gives the same order.
+
+#Initialize logging
+logging.basicConfig(format='%(asctime)s %(levelname)s %(filename)s %(funcName)s:%(lineno)d %(name)s %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+db = data.WebStereoDB  # for its constants
+
+
+class Permutation:
+    # A pseudorandom permutation of range(size), keyed by seed: permutation[i] is the i-th element, computed in constant time without generating the others.
+    # It is a small Feistel network over the smallest even number of bits that covers size; outputs that fall outside the range are encrypted again ("cycle
+    # walking") until one lands inside it, which keeps it a permutation. As the network's domain is less than four times size, that takes few steps.
+    ROUNDS = 4
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2
+        self.half_bits = bits // 2
+        self.mask = (1 << self.half_bits) - 1
+
+    def __len__(self):
+        return self.size
+
+    def round_function(self, r, value):
+        digest = hashlib.blake2b(b'%d:%d:%d' % (self.seed, r, value), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') & self.mask
+
+    def encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.mask
+        for r in range(self.ROUNDS):
+            left, right = right, left ^ self.round_function(r, right)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        value = index
+        while True:
+            value = self.encrypt(value)
+            if value < self.size:
+                return value
+
+
+class Shuffle:
+    HISTORY_LIMIT = 100  # songs remembered for previous()
+
+    def __init__(self, database, playlist=None, seed=None, spread_artists=False, items=None, size=None):
+        # Shuffle the whole library, or the named playlist. With spread_artists, a song by the same artist as the one before it is held back until something else
+        # has been played. items and size are those of a shuffle being restored (see restore()); otherwise they are taken from the database as it is now.
+        self.db = database
+        self.playlist = playlist or None
+        self.seed = random.getrandbits(63) if seed is None else int(seed)
+        self.spread_artists = spread_artists
+        self.position = 0  # how much of the permutation has been used
+        self.deferred = []  # song IDs held back by spread_artists, oldest first
+        self.last_artist = None
+        self.history = []  # song IDs played, oldest first
+        self.rewound = 0  # how far previous() has gone back into history
+        self.items = items  # None in library mode, where positions are song IDs
+        if size is None:
+            if self.playlist:
+                self.items = [i for i in self.db.fetch_playlist_contents(self.playlist) if str(i).isdigit()]
+                size = len(self.items)
+            else:
+                size = self.db.max_song_id() + 1
+        self.permutation = Permutation(size, self.seed)
+
+    def state(self):
+        # Everything restore() needs to carry on from here, in a form that can be written out as JSON. The permutation depends on its size as well as the seed,
+        # so that (and the playlist's contents) are kept as they were when the shuffle began; songs added since then are left for the next one.
+        return {
+            'playlist': self.playlist,
+            'seed': self.seed,
+            'size': len(self.permutation),
+            'items': self.items,
+            'spread_artists': self.spread_artists,
+            'position': self.position,
+            'deferred': self.deferred,
+            'last_artist': self.last_artist,
+            'history': self.history,
+            'rewound': self.rewound,
+        }
+
+    @classmethod
+    def restore(cls, database, state):
+        # States saved before size was recorded begin again with the library or playlist as it is now.
+        shuffle = cls(database, state['playlist'], state['seed'], state['spread_artists'], state.get('items'), state.get('size'))
+        shuffle.position = state['position']
+        shuffle.deferred = list(state['deferred'])
+        shuffle.last_artist = state['last_artist']
+        shuffle.history = list(state['history'])
+        shuffle.rewound = state['rewound']
+        return shuffle
+
+    def remaining(self):
+        # An upper bound: in library mode, some of the IDs left may belong to songs that have since been deleted.
+        return len(self.permutation) - self.position + len(self.deferred)
+
+    def song(self, position):
+        # The database row for a position in the permutation, or None if there is no such song.
+        uid = self.permutation[position] if self.items is None else int(self.items[self.permutation[position]])
+        return self.db.find_song_by_id(uid) or None
+
+    def next(self):
+        # The database row of the next song to play, or None once everything has been played.
+        if self.rewound:
+            self.rewound -= 1
+            return self.db.find_song_by_id(self.history[-1 - self.rewound]) or self.next()
+
+        song = self.draw()
+        if song:
+            self.last_artist = song[db.DB_SONG_ARTIST]
+            self.history.append(song[db.DB_SONG_ID])
+            del self.history[:-self.HISTORY_LIMIT]
+        return song
+
+    def draw(self):
+        for i in range(len(self.deferred)):
+            song = self.db.find_song_by_id(self.deferred[i])
+            if song and song[db.DB_SONG_ARTIST] != self.last_artist:
+                del self.deferred[i]
+                return song
+
+        while self.position < len(self.permutation):
+            song = self.song(self.position)
+            self.position += 1
+            if not song:
+                continue  # a gap left by a deleted song
+            if self.spread_artists and song[db.DB_SONG_ARTIST] == self.last_artist:
+                self.deferred.append(song[db.DB_SONG_ID])
+                continue
+            return song
+
+        # Only songs by the last artist are left; play them anyway.
+        while self.deferred:
+            song = self.db.find_song_by_id(self.deferred.pop(0))
+            if song:
+                return song
+        return None
+
+    def previous(self):
+        # The database row of the song played before the current one, or None if there is none. next() then retraces the same steps.
+        if self.rewound + 1 >= len(self.history):
+            return None
+        self.rewound += 1
+        return self.db.find_song_by_id(self.history[-1 - self.rewound]) or None
@@ -8,4 +8,113 @@ function nowPlayingLoop(){
     npReq.send();
 }
 nowPlayingLoop(); //Ensure this is run right at the outset.
-setInterval(nowPlayingLoop, 1000);*/
\ No newline at end of file
+setInterval(nowPlayingLoop, 1000);*/
+
+//Keep the now playing panel up to date from the server's event stream (/events). The first event carries the player's whole state and later ones only what
+//changed, so merge each one into nowPlayingState and redraw. The clock is run here between events, from the position the server last reported.
+var nowPlayingState = {};
+var nowPlayingReceived = 0; //when the last position arrived, in milliseconds
+var nowPlayingFailures = 0;
+function formatTime(secs){
+    secs = Math.max(0, Math.floor(secs));
+    return Math.floor(secs / 60) + ":" + (secs % 60 < 10 ? "0" : "") + (secs % 60);
+}
+function currentPosition(){
+    var s = nowPlayingState;
+    if (!s.playing) { return 0; }
+    if (s.paused) { return s.position; }
+    return s.position + (Date.now() - nowPlayingReceived) / 1000;
+}
+function queueList(entries, limit){
+    var ol = document.createElement("ol");
+    entries.slice(0, limit).forEach(function(entry){
+	var li = document.createElement("li");
+	li.appendChild(makeLink("javascript:;", entry[1], function(){ playSong(entry[0]); }));
+	ol.appendChild(li);
+    });
+    return ol;
+}
+function heading(text){
+    var h4 = document.createElement("h4");
+    var b = document.createElement("b");
+    b.textContent = text;
+    h4.appendChild(b);
+    return h4;
+}
+function renderNowPlaying(){
+    //Mirrors nowplaying.html
+    var panel = document.getElementById("now-playing-panel");
+    if (panel == null) { return; }
+    var s = nowPlayingState;
+    var table = document.createElement("table");
+    table.style.display = "table-row";
+    var tr = document.createElement("tr");
+
+    var prev = document.createElement("td");
+    prev.id = "up-prev-display";
+    prev.style.verticalAlign = "top";
+    prev.appendChild(heading("PREVIOUSLY PLAYED"));
+    prev.appendChild(queueList(s.up_prev || [], 10));
+    tr.appendChild(prev);
+
+    var next = document.createElement("td");
+    next.id = "up-next-display";
+    next.style.verticalAlign = "top";
+    var nextHeading = heading("UP NEXT");
+    var clear = makeLink("#", "  (CLEAR)", function(){ purge(); });
+    clear.style.color = "#FF0000";
+    nextHeading.appendChild(clear);
+    next.appendChild(nextHeading);
+    next.appendChild(queueList(s.up_next || [], 10));
+    tr.appendChild(next);
+
+    var info = document.createElement("td");
+    [["np-song", s.song], ["np-album", s.album], ["np-track", s.track], ["np-time", formatTime(currentPosition()) + " / " + s.length]].forEach(function(field){
+	var p = document.createElement("p");
+	p.id = field[0];
+	p.textContent = field[1];
+	info.appendChild(p);
+    });
+    info.lastChild.style.letterSpacing = "1px";
+    tr.appendChild(info);
+
+    table.appendChild(tr);
+    var center = document.createElement("center");
+    center.appendChild(table);
+    panel.replaceChildren(center);
+
+    if (s.album != currentAlbum){
+	currentAlbum = s.album;
+	document.getElementById("current-album-cover").src = s.album_id == null ? "/artwork/none?size=150" : "/artwork/" + s.album_id + "?size=150";
+    }
+    var button = document.getElementById("play-pause");
+    if (button != null && s.paused != paused){
+	paused = s.paused;
+	button.innerHTML = paused ? "PLAY" : "PAUSE";
+    }
+}
+function tickNowPlaying(){
+    var t = document.getElementById("np-time");
+    if (t != null && nowPlayingState.playing) { t.textContent = formatTime(currentPosition()) + " / " + nowPlayingState.length; }
+}
+function startNowPlayingEvents(){
+    var events = new EventSource("/events");
+    var clock = setInterval(tickNowPlaying, 1000);
+    events.addEventListener("message", function(e){
+	nowPlayingFailures = 0;
+	Object.assign(nowPlayingState, JSON.parse(e.data));
+	nowPlayingReceived = Date.now();
+	renderNowPlaying();
+    });
+    events.addEventListener("error", function(){
+	//The server closes streams from time to time and the browser reconnects by itself; only give up on events if connecting keeps failing.
+	if (++nowPlayingFailures >= 3){
+	    events.close();
+	    clearInterval(clock);
+	    startNowPlayingPolling();
+	}
+    });
+}
+if (document.getElementById("now-playing-panel") != null){
+    if (window.EventSource) { startNowPlayingEvents(); } else { startNowPlayingPolling(); }
+}
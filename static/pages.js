@@ -1,17 +1,4 @@
 var isLoadingAlbums = false; //Flags whether albums are being loaded. This is used to communicate across functions and ensure that the subtly different JavaScript code for this particular page is executed properly
-function recomputeCoverSizes(){
-    var rowWidth = document.getElementById("row-width-container").innerText
-    //Used to determine the appropriate size at which to render album covers.
-      //This must be an inline script because it relies on formatting in the Flask template.render() call. I hate this too.
-    var coverArtImages = document.getElementsByTagName('img');
-    var coverSideLength = document.documentElement.clientWidth / rowWidth;
-    for (var i=0;i<coverArtImages.length;i++){
-	coverArtImages[i].width = coverSideLength;
-	coverArtImages[i].height = coverSideLength;
-    }
-
-}
-
 /*function writePage() {
     document.getElementById("content").innerHTML = this.response; //Set page to show HTML data
     if (isLoadingAlbums){
@@ -48,3 +35,182 @@ function page(loc){
     }
     }*/
 
+//Load long tables a page at a time. /songs and /albums render only the first page; the rest is fetched from the JSON endpoint named in data-source
+//on the element with id "paged-rows" as the user scrolls towards the bottom. data-next-page holds the cursor for the next page (null once everything is loaded).
+var loadingPage = false;
+function makeLink(href, text, onclick){
+    var a = document.createElement("a");
+    a.className = "btn";
+    a.href = href;
+    if (onclick) { a.addEventListener("click", onclick); }
+    a.textContent = text;
+    return a;
+}
+function centeredCell(child){
+    var td = document.createElement("td");
+    var center = document.createElement("center");
+    if (typeof child == "string") { center.textContent = child; } else { center.appendChild(child); }
+    td.appendChild(center);
+    return td;
+}
+function songRow(container, song){
+    //Mirrors the rows rendered by songs.html
+    var index = container.rows.length + 1;
+    var tr = document.createElement("tr");
+    var img = document.createElement("img");
+    img.width = 50;
+    img.height = 50;
+    img.loading = "lazy";
+    img.src = "/artwork/" + song.album_id + "?size=50";
+    tr.appendChild(centeredCell(img));
+    tr.appendChild(centeredCell(makeLink("javascript:;", song.title, function(){ playSong(song.id); })));
+    tr.appendChild(centeredCell(makeLink("/album-data/" + song.album_id, song.album)));
+    tr.appendChild(centeredCell(String(song.number)));
+    tr.appendChild(centeredCell(song.length));
+    tr.appendChild(centeredCell(makeLink("javascript:;", "Enqueue", function(){ upNextSong(song.id); })));
+    var edit = makeLink("/edit-metadata/song/" + song.id, "Edit");
+    edit.target = "_blank";
+    tr.appendChild(centeredCell(edit));
+    var open = makeLink("/player/" + song.id, "Open");
+    open.target = "_blank";
+    tr.appendChild(centeredCell(open));
+    var td = document.createElement("td");
+    var select = document.getElementById("playlist-options").cloneNode(true);
+    select.id = "playlist-select" + index;
+    select.name = "playlist-select" + index;
+    select.style.display = "";
+    td.appendChild(select);
+    td.appendChild(makeLink("javascript:;", "Add", function(){ addToPlaylist(index, song.id); }));
+    tr.appendChild(td);
+    container.appendChild(tr);
+}
+function albumCell(container, album){
+    //Mirrors the cells rendered by albums.html, filling the last row before starting a new one
+    var rowWidth = parseInt(container.dataset.rowWidth);
+    var tr = container.rows[container.rows.length - 1];
+    if (tr == undefined || tr.cells.length >= rowWidth) {
+	tr = document.createElement("tr");
+	container.appendChild(tr);
+    }
+    var size = document.getElementById("retrieve-album-size").innerText;
+    var existing = document.getElementsByClassName("album-cover-display");
+    var td = document.createElement("td");
+    td.width = size;
+    td.height = size;
+    var a = document.createElement("a");
+    a.href = "/album-data/" + album.id;
+    a.className = "album-link";
+    var img = document.createElement("img");
+    img.className = "album-cover-display";
+    img.loading = "lazy";
+    img.width = existing.length ? existing[0].width : size; //recompute-album-sizes.js may have resized the covers already on the page
+    img.height = existing.length ? existing[0].height : size;
+    img.src = "/artwork/" + album.id + "?size=" + size;
+    a.appendChild(img);
+    [album.title, album.artist].forEach(function(text){
+	var p = document.createElement("p");
+	var b = document.createElement("b");
+	p.className = "truncated";
+	b.textContent = text;
+	p.appendChild(b);
+	a.appendChild(p);
+    });
+    td.appendChild(a);
+    td.appendChild(document.createElement("br"));
+    tr.appendChild(td);
+}
+function loadNextPage(){
+    var container = document.getElementById("paged-rows");
+    if (container == null || loadingPage) { return; }
+    var next = JSON.parse(container.dataset.nextPage || "null");
+    if (next == null) { return; } //everything has been loaded
+    loadingPage = true;
+    var req = new XMLHttpRequest();
+    req.addEventListener("load", function(){
+	loadingPage = false;
+	if (req.status != 200) { return; }
+	var page = JSON.parse(req.response);
+	var builder = window[container.dataset.rowBuilder];
+	page.rows.forEach(function(row){ builder(container, row); });
+	container.dataset.nextPage = JSON.stringify(page.next);
+	checkScroll(); //keep going if the page still doesn't fill the window
+    });
+    req.addEventListener("error", function(){ loadingPage = false; });
+    req.open("GET", container.dataset.source + "?after=" + encodeURIComponent(JSON.stringify(next)));
+    req.send();
+}
+function checkScroll(){
+    //Start fetching well before the bottom is reached so that scrolling doesn't stall
+    if (window.innerHeight + window.scrollY >= document.body.offsetHeight - 2 * window.innerHeight) {
+	loadNextPage();
+    }
+}
+window.addEventListener("scroll", checkScroll);
+window.addEventListener("load", checkScroll);
+
+//The playlists page lists only the playlists themselves; the songs in each are fetched from /data/playlists/<playlist> the first time it is opened, a page at a
+//time. Which playlists are open is remembered for the rest of the session, so that they are still open after the page reloads to show an edit.
+function openPlaylists(){
+    return JSON.parse(sessionStorage.getItem("open-playlists") || "[]");
+}
+function playlistRow(container, song){
+    //Play, Enqueue, title, album, Up (which needs the position of the row before) and Delete
+    var plist = container.dataset.playlist;
+    var previous = container.dataset.lastPosition;
+    var tr = document.createElement("tr");
+    [makeLink("javascript:;", "Play", function(){ playSong(song.id); }),
+     makeLink("javascript:;", "Enqueue", function(){ upNextSong(song.id); }),
+     makeLink("javascript:;", song.title, function(){ playSong(song.id); }),
+     makeLink("/album-data/" + song.album_id, song.album),
+     previous == undefined ? null : makeLink("javascript:;", "Up", function(){ moveInPlaylist(plist, song.position, parseInt(previous)); }),
+     makeLink("javascript:;", "Delete", function(){ deleteFromPlaylist(plist, song.id); })].forEach(function(child){
+	 var td = document.createElement("td");
+	 if (child) { td.appendChild(child); }
+	 tr.appendChild(td);
+     });
+    tr.cells[5].firstChild.style.color = "#F00";
+    container.dataset.lastPosition = song.position;
+    container.appendChild(tr);
+}
+function loadPlaylistPage(id){
+    var container = document.getElementById("playlist-rows" + id);
+    if (container.dataset.loading == "true") { return; }
+    var url = "/data/playlists/" + encodeURIComponent(container.dataset.playlist);
+    var next = JSON.parse(container.dataset.nextPage);
+    if (next != null) { url += "?after=" + encodeURIComponent(JSON.stringify(next)); }
+    container.dataset.loading = "true";
+    var req = new XMLHttpRequest();
+    req.addEventListener("load", function(){
+	container.dataset.loading = "false";
+	if (req.status != 200) { return; }
+	var page = JSON.parse(req.response);
+	page.rows.forEach(function(row){ playlistRow(container, row); });
+	container.dataset.nextPage = JSON.stringify(page.next);
+	container.dataset.loaded = "true";
+	document.getElementById("playlist-more" + id).style.display = page.next == null ? "none" : "";
+    });
+    req.addEventListener("error", function(){ container.dataset.loading = "false"; });
+    req.open("GET", url);
+    req.send();
+}
+function togglePlaylist(id){
+    var container = document.getElementById("playlist-rows" + id);
+    var open = openPlaylists().filter(function(i){ return i != id; });
+    if (container.style.display == "none") {
+	container.style.display = "";
+	document.getElementById("playlist-toggle" + id).textContent = "Hide songs";
+	if (container.dataset.loaded == "false") { loadPlaylistPage(id); }
+	open.push(id);
+    }
+    else {
+	container.style.display = "none";
+	document.getElementById("playlist-more" + id).style.display = "none";
+	document.getElementById("playlist-toggle" + id).textContent = "Show songs";
+    }
+    sessionStorage.setItem("open-playlists", JSON.stringify(open));
+}
+window.addEventListener("load", function(){
+    openPlaylists().forEach(function(id){
+	if (document.getElementById("playlist-rows" + id)) { togglePlaylist(id); }
+    });
+});
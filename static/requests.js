@@ -30,6 +30,18 @@ function upNextSong(song_id){
     req.open("POST", "/up-next/song/" + song_id);
     req.send();
 }
+function upNextPlaylist(plist){
+    //Queue a whole playlist, in order
+    var req = new XMLHttpRequest();
+    req.open("POST", "/up-next/playlist/" + encodeURIComponent(plist));
+    req.send();
+}
+function upNextSearch(query){
+    //Queue every song matching a search
+    var req = new XMLHttpRequest();
+    req.open("POST", "/up-next/search?q=" + encodeURIComponent(query));
+    req.send();
+}
 function playAlbum(name){
     var req = new XMLHttpRequest();
     console.log(name)
@@ -51,6 +63,11 @@ function forward(secs){
         req.open("POST", "/command/fwd=" + secs);
         req.send();
 }
+function previous(){
+	var req = new XMLHttpRequest();
+	req.open("POST", "/command/prev=0");
+	req.send();
+}
 function next(secs){
 	var req = new XMLHttpRequest();
 	req.open("POST", "/command/next=0");
@@ -91,6 +108,13 @@ function deleteFromPlaylist(plist, song_id) {
     req.send();
     location.reload(); //display updated playlist
 }
+function moveInPlaylist(plist, position, before) {
+    //Move an entry in a playlist to just before another one
+    var req = new XMLHttpRequest();
+    req.addEventListener("load", function(){ location.reload(); }); //display updated playlist
+    req.open("POST", "/playlists/move/" + encodeURIComponent(plist) + '/' + position + "?before=" + before);
+    req.send();
+}
 function startShuffle(playlist){
     var req = new XMLHttpRequest();
     if (playlist == undefined) {
@@ -113,7 +137,7 @@ function nowPlayingUpdate(){
     document.getElementById("now-playing-panel").innerHTML = this.response;
     var ca = document.getElementById("nowplaying-album-notify").innerText;
     if (ca != currentAlbum){
-	document.getElementById("current-album-cover").src = "/artwork/" + ca;
+	document.getElementById("current-album-cover").src = "/artwork/" + ca + "?size=150";
     }
 }
 function nowPlayingLoop(){
@@ -123,5 +147,8 @@ function nowPlayingLoop(){
     npReq.open("GET", url);
     npReq.send();
 }
-nowPlayingLoop(); //Ensure this is run right at the outset.
-setInterval(nowPlayingLoop, 1000);
+//Polling /nowplaying is the fallback for browsers without server-sent events; nowplaying.js decides which to use.
+function startNowPlayingPolling(){
+    nowPlayingLoop(); //Ensure this is run right at the outset.
+    return setInterval(nowPlayingLoop, 1000);
+}
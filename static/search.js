@@ -0,0 +1,40 @@
+//Type-ahead for the search boxes: as the user types, ask /data/search for matching songs, albums and artists and offer them in a datalist.
+//Requests are made at most once per pause in typing, and answers to anything but the latest request are ignored.
+var suggestTimer = null;
+var suggestSerial = 0;
+function showSuggestions(list, results){
+    while (list.firstChild) { list.removeChild(list.firstChild); }
+    var values = [];
+    results.artists.forEach(function(artist){ values.push(artist.artist); });
+    results.albums.forEach(function(album){ values.push(album.title); });
+    results.songs.forEach(function(song){ values.push(song.title); });
+    values.filter(function(value, index){ return values.indexOf(value) == index; }).forEach(function(value){
+	var option = document.createElement("option");
+	option.value = value;
+	list.appendChild(option);
+    });
+}
+function requestSuggestions(input, list){
+    var serial = ++suggestSerial;
+    if (input.value.trim() == "") { showSuggestions(list, {artists: [], albums: [], songs: []}); return; }
+    var req = new XMLHttpRequest();
+    req.addEventListener("load", function(){
+	if (req.status != 200 || serial != suggestSerial) { return; }
+	showSuggestions(list, JSON.parse(req.response));
+    });
+    req.open("GET", "/data/search?q=" + encodeURIComponent(input.value));
+    req.send();
+}
+window.addEventListener("load", function(){
+    document.querySelectorAll('input[name="search-query"]').forEach(function(input, index){
+	var list = document.createElement("datalist");
+	list.id = "search-suggestions-" + index;
+	input.parentNode.appendChild(list);
+	input.setAttribute("list", list.id);
+	input.setAttribute("autocomplete", "off");
+	input.addEventListener("input", function(){
+	    clearTimeout(suggestTimer);
+	    suggestTimer = setTimeout(function(){ requestSuggestions(input, list); }, 150);
+	});
+    });
+});
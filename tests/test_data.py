@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import tempfile
+import types
+import unittest
+
+import data
+
+
+class WebStereoDBTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'media.db')
+        self.db = data.WebStereoDB(self.path)
+
+    def tearDown(self):
+        self.db.connection.close()
+        self.directory.cleanup()
+
+    def test_failed_write_releases_the_database(self):
+        # A write that fails outside of a transaction() must not leave this thread's connection holding the database's write lock.
+        self.db.query('INSERT INTO PLAYLISTS (NAME, MODIFIED_TIME) VALUES (?, ?)', ['Playlist', 0])
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.db.query('INSERT INTO PLAYLISTS (NAME, MODIFIED_TIME) VALUES (?, ?)', ['Playlist', 0])
+        self.assertFalse(self.db.connection.in_transaction)
+
+        other = sqlite3.connect(self.path, timeout=0.1)
+        try:
+            other.execute('INSERT INTO PLAYLISTS (NAME, MODIFIED_TIME) VALUES (?, ?)', ['Another', 0])
+            other.commit()
+        finally:
+            other.close()
+        self.assertEqual(sorted(self.db.fetch_all_playlist_names()), ['Another', 'Playlist'])
+
+    def test_ids_are_allocated_by_the_database(self):
+        # Another process (data.py -s, say) may add albums and songs after this one has opened the database; new rows must not be given the IDs they took.
+        other = sqlite3.connect(self.path)
+        try:
+            other.execute("INSERT INTO ALBUMS (TITLE, ARTIST, GENRE, ARTWORK, YEAR, UNIQUE_ID, ARTIST_SORTED) VALUES ('Elsewhere', 'Someone', 'Rock', '', '2000', 1, 'someone')")
+            other.execute("INSERT INTO SONGS (FILE, TITLE, ALBUM_ID, LENGTH, ENCTYPE, UNIQUE_ID, SORTING) VALUES ('/elsewhere.flac', 'Song', 1, '0:01', 'FLAC', 1, 'song')")
+            other.commit()
+        finally:
+            other.close()
+        album_id = self.db.create_album('Here', 'Someone Else', 'Jazz', 2001)
+        self.db.create_song('/here.flac', 'Song', album_id, 1)
+        self.assertEqual(album_id, 2)
+        self.assertEqual(self.db.max_song_id(), 2)
+
+    def test_albums_are_told_apart_by_artist(self):
+        # Two albums of the same name by different artists are two albums, and a sync that reads their songs again leaves them as they were.
+        info = types.SimpleNamespace(length=60)
+        songs = [data.SongMetadata('/%s/Greatest Hits/01.flac' % artist, 'Song', 'Greatest Hits', 1, info, 'FLAC', artist, 'Pop', '2000', '/none.jpg')
+                 for artist in ['Someone', 'Someone Else']]
+        self.db.write_songs((meta, None) for meta in songs)
+        albums = self.db.query("SELECT UNIQUE_ID, ARTIST FROM ALBUMS WHERE TITLE = 'Greatest Hits' ORDER BY ARTIST")
+        self.assertEqual([i[1] for i in albums], ['Someone', 'Someone Else'])
+
+        ids = dict(self.db.query('SELECT FILE, UNIQUE_ID FROM SONGS'))
+        self.db.write_songs((meta, ids[meta.file]) for meta in songs)
+        self.assertEqual(self.db.query("SELECT UNIQUE_ID, ARTIST FROM ALBUMS WHERE TITLE = 'Greatest Hits' ORDER BY ARTIST"), albums)
+        self.assertEqual(sorted(self.db.query('SELECT ALBUM_ID FROM SONGS')), sorted((i[0],) for i in albums))
+
+
+if __name__ == '__main__':
+    unittest.main()
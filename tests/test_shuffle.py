@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+import data
+import shuffle
+
+
+class ShuffleTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = data.WebStereoDB(os.path.join(self.directory.name, 'media.db'))
+        self.add_songs(400)
+
+    def tearDown(self):
+        self.db.connection.close()
+        self.directory.cleanup()
+
+    def add_songs(self, count):
+        album_id = self.db.create_album('Album %d' % (self.db.max_song_id() + 1), 'Artist', 'Rock', 2000)
+        with self.db.transaction():
+            for i in range(count):
+                self.db.create_song('/%d.flac' % i, 'Song %d' % i, album_id, i + 1)
+
+    def draw(self, shuffle, count):
+        return [shuffle.next()[data.WebStereoDB.DB_SONG_ID] for i in range(count)]
+
+    def test_restore_after_the_library_grows(self):
+        # A shuffle carries on through the same order after a restart, even if songs have been added in the meantime.
+        expected = self.draw(shuffle.Shuffle(self.db, seed=7), 400)
+        original = shuffle.Shuffle(self.db, seed=7)
+        played = self.draw(original, 200)
+        state = original.state()
+        self.add_songs(700)
+
+        restored = shuffle.Shuffle.restore(self.db, state)
+        rest = []
+        song = restored.next()
+        while song:
+            rest.append(song[data.WebStereoDB.DB_SONG_ID])
+            song = restored.next()
+        self.assertEqual(played + rest, expected)
+        self.assertEqual(sorted(expected), list(range(1, 401)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import os.path
+import shutil
+import hashlib
+import threading
+import subprocess
+import concurrent.futures
+import logging
+
+# Resized copies of album artwork, so that pages showing hundreds of covers don't send every one of them at full size and leave the browser to scale it down.
+# Copies are named after the SHA-1 of the image they were made from, so a name always refers to the same image; when the artwork changes, so does the name.
+# That makes them safe to cache indefinitely, wherever they are cached. Resizing is done by ffmpeg, which webstereo needs for playback anyway.
+
+#Initialize logging
+logging.basicConfig(format='%(asctime)s %(levelname)s %(filename)s %(funcName)s:%(lineno)d %(name)s %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+class FileDigests:
+    # SHA-1 digests of files, remembered along with each file's size and modification time, so that a file is only read through again when it has changed.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.digests = {}  # path: (size, mtime, SHA-1)
+
+    def digest(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.digests.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                sha1.update(block)
+        with self.lock:
+            self.digests[path] = (stat.st_size, stat.st_mtime_ns, sha1.hexdigest())
+        return sha1.hexdigest()
+
+
+class ArtworkCache:
+    def __init__(self, location, sizes):
+        # location is the directory the copies are kept in; sizes are the widths (and heights - covers are square, or are fit inside a square) of the copies
+        # made of every image. Requests for other sizes are served the next size up. A relative location is taken from the current directory (Flask would
+        # otherwise take it from the application's).
+        self.location = os.path.abspath(location)
+        self.sizes = sorted(set([int(i) for i in sizes if int(i) > 0]))
+        self.digests = FileDigests()
+
+    def standard_size(self, size):
+        # The smallest standard size at least as large as the one asked for. 0 stands for the original image, which is also what is sent for anything larger than
+        # the largest standard size.
+        for i in self.sizes:
+            if size and size <= i:
+                return i
+        return 0
+
+    def thumbnail(self, path, size=0):
+        # The name, within self.location, of the copy of the image at path at (the standard size nearest to) size, making it first if it doesn't exist yet.
+        # Raises OSError if path cannot be read.
+        size = self.standard_size(size)
+        name = '%s-%d%s' % (self.digests.digest(path), size, '.jpg' if size else os.path.splitext(path)[1].lower())
+        target = os.path.join(self.location, name)
+        if not os.path.isfile(target):
+            self.render(path, target, size)
+        return name
+
+    def render(self, source, target, size):
+        # Written under a temporary name and then moved into place, so that a copy that exists at all is complete.
+        os.makedirs(self.location, exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (target, os.getpid(), threading.get_ident())
+        try:
+            if size:
+                # Shrink the image to fit inside size x size, but never enlarge it.
+                subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', source,
+                                '-vf', "scale=w='min(%d,iw)':h='min(%d,ih)':force_original_aspect_ratio=decrease" % (size, size),
+                                '-frames:v', '1', '-pix_fmt', 'yuvj420p', '-q:v', '3', '-f', 'mjpeg', tmp_path],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+            else:
+                shutil.copyfile(source, tmp_path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # ffmpeg is missing or can't read the image; the browser is left to scale the original, as it always used to.
+            log.warning('could not resize %s: %s' % (source, e))
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+
+    def prerender(self, paths, jobs=1):
+        # Make copies of each of paths at every standard size ahead of time, so that the first visit to the albums page doesn't wait for them. Images that don't
+        # exist are skipped. Each copy is made by its own ffmpeg process, so threads are enough to run `jobs` of them at once.
+        def render_all(path):
+            for size in self.sizes:
+                try:
+                    self.thumbnail(path, size)
+                except OSError as e:
+                    log.debug('not rendering %s: %s' % (path, e))
+                    return
+
+        with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+            list(executor.map(render_all, [i for i in set(paths) if os.path.isfile(i)]))
@@ -0,0 +1,136 @@
+import os
+import os.path
+import threading
+import subprocess
+import logging
+
+from thumbnails import FileDigests
+
+# Transcoded copies ("renditions") of songs, for the browser player: a phone on a slow connection is better served by 96 kbit/s Opus than by a 40 MB FLAC file.
+# Renditions are named after the SHA-1 of the file they were made from and the bitrate they were made at, so a name always refers to the same audio, and are
+# kept on disk so that a song is only transcoded once per format and bitrate. Transcoding is done by ffmpeg, which webstereo needs for playback anyway.
+
+#Initialize logging
+logging.basicConfig(format='%(asctime)s %(levelname)s %(filename)s %(funcName)s:%(lineno)d %(name)s %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# format: (file extension, ffmpeg encoder arguments, MIME type). Each is a container that can be written front to back in one pass, so a rendition can be sent
+# while it is still being made.
+FORMATS = {
+    'opus': ('.opus', ['-c:a', 'libopus', '-f', 'ogg'], 'audio/ogg'),
+    'aac': ('.aac', ['-c:a', 'aac', '-f', 'adts'], 'audio/aac'),
+    'mp3': ('.mp3', ['-c:a', 'libmp3lame', '-f', 'mp3'], 'audio/mpeg'),
+}
+MIN_BITRATE = 32  # kbit/s
+MAX_BITRATE = 320
+FOLLOW_INTERVAL = 0.1  # seconds; how often a rendition being made is checked for more data
+
+
+class TranscodeJob:
+    # A rendition being made. Requests for it while it is made read the temporary file ffmpeg is writing, rather than each starting an ffmpeg of their own.
+    def __init__(self, name, target):
+        self.name = name
+        self.target = target
+        self.tmp_path = '%s.%d.tmp' % (target, os.getpid())
+        self.finished = threading.Event()  # set once the rendition is in place at target, or has failed
+        self.failed = False
+
+
+class TranscodeCache:
+    def __init__(self, location, size_limit=0):
+        # location is the directory renditions are kept in (a relative location is taken from the current directory, as Flask would otherwise take it from the
+        # application's); once they take up more than size_limit bytes, the least recently used are deleted. 0 means no limit.
+        self.location = os.path.abspath(location)
+        self.size_limit = size_limit
+        self.digests = FileDigests()
+        self.lock = threading.Lock()
+        self.jobs = {}  # name: TranscodeJob, for renditions being made
+
+    def rendition(self, path, audio_format, bitrate):
+        # (name, job) for the rendition of the song at path in audio_format at bitrate kbit/s. If the rendition is already in self.location, job is None;
+        # otherwise job is the TranscodeJob making it, started now if it isn't already running - see follow(). Raises OSError if path cannot be read.
+        extension = FORMATS[audio_format][0]
+        name = '%s-%dk%s' % (self.digests.digest(path), bitrate, extension)
+        target = os.path.join(self.location, name)
+        with self.lock:
+            job = self.jobs.get(name)
+            if job:
+                return name, job
+            if os.path.isfile(target):
+                os.utime(target)  # the modification time records when a rendition was last used; see trim()
+                return name, None
+            job = self.jobs[name] = TranscodeJob(name, target)
+        threading.Thread(target=self.transcode, args=(path, audio_format, bitrate, job), daemon=True).start()
+        return name, job
+
+    def transcode(self, source, audio_format, bitrate, job):
+        # Written under a temporary name and then moved into place, so that a rendition that exists at all is complete. ffmpeg writes to a pipe rather than to
+        # the file itself so that it never seeks back to rewrite a header: what follow() has already sent is then the same as what ends up in the cache.
+        try:
+            os.makedirs(self.location, exist_ok=True)
+            with open(job.tmp_path, 'wb') as f:
+                subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-i', source, '-vn', '-b:a', '%dk' % bitrate]
+                               + FORMATS[audio_format][1] + ['pipe:1'], stdin=subprocess.DEVNULL, stdout=f, check=True)
+            os.replace(job.tmp_path, job.target)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning('could not transcode %s to %s: %s' % (source, audio_format, e))
+            job.failed = True
+            try:
+                os.remove(job.tmp_path)
+            except OSError:
+                pass
+        finally:
+            with self.lock:
+                del self.jobs[job.name]
+            job.finished.set()
+        if not job.failed:
+            self.trim()
+
+    def follow(self, job, block_size=1 << 16):
+        # The rendition job is making, as a generator of blocks that follows the temporary file as ffmpeg writes it and ends once ffmpeg is done. If the
+        # transcode fails part of the way through, what was sent is all there is.
+        f = None
+        while f is None:
+            try:
+                f = open(job.tmp_path, 'rb')
+            except FileNotFoundError:
+                if not job.finished.is_set():
+                    job.finished.wait(FOLLOW_INTERVAL)  # ffmpeg hasn't been started yet
+                elif job.failed:
+                    return
+                else:
+                    f = open(job.target, 'rb')  # finished, and already moved into place
+
+        with f:
+            while True:
+                finished = job.finished.is_set()  # checked before reading, so that nothing written after an empty read is missed
+                block = f.read(block_size)
+                if block:
+                    yield block
+                elif finished:
+                    return
+                else:
+                    job.finished.wait(FOLLOW_INTERVAL)
+
+    def trim(self):
+        # Delete the least recently used renditions until the rest fit in size_limit. A rendition being sent when it is deleted is still sent in full, as the
+        # file stays open.
+        if not self.size_limit:
+            return
+        entries = []
+        with os.scandir(self.location) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(i[1] for i in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.size_limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,274 @@
+import os
+import os.path
+import stat
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+import logging
+
+import data
+
+# Keep the database up to date with the library as files are added, changed and removed, without rebuilding or rescanning it: new rips show up within seconds.
+# Changes are noticed with inotify where it is available (Linux), and by comparing the modification times of the album folders every so often otherwise. They are
+# gathered up by folder, and once the library has been quiet for a moment, the folders that changed are brought up to date with WebStereoDB.sync_directories(),
+# which reads only the files in them that are new or have changed.
+# Run it on its own with `python3 watcher.py`, or set watch-library in config.json to have webstereo.py run it alongside the web interface.
+
+#Initialize logging
+logging.basicConfig(format='%(asctime)s %(levelname)s %(filename)s %(funcName)s:%(lineno)d %(name)s %(message)s')
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')  # watch descriptor, mask, cookie, length of the name that follows
+
+MAX_DELAY = 30  # seconds; changes are applied at least this often, even if they never stop coming, so that a large copy shows up as it goes
+
+
+class Inotify:
+    # Just enough of the inotify API, through ctypes. Raises OSError if it isn't available.
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self.add_watch = libc.inotify_add_watch
+            self.rm_watch = libc.inotify_rm_watch
+            self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError('inotify is not available on this system')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def watch(self, path):
+        # The watch descriptor for path. Raises FileNotFoundError if it has gone, or OSError if it can't be watched - ENOSPC means that fs.inotify.max_user_watches
+        # has been reached.
+        wd = self.add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise (FileNotFoundError if error == 2 else OSError)(error, os.strerror(error), path)
+        return wd
+
+    def unwatch(self, wd):
+        self.rm_watch(self.fd, wd)  # fails harmlessly if the folder has already gone
+
+    def read(self):
+        # Yield (watch descriptor, mask, name) for each event waiting to be read.
+        try:
+            buffer = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            yield wd, mask, os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    def __init__(self, database, location, debounce=2, poll_interval=30, jobs=1):
+        # Changes are applied once nothing has changed for `debounce` seconds. Without inotify, the library is looked at every `poll_interval` seconds. Folders are
+        # identified by () for the library, (artist,) and (artist, album), as for sync_directories().
+        self.db = database
+        self.location = location
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.jobs = jobs
+        self.dirty = set()  # folders changed since the last sync
+        self.first_change = None
+        self.last_change = None
+        self.contents = {}  # see run_polling()
+        self.watches = {}  # inotify watch descriptor: folder
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        # Watch with inotify if possible, and otherwise, or if it stops working (there are more folders than the system allows watches, say), poll.
+        try:
+            self.run_inotify()
+            return
+        except OSError as e:
+            log.warning('cannot watch %s with inotify (%s); looking for changes every %d seconds instead' % (self.location, e, self.poll_interval))
+        self.run_polling()
+
+    def mark(self, folder):
+        now = time.time()
+        self.dirty.add(folder)
+        self.first_change = self.first_change or now
+        self.last_change = now
+
+    def time_to_sync(self):
+        # Seconds until the changes so far are due to be applied, or None if there are none.
+        if not self.dirty:
+            return None
+        return max(0, min(self.last_change + self.debounce, self.first_change + MAX_DELAY) - time.time())
+
+    def sync(self):
+        folders, self.dirty = self.dirty, set()
+        self.first_change = self.last_change = None
+        self.contents = {}
+        try:
+            added, changed, removed = self.db.sync_directories(self.location, folders, self.jobs)
+        except Exception as e:
+            # Whatever went wrong (a file that trips up mutagen, or a database that stays locked), the watcher carries on, and the folders are looked at again once
+            # the debounce has passed; they would otherwise wait until they next change, or for data.py -s.
+            log.exception('could not apply changes to %s: %s' % (', '.join('/'.join(i) or self.location for i in sorted(folders)), e))
+            for folder in folders:
+                self.mark(folder)
+            return
+        if added or changed or removed:
+            log.info('%d added, %d changed, %d removed' % (added, changed, removed))
+
+    def path(self, folder):
+        return self.location + '/'.join(folder)
+
+    def run_inotify(self):
+        inotify = Inotify()
+        try:
+            self.watch_tree(inotify, ())
+            log.info('watching %d folders in %s' % (len(self.watches), self.location))
+            while not self.stopped.is_set():
+                # Wake up at least once a second to notice stop().
+                wait = self.time_to_sync()
+                readable, _, _ = select.select([inotify.fd], [], [], 1 if wait is None else min(wait, 1))
+                if readable:
+                    for wd, mask, name in inotify.read():
+                        self.handle_event(inotify, wd, mask, name)
+                if self.time_to_sync() == 0:
+                    self.sync()
+        finally:
+            self.watches = {}
+            inotify.close()
+
+    def watch_tree(self, inotify, folder):
+        # Watch folder, and, for the library and artist folders, every folder inside it. Folders made inside it from here on are reported by the watch on it; those
+        # made before are found by listing it, so none are missed.
+        try:
+            self.watches[inotify.watch(self.path(folder))] = folder
+            children = os.listdir(self.path(folder)) if len(folder) < 2 else []
+        except FileNotFoundError:
+            if not folder:
+                raise  # the library itself is missing
+            return  # gone again already
+        for name in children:
+            if os.path.isdir(self.path(folder + (name,))):
+                self.watch_tree(inotify, folder + (name,))
+
+    def unwatch_tree(self, inotify, folder):
+        for wd, watched in list(self.watches.items()):
+            if watched[:len(folder)] == folder:
+                inotify.unwatch(wd)
+                del self.watches[wd]
+
+    def handle_event(self, inotify, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log.warning('too many changes at once; looking at the whole library')
+            self.mark(())
+            return
+        folder = self.watches.get(wd)
+        if folder is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]  # the folder was deleted
+            return
+
+        if len(folder) < 2:
+            # The library or an artist folder: only the folders inside it matter; files outside of the artist/album structure are ignored, as by walk_library().
+            if not mask & IN_ISDIR:
+                return
+            child = folder + (name,)
+            self.mark(child)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(inotify, child)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.unwatch_tree(inotify, child)
+        elif not mask & IN_ISDIR and os.path.splitext(name)[1].lower() in data.SUPPORTED_EXTENSIONS:
+            self.mark(folder)
+
+    def album_folders(self):
+        # {(artist, album): modification time} for every album folder. Adding, removing or renaming a file changes the modification time of its folder, so
+        # comparing these finds the albums that have changed without looking at any files.
+        albums = {}
+        try:
+            artists = os.listdir(self.location)
+        except OSError as e:
+            log.warning('cannot read %s: %s' % (self.location, e))
+            return albums
+        for artist in artists:
+            try:
+                names = os.listdir(self.path((artist,)))
+            except OSError:
+                continue  # not a folder, or gone
+            for album in names:
+                try:
+                    st = os.stat(self.path((artist, album)))
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    albums[(artist, album)] = st.st_mtime_ns
+        return albums
+
+    def folder_contents(self, folder):
+        try:
+            with os.scandir(self.path(folder)) as it:
+                return sorted((i.name, i.stat().st_size, i.stat().st_mtime_ns) for i in it if i.is_file())
+        except OSError:
+            return None
+
+    def run_polling(self):
+        # Folders whose modification times have changed are marked, as are those that have appeared or disappeared. Editing a file in place doesn't change its
+        # folder, so without inotify that is left to data.py -s; most tag editors write a new file and rename it over the old one, which does.
+        albums = self.album_folders()
+        while not self.stopped.wait(self.debounce if self.dirty else self.poll_interval):
+            current = self.album_folders()
+            for album in set(albums) | set(current):
+                if albums.get(album) != current.get(album):
+                    self.mark(album)
+            albums = current
+
+            # A file that is still being copied grows without changing its folder, so wait until the files in the changed folders have stopped changing.
+            contents = dict((i, self.folder_contents(i)) for i in self.dirty)
+            if contents != self.contents:
+                self.contents = contents
+                if self.dirty:
+                    self.last_change = time.time()
+            if self.time_to_sync() == 0:
+                self.sync()
+
+
+def library_watcher(database, jobs=1):
+    return LibraryWatcher(database, data.configuration['library-path'],
+                          debounce=data.configuration.get('watch-debounce', data.CONFIGURATION_TEMPLATE['watch-debounce']),
+                          poll_interval=data.configuration.get('watch-poll-interval', data.CONFIGURATION_TEMPLATE['watch-poll-interval']), jobs=jobs)
+
+
+if __name__ == '__main__':
+    data.load_configuration()
+    watcher = library_watcher(data.WebStereoDB(data.DB_PATH), jobs=data.jobs_option())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
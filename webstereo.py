@@ -6,14 +6,26 @@ import time
 import threading
 import sys
 import urllib.parse
+import json
 import data
 import audio_io
+import transcoding
+import watcher
+import loudness
+import metrics
 import waitress
 import logging
 
-# initialization of external modules and classes that are part of webstereo.
-db = data.WebStereoDB()
-player = audio_io.AudioController(db)
+# initialization of external modules and classes that are part of webstereo; see create_app().
+db = None
+player = None
+artwork = None
+transcodes = None
+background_started = False
+setup_lock = threading.Lock()
+
+STARTUP_BUDGET = 1  # seconds; create_app() warns if it takes longer than this
+STARTUP_SECONDS = metrics.Gauge('webstereo_startup_seconds', 'Time taken by create_app() to load the configuration and open the database, player and caches.')
 
 # initialize flask
 application = Flask(__name__)
@@ -25,6 +37,50 @@ log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 
+def create_app(background=False):
+    # Load the configuration and open the database, the player and the caches the routes use. Importing this module does none of that, so importing it is cheap
+    # and changes nothing: a WSGI server's workers and test clients call this (or leave it to the first request; see setup_on_first_request()), and it only
+    # does the work once. With background, the threads that run alongside the web interface are started as well - the player carrying on from where it was
+    # stopped, the library watcher and the loudness analyzer - which are only wanted in the process that actually plays music; `python3 webstereo.py` does this.
+    global db, player, artwork, transcodes, background_started
+    with setup_lock:
+        if db is None:
+            start = time.perf_counter()
+            if not data.configuration:
+                data.load_configuration()
+            data.check_password_set()
+            database = data.WebStereoDB()
+            player = audio_io.AudioController(database)
+            artwork = data.artwork_cache()
+            transcodes = data.transcode_cache()
+            # Let a front-end server (Apache with mod_xsendfile, lighttpd) send audio files straight from disk with sendfile(), rather than through Python; see
+            # stream_audio().
+            application.config['USE_X_SENDFILE'] = data.configuration.get('use-x-sendfile', data.CONFIGURATION_TEMPLATE['use-x-sendfile'])
+            db = database  # last, so that nothing is used before it is all ready
+
+            elapsed = time.perf_counter() - start
+            STARTUP_SECONDS.set(elapsed)
+            if elapsed > STARTUP_BUDGET:
+                log.warning('startup took %.3f seconds' % elapsed)
+            else:
+                log.info('started in %.3f seconds' % elapsed)
+
+        if background and not background_started:
+            background_started = True
+            player.restore_state()  # carry on from where webstereo was last stopped
+            if data.configuration.get('watch-library', data.CONFIGURATION_TEMPLATE['watch-library']):
+                watcher.library_watcher(db).start()  # tags are read in this process, one file at a time, rather than forking the server
+            if data.configuration.get('analyze-loudness', data.CONFIGURATION_TEMPLATE['analyze-loudness']):
+                loudness.loudness_analyzer(db).start()
+    return application
+
+
+@application.before_request
+def setup_on_first_request():
+    if db is None:
+        create_app()
+
+
 @application.route('/')
 def index():
     # The main page- it exists primarily to redirect to other pages. While this is technically a route, it avoids the _page convention used to specify default
@@ -78,7 +134,9 @@ def albums_page(row_width=6):
     if data.configuration['authenticate'] and 'active' not in session:
             return redirect('/')  # no user is authenticated
         
-    albums = db.fetch_albums()
+    # Only the first page of albums is rendered here; pages.js fetches the rest from /data/albums as the user scrolls.
+    albums = db.fetch_albums(limit=page_size())
+    next_page = json.dumps(db.page_cursor(albums, db.ALBUM_SORT_KEYS['ARTIST']) if len(albums) == page_size() else None)
     # tmp is added to this every row_width cycles, making it a 2-D array which is processed using nested for loops in the template to fill out an HTML table.
     # I am aware of the oceans of ink spilled in diatribe against table-based layouts, but this variable-size arrangement is what it's actually for - thus, I have no remorse for using it.
     albums_final = [] 
@@ -92,7 +150,7 @@ def albums_page(row_width=6):
             except IndexError:
                 # we know we're done when there is no more data to fetch; an IndexError will be raised at that point.
                 albums_final.append(tmp)
-                return render_template('albums.html', albums=albums_final, row_width=row_width)
+                return render_template('albums.html', albums=albums_final, row_width=row_width, next_page=next_page)
 
         x += 1
         albums_final.append(tmp)  # add row to final list of albums
@@ -106,21 +164,130 @@ def songs_page():
     # Authenticate, if the configuration stipulates that we must do so.
     if data.configuration['authenticate'] and 'active' not in session: return redirect('/')
 
-    sql_songs = db.fetch_songs()
-    songs = []
+    # Only the first page of songs is rendered here; pages.js fetches the rest from /data/songs as the user scrolls.
+    songs = db.fetch_songs(limit=page_size())  # rows from the database carry their album's ID, which the template uses for links and artwork
+    next_page = json.dumps(db.page_cursor(songs, db.SONG_SORT_KEYS['TITLE']) if len(songs) == page_size() else None)
     playlists = db.fetch_all_playlist_names()  # used for the 'append to playlist' interface
 
-    # To give the album ID to the template, data must be added to the array returned by the database (given the way the database is built from a media folder, there is no easy way - that I know of, at least - to add album IDs
-    # to the songs' data structure). However, SQLite returns a tuple by default, on which one cannot run .append(). Therefore, these tuples must first be converted into lists so that .append() can be used. This done, the needed
-    # data is added
-    index = 0
-    for i in sql_songs:
-        songs.append(list(i))
-        songs[index].append(db.search_albums(i[db.DB_SONG_ALBUM])[0][db.DB_ALBUM_ID])
-        #log.debug(db.search_albums(i[db.DB_SONG_ALBUM])[0][db.DB_ALBUM_ID])
-        index += 1
+    return render_template('songs.html', songs=songs, playlists=playlists, next_page=next_page)
 
-    return render_template('songs.html', songs=songs, playlists=playlists)
+
+def page_size():
+    # Number of rows sent at once by /songs, /albums and their /data/ counterparts.
+    return data.configuration.get('page-size', 100)
+
+
+def fetch_page(fetch, sort_keys, default_sort):
+    # Shared by the /data/ routes: read the sort order, cursor and page size from the query string, fetch the rows, and work out where the next page begins.
+    sort_by = request.args.get('sort', default_sort)
+    if sort_by not in sort_keys:
+        abort(400)
+    try:
+        after = json.loads(request.args['after']) if request.args.get('after') else None
+        limit = max(1, min(int(request.args.get('limit', page_size())), 1000))
+    except ValueError:
+        abort(400)
+    # The cursor is the sort keys of the last row of the previous page (see page_cursor()): one value for each key.
+    if after is not None and not (isinstance(after, list) and len(after) == len(sort_keys[sort_by])
+                                  and all(i is None or isinstance(i, (str, int, float)) for i in after)):
+        abort(400)
+
+    rows = fetch(sort_by=sort_by, limit=limit, after=after)
+    next_page = db.page_cursor(rows, sort_keys[sort_by]) if len(rows) == limit else None
+    return rows, next_page
+
+
+@application.route('/data/songs')
+def songs_data():
+    # One page of songs as JSON, used by pages.js to extend the table on the songs page.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)
+
+    rows, next_page = fetch_page(db.fetch_songs, db.SONG_SORT_KEYS, 'TITLE')
+    return jsonify(next=next_page, rows=[{
+        'id': i[db.DB_SONG_ID],
+        'title': i[db.DB_SONG_TITLE],
+        'album': i[db.DB_SONG_ALBUM],
+        'album_id': i[db.DB_SONG_ALBUM_ID],
+        'artist': i[db.DB_SONG_ARTIST],
+        'number': i[db.DB_SONG_TRACK_NUMBER],
+        'length': i[db.DB_SONG_LENGTH],
+    } for i in rows])
+
+
+@application.route('/data/albums')
+def albums_data():
+    # One page of albums as JSON, used by pages.js to extend the grid on the albums page.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)
+
+    rows, next_page = fetch_page(lambda **kwargs: db.fetch_albums(silence=True, **kwargs), db.ALBUM_SORT_KEYS, 'ARTIST')
+    return jsonify(next=next_page, rows=[{
+        'id': i[db.DB_ALBUM_ID],
+        'title': i[db.DB_ALBUM_TITLE],
+        'artist': i[db.DB_ALBUM_ARTIST],
+        'genre': i[db.DB_ALBUM_GENRE],
+        'year': i[db.DB_ALBUM_YEAR],
+    } for i in rows])
+
+
+@application.route('/data/playlists/<string:playlist>')
+def playlist_data(playlist):
+    # One page of the songs in a playlist as JSON, used by pages.js to fill in the playlists page as each playlist is opened.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)
+
+    try:
+        rows, next_page = fetch_page(lambda **kwargs: db.fetch_playlist_songs(playlist, **kwargs), db.PLAYLIST_ITEM_SORT_KEYS, 'POSITION')
+    except IndexError:
+        abort(404)  # no such playlist
+    return jsonify(next=next_page, rows=[{
+        'id': i[db.DB_SONG_ID],
+        'title': i[db.DB_SONG_TITLE],
+        'album': i[db.DB_SONG_ALBUM],
+        'album_id': i[db.DB_SONG_ALBUM_ID],
+        'artist': i[db.DB_SONG_ARTIST],
+        'length': i[db.DB_SONG_LENGTH],
+        'position': i[db.DB_PLAYLIST_ITEM_POSITION],
+    } for i in rows])
+
+
+@application.route('/data/statistics')
+def statistics_data():
+    # The size of the library, overall and by genre, artist and format (the largest ?limit= of each), from the totals kept in LIBRARY_STATISTICS.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)
+
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    songs, albums, duration = db.library_totals()
+    breakdown = lambda kind: [{'name': i[0], 'songs': i[1], 'albums': i[2], 'duration': i[3]} for i in db.library_breakdown(kind, limit)]
+    return jsonify(songs=songs, albums=albums, duration=duration, genres=breakdown('genre'), artists=breakdown('artist'), formats=breakdown('format'))
+
+
+@application.route('/metrics')
+def metrics_data():
+    # Request, database and player metrics in the Prometheus text format; see metrics.py. A scraper can't log in, so with public-metrics set, it needn't.
+    if data.configuration['authenticate'] and 'active' not in session and not data.configuration.get('public-metrics', data.CONFIGURATION_TEMPLATE['public-metrics']):
+        abort(403)
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@application.route('/data/search')
+def search_data():
+    # Type-ahead suggestions for the search boxes (see search.js): the best few songs, albums and artists matching what has been typed so far.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)
+
+    search_query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    return jsonify(songs=[{
+        'id': i[db.DB_SONG_ID],
+        'title': i[db.DB_SONG_TITLE],
+        'album': i[db.DB_SONG_ALBUM],
+        'artist': i[db.DB_SONG_ARTIST],
+    } for i in db.search_in_songs(search_query, limit)], albums=[{
+        'id': i[db.DB_ALBUM_ID],
+        'title': i[db.DB_ALBUM_TITLE],
+        'artist': i[db.DB_ALBUM_ARTIST],
+    } for i in db.search_in_albums(search_query, limit)], artists=[{
+        'artist': artist,
+        'albums': albums,
+    } for artist, albums in db.search_artists(search_query, limit)])
 
 
 @application.route('/search', methods=['GET', 'POST'])
@@ -134,23 +301,17 @@ def search_page():
     else:
         # POST request, execute search
         search_query = request.form['search-query']
-        sql_results_song = db.search_in_songs(search_query)
+        results_song = db.search_in_songs(search_query)
         results_album = db.search_in_albums(search_query)
-        results_song = []
         log.debug('RESULTS FOR SONG: %s' %  results_song)
         log.debug('RESULTS FOR ALBUM: %s' % results_album)
 
-        index = 0
-        for i in sql_results_song:
-            results_song.append(list(i))
-            results_song[index].append(db.search_albums(i[db.DB_SONG_ALBUM])[0][db.DB_ALBUM_ID])
-            index += 1
-            
         return render_template('search.html',
-                               results=(sql_results_song or results_album),
+                               results=(results_song or results_album),
+                               search_query=search_query,
                                results_song=results_song, size=256,
                                results_album=results_album,
-                               quantity_msg='{} songs, {} albums'.format(len(sql_results_song), len(results_album)))
+                               quantity_msg='{} songs, {} albums'.format(len(results_song), len(results_album)))
 
 
 @application.route('/playlists', methods=['GET', 'POST'])
@@ -159,20 +320,9 @@ def playlists_page():
     if data.configuration['authenticate'] and 'active' not in session: return redirect('/')  # authentication
     
     if request.method == 'GET':
-        # GET requests, show available playlists
-        results = db.fetch_all_playlists()
-        for i in results:
-            for j in range(len(i.contents)):
-                try:
-                    i.contents[j] = list(i.contents[j])
-                    i.contents[j].append(db.search_albums(i.contents[j][db.DB_SONG_ALBUM])[0][db.DB_ALBUM_ID])
-                except IndexError:  # empty space
-                    pass
-                
-        if results:
-            return render_template('playlists.html', contents=results)
-        else:
-            return render_template('playlists.html', contents=[])
+        # GET requests, show available playlists. Only their names, sizes and lengths are sent; pages.js fetches the songs in a playlist from
+        # /data/playlists/<playlist> when it is opened.
+        return render_template('playlists.html', contents=db.fetch_playlist_summaries())
         
     elif request.method == 'POST':
         # POST request, create playlist
@@ -215,23 +365,30 @@ def delete_from_playlist(song_id, playlist):
     try:
         db.delete_from_playlist(playlist, song_id)
     except ValueError as e:
-        #  db.delete_from_playlist() calls .remove on a string. In keeping with the behavior of that function, it throws a ValueError if the value to be deleted is absent from the salient data.
+        # db.delete_from_playlist() throws a ValueError if the song is not in the playlist.
         log.info(str(e))
+    return ''
+
+
+@application.route('/playlists/move/<string:playlist>/<int:position>', methods=['POST'])
+def move_in_playlist(playlist, position):
+    # Move the entry at a position in a playlist to just before the entry at ?before=, or to the end of the playlist without it. Positions are those in the rows
+    # from db.fetch_playlist_songs().
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)
+    try:
+        db.move_in_playlist(playlist, position, request.args.get('before', type=int))
+    except IndexError:
+        abort(404)  # no such playlist
+    return ''
 
 
 @application.route('/nowplaying')
 @application.route('/nowplaying/<string:song>')
 def nowplaying_page(song=None):
-    # Renders the "now playing" information at the top of the screen for the frontend. 
-    # this is routinely called in backend because the logic for checking song progress and advancing to the next song is here rather than in audio_io.
-    
-    up_next_queue = []
-    for i in list(player.up_next.queue):
-        up_next_queue.append(db.find_song_by_id(i))
-
-    up_prev_queue = []
-    for i in player.up_prev:
-        up_prev_queue.append(db.find_song_by_id(i))
+    # Renders the "now playing" information at the top of the screen for the frontend. Browsers that support server-sent events are kept up to date by /events
+    # instead (see nowplaying.js); this remains for those that don't.
+    up_next_queue = db.find_songs_by_ids(player.queued(10))
+    up_prev_queue = db.find_songs_by_ids(player.up_prev)
         
     # I think these need to be separate try/except blocks so that each statement
     # gets its very own chance to fail harmlessly. This could also be solved with try/except nested inside
@@ -270,36 +427,12 @@ def nowplaying_page(song=None):
                                    )
         
     else:
-        # Fetch data for current song playing on the server
-        if player.playing:
-            if player.paused:
-                log.debug('playback is paused')
-                # Playback is paused. Do not increment counter during this time
-                track_time = player.paused_time
-            else:
-                track_time = int(time.time()) - player.start_time
-                
-            assert track_time > -5  # enable countdowns, but warn on excessively negative values
-            
-            # Convert seconds to minutes and seconds, adding leading zeroes as needed.
-            track_minutes = track_time // 60
-            track_seconds = track_time % 60
-            if track_seconds < 10:
-                track_seconds_str = '0' + str(track_seconds)
-            else:
-                track_seconds_str = str(track_seconds)
-                
-            track_time_str = str(track_minutes) + ':' + track_seconds_str
-
-            if track_time_str == player.length:
-                player.next_track()
-
-        else:
-            # Not playing, thus no time available
-            track_time_str = '0:00'
-
-        # see the note on the above instance of this line for the reasoning behind its location here.
+        # Fetch data for current song playing on the server. The player advances to the next track by itself when the current one ends.
         if data.configuration['authenticate'] and 'active' not in session: abort(403)
+
+        # Convert seconds to minutes and seconds, adding leading zeroes as needed.
+        track_time = player.position()
+        track_time_str = '%d:%02d' % (track_time // 60, track_time % 60)
         
         return render_template('nowplaying.html',
                                prev_queue=up_prev_queue,
@@ -313,6 +446,37 @@ def nowplaying_page(song=None):
                                )
 
 
+EVENT_KEEPALIVE_INTERVAL = 15  # seconds
+EVENT_STREAM_LIFETIME = 300  # seconds
+
+
+@application.route('/events')
+def player_events():
+    # A stream of server-sent events describing the server-side player, consumed by nowplaying.js. The first event carries the whole state (see
+    # AudioController.state()); each one after that carries only the fields that changed, and is sent only when something does change. Playback position is
+    # included in every event so that the browser can run the clock itself in between.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)
+
+    def stream():
+        sent = None
+        version = None
+        # Each open stream occupies one of waitress's threads, so close it from time to time; the browser reconnects on its own.
+        deadline = time.time() + EVENT_STREAM_LIFETIME
+        yield 'retry: 2000\n\n'
+        while time.time() < deadline:
+            new_version = player.wait_for_change(version, EVENT_KEEPALIVE_INTERVAL)
+            if new_version == version:
+                yield ': keepalive\n\n'  # keeps proxies from timing out the connection, and finds out whether the client is still there
+                continue
+            version = new_version
+            state = player.state()
+            delta = state if sent is None else {key: value for key, value in state.items() if sent.get(key) != value or key == 'position'}
+            sent = state
+            yield 'data: %s\n\n' % json.dumps(delta)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @application.route('/edit-metadata/song/<int:song_id>', methods=['GET', 'POST'])
 def metadata_editor_songs(song_id):
     # This, intuitively, edits the metadata on a song, both in the database and (if possible) in the audio file on disk.
@@ -325,12 +489,14 @@ def metadata_editor_songs(song_id):
         # POST request, change metadata stored in database.
         # new_album is a holdover from the time before songs had unique IDs- to uniquely identify a particular song, its album had to be passed along with its name. Therefore,
         # old and new album names were stored in the form, the former using a display: none - style kludge.
-        new_metadata = {
-                'title': item,
+        try:
+            new_metadata = {
                 'new_title': request.form['title'],
                 'album': request.form['new album'],
-                'number': request.form['number'],
+                'number': int(request.form['number']),
             }
+        except ValueError:
+            abort(400)  # track numbers are numbers
         db.edit_song(song_id, new_metadata)
 
         return redirect(request.url)
@@ -353,10 +519,10 @@ def metadata_editor_albums(album_id):
                 "genre": request.form['genre'],
                 "year": request.form['year'],
             }
-        db.edit_album(album_id, new_metadata)
+        album_id = db.edit_album(album_id, new_metadata)  # which changes if it was merged into another album
 
         # change album artwork, if file is supplied. Artwork is stored as "artwork.jpg" files contained in each album's directory, not in the SQL database.
-        artwork_path = db.search_albums(new_metadata['title'])[0][3]  # get location to save file
+        artwork_path = db.find_album_by_id(album_id)[db.DB_ALBUM_ARTWORK]  # get location to save file
         is_allowed = lambda filename: os.path.splitext(fileitem.filename)[-1].lower() in data.configuration['allowed-artwork-extensions']  # confirm that file is permissible per config.json.
 
         # save the file
@@ -365,14 +531,14 @@ def metadata_editor_albums(album_id):
             flash('no file part')
             log.debug('no file part')
 
-            return redirect(request.url)
+            return redirect(url_for('metadata_editor_albums', album_id=album_id))
 
         fileitem = request.files['artworkupload']
         if fileitem.filename == '':
             flash('no file')
             log.debug('no file')
 
-            return redirect(request.url)
+            return redirect(url_for('metadata_editor_albums', album_id=album_id))
         
         log.debug(os.path.splitext(fileitem.filename))
         log.debug(os.path.splitext(fileitem.filename[-1]))
@@ -387,48 +553,98 @@ def metadata_editor_albums(album_id):
             fileitem.save(artwork_path)
             log.debug('file saved')
 
-        return redirect(request.url)  # return to the metadata editor, open to the item processed above.
+        return redirect(url_for('metadata_editor_albums', album_id=album_id))  # return to the metadata editor, open to the item processed above.
+
+
 
 
+ARTWORK_REDIRECT_MAX_AGE = 300  # seconds; how long a browser may go on using the resized copy it was last sent for an album without asking again
+ARTWORK_MAX_AGE = 365 * 24 * 3600  # seconds; resized copies never change, see thumbnails.py
 
 
 @application.route('/artwork/<int:album>')
 @application.route('/artwork/<string:album>')
 def send_artwork(album):
-    # Send the image file with the cover art for the specified album
+    # Send the cover art for the specified album, by redirecting to a copy in the artwork cache. ?size= asks for a copy resized to fit in a square of that many
+    # pixels (or the next standard size up); without it, the full-size image is sent.
     # Authenticate, if it is enabled.
     if data.configuration['authenticate'] and 'active' not in session: abort(403)
-    default_path = os.getcwd() + '/' + 'static' + '/' + 'default-artwork.jpg'
+    default_path = os.getcwd() + '/' + data.DEFAULT_ARTWORK
 
     if type(album) == int:
         f = db.fetch_album_artwork_by_id(album)
     elif album == 'none':  # special case where artwork does not exist
-        return send_file(default_path)
+        f = None
     else:  # string, presumably
         f = db.fetch_album_artwork_by_name(album)
 
-    if f:
-        return send_file(f)
-    else:
-        # Some albums don't have artwork (f is None). In those cases, use the default file- the webstereo logo.
-        return send_file(default_path)
+    # Some albums don't have artwork (f is None). In those cases, use the default file- the webstereo logo.
+    try:
+        name = artwork.thumbnail(f or default_path, request.args.get('size', 0, type=int))
+    except OSError as e:
+        log.warning('cannot read artwork for %s: %s' % (album, e))
+        abort(404)
+
+    response = redirect(url_for('send_cached_artwork', name=name))
+    response.headers['Cache-Control'] = 'private, max-age=%d' % ARTWORK_REDIRECT_MAX_AGE
+    return response
+
+
+@application.route('/artwork/cache/<string:name>')
+def send_cached_artwork(name):
+    # A file from the artwork cache. Its name is derived from its contents, so it can be cached for as long as the browser likes; ETag and Last-Modified are
+    # there for the benefit of anything that asks again regardless.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)
+
+    response = send_from_directory(artwork.location, name, etag=os.path.splitext(name)[0])
+    response.headers['Cache-Control'] = 'private, max-age=%d, immutable' % ARTWORK_MAX_AGE
+    return response
 
 
 @application.route('/player/<int:song_id>')
 def browserplayer(song_id):
     # Allows for playing audio in the user's browser. Niceties such as up next and shuffle, however, will not work; those depend on server-side functionality.
     if data.configuration['authenticate'] and 'active' not in session: abort(403)
+    # ?format= and ?bitrate= choose what the player is sent; see stream_audio().
     s = db.find_song_by_id(song_id)
-    return render_template('player.html', song=s)
+    if not s: abort(404)
+    audio_format = request.args.get('format', 'original')
+    bitrate = request.args.get('bitrate', data.configuration.get('transcode-bitrate', data.CONFIGURATION_TEMPLATE['transcode-bitrate']), type=int)
+    return render_template('player.html', song=s, audio_format=audio_format, bitrate=bitrate, formats=sorted(transcoding.FORMATS))
 
 
+@application.route('/stream/<int:song_id>')
 @application.route('/get-audio-file/<int:song_id>')
-def get_audio_file(song, album):
-    # Send the audio file to the frontend, used in the browser-side player.
+def stream_audio(song_id):
+    # Send a song to the browser-side player. Without ?format= (or with format=original), the file is sent as it is, and Range requests - which is how the
+    # browser seeks - are answered with just the part asked for. With use-x-sendfile, the front-end server sends it instead, straight from disk.
+    # ?format=opus, aac or mp3 sends it transcoded, at ?bitrate= kbit/s. Renditions are kept in a cache (see transcoding.py) and sent from there like the
+    # original; one that is still being made is sent as it is written, without Range support, so the first listener doesn't wait for the whole song.
     if data.configuration['authenticate'] and 'active' not in session: abort(403)  # authenicate if needed.
 
-    filepath = db.find_song_by_id(song_id)[db.DB_SONG_FILE]  # Get file path from database.
-    return send_file(filepath)
+    song = db.find_song_by_id(song_id)
+    if not song: abort(404)
+    filepath = song[db.DB_SONG_FILE]
+    audio_format = request.args.get('format', 'original')
+    if audio_format == 'original':
+        try:
+            return send_file(filepath, conditional=True)
+        except FileNotFoundError:
+            abort(404)
+
+    if audio_format not in transcoding.FORMATS: abort(400)
+    bitrate = request.args.get('bitrate', data.configuration.get('transcode-bitrate', data.CONFIGURATION_TEMPLATE['transcode-bitrate']), type=int)
+    if not transcoding.MIN_BITRATE <= bitrate <= transcoding.MAX_BITRATE: abort(400)
+    mimetype = transcoding.FORMATS[audio_format][2]
+    try:
+        name, job = transcodes.rendition(filepath, audio_format, bitrate)
+    except OSError as e:
+        log.warning('cannot read %s: %s' % (filepath, e))
+        abort(404)
+
+    if job:
+        return Response(transcodes.follow(job), mimetype=mimetype, headers={'Cache-Control': 'no-cache'})
+    return send_from_directory(transcodes.location, name, mimetype=mimetype, etag=os.path.splitext(name)[0])
 
 
 @application.route('/play/song/<int:song_id>', methods=['POST'])
@@ -453,23 +669,66 @@ def up_next_backend_song(song_id):
     if player.shuffle_on:
         player.end_shuffle()
 
-    # Adds song to "up next" queue.
-    player.enqueue_song(song_id)
+    # Adds song to "up next" queue: at the end, or before the entry at ?before= (a position from the up_next_positions sent by /events).
+    player.enqueue_song(song_id, before=request.args.get('before', type=int))
     log.debug('added song: %d' % song_id)
     return ''
 
 
+@application.route('/up-next/move/<int:position>', methods=['POST'])
+def up_next_move(position):
+    # Move the queue entry at a position to just before the entry at ?before=, or to the end of the queue.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)  # authentication
+
+    if not player.move_queued(position, request.args.get('before', type=int)):
+        abort(404)  # no such entry
+    return ''
+
+
+@application.route('/up-next/remove/<int:position>', methods=['POST'])
+def up_next_remove(position):
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)  # authentication
+
+    if not player.remove_queued(position):
+        abort(404)  # no such entry
+    return ''
+
+
+def enqueue_all(song_ids):
+    # Shared by the routes that queue many songs at once: like a single song, they take the queue back from shuffle mode. ?before= is as for /up-next/song.
+    if player.shuffle_on:
+        player.end_shuffle()
+    count = player.enqueue_songs(song_ids, before=request.args.get('before', type=int))
+    log.debug('added %d songs' % count)
+    return ''
+
+
 @application.route('/up-next/album/<int:album_id>', methods=['POST'])
 def up_next_backend_album(album_id):
     if data.configuration['authenticate'] and 'active' not in session: abort(403)  # authentication
 
-    # fetch_album_contents takes an album title, which must be extracted from the unique ID given by the URL.
-    track_results = db.fetch_album_contents(db.find_album_by_id(album_id)[db.DB_ALBUM_TITLE])
-    # add every song to the list for "up next."
-    for i in track_results:
-        player.enqueue_song(i[db.DB_SONG_ID])
+    # add every song to the list for "up next," in track order.
+    return enqueue_all([i[db.DB_SONG_ID] for i in db.fetch_album_contents(album_id)])
 
-    return ''
+
+@application.route('/up-next/playlist/<string:playlist>', methods=['POST'])
+def up_next_backend_playlist(playlist):
+    # Queue a playlist in its own order, rather than shuffled.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)  # authentication
+
+    try:
+        song_ids = db.fetch_playlist_contents(playlist)
+    except IndexError:
+        abort(404)  # no such playlist
+    return enqueue_all(song_ids)
+
+
+@application.route('/up-next/search', methods=['POST'])
+def up_next_backend_search():
+    # Queue every song matching ?q=, best matches first, as listed on the search page.
+    if data.configuration['authenticate'] and 'active' not in session: abort(403)  # authentication
+
+    return enqueue_all([i[db.DB_SONG_ID] for i in db.search_in_songs(request.args.get('q', ''))])
 
 
 @application.route('/command/<string:parameter>', methods=['POST'])
@@ -493,15 +752,17 @@ def player_command(parameter, value=''):
     elif parameter == 'next':
         player.next_track()
 
+    elif parameter == 'prev':
+        player.previous_track()
+
     elif parameter == 'purge':
         # Clear the queue
-        tracks = list(player.up_next.queue)
-        for i in tracks:
-            player.up_next.get_nowait()
+        player.clear_queue()
 
     elif parameter == 'shuffle-begin':
+        # ?seed= replays a particular order; ?spread-artists=1 avoids playing the same artist twice in a row.
         log.debug("Starting shuffle with playlist %s" % value)
-        player.begin_shuffle(value)
+        player.begin_shuffle(value, request.args.get('seed', type=int), request.args.get('spread-artists', 0, type=int) == 1)
 
     elif parameter == 'shuffle-end':
         player.end_shuffle()
@@ -525,7 +786,7 @@ def album_songs(album_id):
     try:
         # If finding the album succeeds but fetching its contents fails, something is badly wrong with the database or the structure of the library folder
         album = db.find_album_by_id(album_id)
-        result = db.fetch_album_contents(album[db.DB_ALBUM_TITLE])
+        result = db.fetch_album_contents(album_id)
     except IndexError:
         abort(404)
         
@@ -536,6 +797,23 @@ def album_songs(album_id):
                            playlists=playlists)
 
 
+# For streamed responses (/events, transcoded audio), this is the time until the response starts, not until it ends.
+REQUEST_SECONDS = metrics.Histogram('webstereo_http_request_duration_seconds', 'Time taken to answer requests, by endpoint.', ['endpoint', 'method', 'status'])
+
+
+@application.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@application.after_request
+def record_request_time(response):
+    start = g.get('request_start')
+    if start is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, request.endpoint or 'none', request.method, response.status_code)
+    return response
+
+
 @application.context_processor
 def inject_template_globals():
     # This function makes the following variables available for use in templates without having to specify in every render_template() call.
@@ -547,6 +825,8 @@ def inject_template_globals():
         db_song_length = db.DB_SONG_LENGTH,
         db_song_enctype = db.DB_SONG_ENCTYPE,
         db_song_id = db.DB_SONG_ID,
+        db_song_album_id = db.DB_SONG_ALBUM_ID,
+        db_song_artist = db.DB_SONG_ARTIST,
         db_song_unallocated_space = db.DB_SONG_UNALLOCATED_SPACE,
         db_album_title = db.DB_ALBUM_TITLE,  # album
         db_album_artist = db.DB_ALBUM_ARTIST,
@@ -555,9 +835,10 @@ def inject_template_globals():
         db_album_id = db.DB_ALBUM_ID,
         db_album_unallocated_space = db.DB_ALBUM_UNALLOCATED_SPACE,
         db_playlist_name = db.DB_PLAYLIST_NAME,  # playlist
-        db_playlist_contents = db.DB_PLAYLIST_CONTENTS,
+        db_playlist_id = db.DB_PLAYLIST_ID,
         db_playlist_modified_time = db.DB_PLAYLIST_MODIFIED_TIME,
-        db_statistics = db.STATISTICS_MSG,  # misc.
+        db_playlist_item_position = db.DB_PLAYLIST_ITEM_POSITION,
+        db_statistics = db.statistics_message(),  # misc.
         require_authentication = data.configuration['authenticate'],  # This is necessary to determine whether the nowplaying panel is shown or not.
         album_artwork_size = data.configuration['artwork_size']
         )
@@ -602,33 +883,10 @@ def error_500(e):
     return render_template('error-500.html')
 
 
-class DataUpdateThread(threading.Thread):
-    # Do this to ensure that songs are rotated and the queue advances in the background.
-    # This is a prime example of the perpetual quandry of whether design mistakes are worth rewriting
-    # or best simply hacked around.
-    def run(self):
-        while True:
-            try:
-                nowplaying_page()
-            except AttributeError:
-                # Calling a routing function here, outside the normal HTTP request context, means that the flask functions for dealing
-                # with web app-type things don't have the necessary prerequisites. However, the relevant code that must be executed routinely here
-                # doesn't pertain to that. Trap this error so as to prevent this thread from exiting.
-                pass
-            except RuntimeError:
-                # see above
-                pass
-            
-            time.sleep(1) # do this every one second so that every possible time stamp is verified.
-
-
-# Neither waitress.serve() nor application.run() ever return. Therefore, this thread is started before the main web app.
-update_thread = DataUpdateThread()
-update_thread.start()
-
-print('Starting application on ', data.configuration['host'], ':', data.configuration['port'])
-
 if __name__ == '__main__':
+     create_app(background=True)
      host = data.configuration['host']
      port = data.configuration['port']
-     waitress.serve(application, host=host, port=port)
+     print('Starting application on ', host, ':', port)
+     # Every open page holds a thread for its /events stream, so allow for rather more than waitress's default of four.
+     waitress.serve(application, host=host, port=port, threads=data.configuration.get('server-threads', 16))